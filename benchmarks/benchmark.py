@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+
+__license__ = 'MIT'
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import http.server
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from functools import partial
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from cargo_generator import cargo_generator
+from flutter_sdk_generator import flutter_sdk_generator
+from pubspec_generator import pubspec_generator
+
+BENCHMARKS = ['pubspec', 'cargo', 'sdk', 'full']
+DEFAULT_SIZES = '100,1000,10000,50000'
+FLUTTER_TAG = '3.99.0'
+FAKE_HOST = 'https://bench.invalid'
+ENGINE_ARTIFACTS = [
+    'dart-sdk-linux-x64.zip',
+    'dart-sdk-linux-arm64.zip',
+    'sky_engine.zip',
+    'flutter_gpu.zip',
+    'flutter_patched_sdk.zip',
+    'flutter_patched_sdk_product.zip',
+    'linux-x64/artifacts.zip',
+    'linux-x64/font-subset.zip',
+    'linux-x64-profile/linux-x64-flutter-gtk.zip',
+    'linux-x64-release/linux-x64-flutter-gtk.zip',
+    'linux-arm64/artifacts.zip',
+    'linux-arm64/font-subset.zip',
+    'linux-arm64-profile/linux-arm64-flutter-gtk.zip',
+    'linux-arm64-release/linux-arm64-flutter-gtk.zip',
+]
+GIT_ENV = {
+    'GIT_AUTHOR_NAME': 'bench',
+    'GIT_AUTHOR_EMAIL': 'bench@bench.invalid',
+    'GIT_AUTHOR_DATE': '2000-01-01T00:00:00Z',
+    'GIT_COMMITTER_NAME': 'bench',
+    'GIT_COMMITTER_EMAIL': 'bench@bench.invalid',
+    'GIT_COMMITTER_DATE': '2000-01-01T00:00:00Z',
+    'GIT_CONFIG_GLOBAL': os.devnull,
+    'GIT_CONFIG_NOSYSTEM': '1',
+}
+
+# Flutter SDK file contents, the fake `flutter` tool only creates the
+# package_config.json the real one would produce on first run
+FLUTTER_SCRIPT = '''#!/bin/sh
+root="$(cd "$(dirname "$0")/.." && pwd)"
+mkdir -p "$root/packages/flutter_tools/.dart_tool"
+cat > "$root/packages/flutter_tools/.dart_tool/package_config.json" <<EOF
+{
+  "configVersion": 2,
+  "packages": [
+    {
+      "name": "flutter_tools",
+      "rootUri": "$root/packages/flutter_tools",
+      "packageUri": "lib/",
+      "languageVersion": "3.0"
+    }
+  ]
+}
+EOF
+'''
+
+
+def _checksum(seed: str) -> str:
+    return hashlib.sha256(seed.encode('utf-8')).hexdigest()
+
+
+def _run_git(args: List[str], cwd: str, env: Dict[str, str]) -> str:
+    stdout = subprocess.run(
+        ['git'] + args, cwd=cwd, env=env, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+    ).stdout
+
+    return stdout.decode('utf-8').strip()
+
+
+def _create_git_repo(
+    work_path: str,
+    bare_path: str,
+    files: Dict[str, str],
+    env: Dict[str, str],
+    tag: Optional[str] = None,
+    executables: Optional[List[str]] = None,
+) -> str:
+    for name, contents in files.items():
+        path = Path(work_path, name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(contents)
+
+    for name in executables or []:
+        os.chmod(Path(work_path, name), 0o755)
+
+    _run_git(['init', '-q', '-b', 'main'], work_path, env)
+    _run_git(['add', '-A'], work_path, env)
+    _run_git(['commit', '-q', '-m', 'Benchmark fixture'], work_path, env)
+
+    if tag is not None:
+        _run_git(['tag', tag], work_path, env)
+
+    commit = _run_git(['rev-parse', 'HEAD'], work_path, env)
+    Path(bare_path).parent.mkdir(parents=True, exist_ok=True)
+    _run_git(['clone', '-q', '--bare', work_path, bare_path], work_path, env)
+
+    return commit
+
+
+def _pubspec_lock(size: int) -> str:
+    lines = ['packages:']
+    git_every = 100
+
+    for idx in range(size):
+        name = f'package_{idx}'
+
+        if idx % git_every == git_every - 1:
+            lines += [
+                f'  {name}:',
+                '    dependency: transitive',
+                '    description:',
+                '      path: "."',
+                '      ref: main',
+                f'      resolved-ref: {_checksum(name)[:40]}',
+                f'      url: "{FAKE_HOST}/dart/{name}.git"',
+                '    source: git',
+                '    version: "1.0.0"',
+            ]
+        else:
+            lines += [
+                f'  {name}:',
+                '    dependency: transitive',
+                '    description:',
+                f'      name: {name}',
+                f'      sha256: "{_checksum(name)}"',
+                '      url: "https://pub.dev"',
+                '    source: hosted',
+                f'    version: "1.{idx % 10}.0"',
+            ]
+
+    lines += [
+        'sdks:',
+        '  dart: ">=3.0.0 <4.0.0"',
+        '',
+    ]
+
+    return '\n'.join(lines)
+
+
+def _create_crate_repos(size: int, fixture_path: str, env: Dict[str, str]) -> List[Dict[str, Any]]:
+    crates_per_repo = 20
+    git_crates = max(1, size // 50)
+    repos = []
+
+    for repo_idx in range((git_crates + crates_per_repo - 1) // crates_per_repo):
+        names = [
+            f'git_crate_{repo_idx}_{idx}'
+            for idx in range(min(crates_per_repo, git_crates - repo_idx * crates_per_repo))
+        ]
+        files = {
+            'Cargo.toml': '\n'.join([
+                '[workspace]',
+                'members = ["crates/*"]',
+                '',
+                '[workspace.package]',
+                'version = "0.1.0"',
+                'edition = "2021"',
+                '',
+                '[workspace.dependencies]',
+                'serde = { version = "1.0", features = ["derive"] }',
+                '',
+            ]),
+        }
+
+        for name in names:
+            files[f'crates/{name}/Cargo.toml'] = '\n'.join([
+                '[package]',
+                f'name = "{name}"',
+                'version.workspace = true',
+                'edition.workspace = true',
+                '',
+                '[dependencies]',
+                'serde = { workspace = true, features = ["rc"] }',
+                '',
+            ])
+            files[f'crates/{name}/src/lib.rs'] = ''
+
+        repo_name = f'repo-{size}-{repo_idx}'
+        commit = _create_git_repo(
+            f'{fixture_path}/work/rust/{repo_name}',
+            f'{fixture_path}/git/rust/{repo_name}.git',
+            files,
+            env,
+        )
+        repos.append({
+            'url': f'{FAKE_HOST}/rust/{repo_name}.git',
+            'commit': commit,
+            'crates': names,
+        })
+
+    return repos
+
+
+def _cargo_lock(size: int, repos: List[Dict[str, Any]]) -> str:
+    lines = ['version = 3', '']
+    git_crates = sum(len(repo['crates']) for repo in repos)
+
+    for idx in range(max(0, size - git_crates)):
+        name = f'crate_{idx}'
+        lines += [
+            '[[package]]',
+            f'name = "{name}"',
+            f'version = "0.{idx % 10}.0"',
+            'source = "registry+https://github.com/rust-lang/crates.io-index"',
+            f'checksum = "{_checksum(name)}"',
+            '',
+        ]
+
+    for repo in repos:
+        for name in repo['crates']:
+            lines += [
+                '[[package]]',
+                f'name = "{name}"',
+                'version = "0.1.0"',
+                f'source = "git+{repo["url"]}?rev={repo["commit"]}#{repo["commit"]}"',
+                '',
+            ]
+
+    return '\n'.join(lines)
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@contextlib.contextmanager
+def _artifact_server(root: str):
+    handler = partial(_QuietHandler, directory=root)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _create_flutter_fixture(fixture_path: str, artifact_size: int, env: Dict[str, str]) -> Dict[str, str]:
+    engine = _checksum('engine')[:40]
+    material_fonts = f'flutter_infra_release/flutter/fonts/{_checksum("fonts")[:40]}/fonts.zip'
+    gradle_wrapper = f'flutter_infra_release/gradle-wrapper/{_checksum("gradle")[:40]}/gradle-wrapper.tgz'
+    storage_path = f'{fixture_path}/storage'
+    artifacts = [f'flutter_infra_release/flutter/{engine}/{a}' for a in ENGINE_ARTIFACTS]
+    rnd = random.Random(0)
+
+    for artifact in artifacts + [material_fonts, gradle_wrapper]:
+        path = Path(storage_path, artifact)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(rnd.getrandbits(8 * artifact_size).to_bytes(artifact_size, 'little'))
+
+    commit = _create_git_repo(
+        f'{fixture_path}/work/flutter',
+        f'{fixture_path}/git/flutter.git',
+        {
+            'version': f'{FLUTTER_TAG}\n',
+            'bin/flutter': FLUTTER_SCRIPT,
+            'bin/internal/engine.version': f'{engine}\n',
+            'bin/internal/material_fonts.version': f'{material_fonts}\n',
+            'bin/internal/gradle_wrapper.version': f'{gradle_wrapper}\n',
+            'packages/flutter_tools/pubspec.yaml': 'name: flutter_tools\n',
+            'packages/flutter_tools/pubspec.lock': _pubspec_lock(100),
+        },
+        env,
+        tag=FLUTTER_TAG,
+        executables=['bin/flutter'],
+    )
+
+    return {
+        'sdk_path': f'{fixture_path}/work/flutter',
+        'storage_path': storage_path,
+        'commit': commit,
+    }
+
+
+def _create_app_fixture(size: int, fixture_path: str, env: Dict[str, str]) -> Dict[str, str]:
+    repos = _create_crate_repos(size, fixture_path, env)
+    commit = _create_git_repo(
+        f'{fixture_path}/work/app-{size}',
+        f'{fixture_path}/git/app-{size}.git',
+        {
+            'pubspec.yaml': 'name: bench\n',
+            'pubspec.lock': _pubspec_lock(size),
+            'rust/Cargo.lock': _cargo_lock(size, repos),
+        },
+        env,
+    )
+    manifest = f'{fixture_path}/manifest-{size}.yml'
+    Path(manifest).write_text('\n'.join([
+        'app-id: com.example.bench',
+        'runtime: org.freedesktop.Platform',
+        "runtime-version: '24.08'",
+        'sdk: org.freedesktop.Sdk',
+        'command: bench',
+        'modules:',
+        '  - name: bench',
+        '    buildsystem: simple',
+        '    build-commands:',
+        '      - flutter build linux --release',
+        '    sources:',
+        '      - type: git',
+        f'        url: {FAKE_HOST}/app-{size}.git',
+        f'        commit: {commit}',
+        '      - type: git',
+        '        url: https://github.com/flutter/flutter.git',
+        f'        tag: {FLUTTER_TAG}',
+        '        dest: flutter',
+        '',
+    ]))
+
+    return {
+        'manifest': manifest,
+        'pubspec_lock': f'{fixture_path}/work/app-{size}/pubspec.lock',
+        'cargo_lock': f'{fixture_path}/work/app-{size}/rust/Cargo.lock',
+    }
+
+
+def _network_env(fixture_path: str, storage_url: str) -> Dict[str, str]:
+    'Redirects all remote git and storage URLs to the local stand-ins'
+    env = dict(GIT_ENV)
+    rewrites = {
+        f'file://{fixture_path}/git/flutter.git': 'https://github.com/flutter/flutter.git',
+        f'file://{fixture_path}/git/': f'{FAKE_HOST}/',
+    }
+    env['GIT_CONFIG_COUNT'] = str(len(rewrites))
+
+    for idx, (url, instead_of) in enumerate(rewrites.items()):
+        env[f'GIT_CONFIG_KEY_{idx}'] = f'url.{url}.insteadOf'
+        env[f'GIT_CONFIG_VALUE_{idx}'] = instead_of
+
+    env['FLUTTER_STORAGE_BASE_URL'] = storage_url
+
+    return env
+
+
+def _measure(func: Callable[[str], Any], run_path: str, repeat: int) -> List[float]:
+    timings = []
+
+    for _ in range(repeat):
+        shutil.rmtree(run_path, ignore_errors=True)
+        os.makedirs(run_path)
+        os.environ['XDG_CACHE_HOME'] = f'{run_path}/.cache'
+
+        with contextlib.redirect_stdout(sys.stderr):
+            start = time.perf_counter()
+            func(run_path)
+            timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def _run_full_flow(manifest: str, run_path: str):
+    options = [
+        sys.executable,
+        str(ROOT / 'flatpak-flutter.py'),
+        '--cargo-locks',
+        'rust',
+        manifest,
+    ]
+    subprocess.run(options, cwd=run_path, env=dict(os.environ), stdout=sys.stderr, stderr=sys.stderr, check=True)
+
+
+def _result(benchmark: str, size: Optional[int], timings: List[float]) -> Dict[str, Any]:
+    return {
+        'benchmark': benchmark,
+        'size': size,
+        'runs': timings,
+        'min': min(timings),
+        'median': statistics.median(timings),
+    }
+
+
+def run_benchmarks(
+    work_path: str,
+    sizes: List[int],
+    benchmarks: List[str],
+    repeat: int,
+    artifact_size: int,
+) -> Dict[str, Any]:
+    fixture_path = f'{work_path}/fixtures'
+    run_path = f'{work_path}/run'
+    results = []
+    flutter = _create_flutter_fixture(fixture_path, artifact_size, GIT_ENV)
+
+    with _artifact_server(flutter['storage_path']) as storage_url:
+        os.environ.update(_network_env(fixture_path, storage_url))
+
+        if 'sdk' in benchmarks:
+            timings = _measure(lambda _: flutter_sdk_generator.generate_sdk(flutter['sdk_path']), run_path, repeat)
+            results.append(_result('flutter_sdk_generator.generate_sdk', None, timings))
+
+        for size in sizes:
+            app = _create_app_fixture(size, fixture_path, GIT_ENV)
+
+            if 'pubspec' in benchmarks:
+                timings = _measure(lambda _: pubspec_generator.generate_sources([app['pubspec_lock']]), run_path, repeat)
+                results.append(_result('pubspec_generator.generate_sources', size, timings))
+
+            if 'cargo' in benchmarks:
+                timings = _measure(
+                    lambda _: asyncio.run(cargo_generator.generate_sources([app['cargo_lock']])), run_path, repeat,
+                )
+                results.append(_result('cargo_generator.generate_sources', size, timings))
+
+            if 'full' in benchmarks:
+                timings = _measure(partial(_run_full_flow, app['manifest']), run_path, repeat)
+                results.append(_result('flatpak-flutter.py', size, timings))
+
+    return {
+        'python': platform.python_version(),
+        'git': _run_git(['--version'], work_path, GIT_ENV),
+        'repeat': repeat,
+        'artifact_size': artifact_size,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--sizes', default=DEFAULT_SIZES, help='Comma separated list of lock file package counts')
+    parser.add_argument('-b', '--benchmarks', default=','.join(BENCHMARKS), help='Comma separated list of benchmarks to run')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of runs per benchmark')
+    parser.add_argument('--artifact-size', type=int, default=1024 * 1024, help='Size in bytes of each fake engine artifact')
+    parser.add_argument('--work-dir', required=False, help='Directory to create fixtures in, kept after the run')
+    parser.add_argument('-o', '--output', required=False, help='Where to write the results, defaults to stdout')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in str(args.sizes).split(',')]
+    benchmarks = str(args.benchmarks).split(',')
+
+    for benchmark in benchmarks:
+        if benchmark not in BENCHMARKS:
+            parser.error(f'Unknown benchmark: {benchmark}')
+
+    with contextlib.ExitStack() as stack:
+        if args.work_dir is not None:
+            work_path = str(Path(args.work_dir).absolute())
+            os.makedirs(work_path, exist_ok=True)
+        else:
+            work_path = stack.enter_context(tempfile.TemporaryDirectory(prefix='flatpak-flutter-bench-'))
+
+        results = run_benchmarks(work_path, sizes, benchmarks, args.repeat, args.artifact_size)
+
+    if args.output is not None:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=4, sort_keys=False)
+            out.write('\n')
+    else:
+        json.dump(results, sys.stdout, indent=4, sort_keys=False)
+        print()
+
+
+if __name__ == '__main__':
+    main()
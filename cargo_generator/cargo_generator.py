@@ -3,20 +3,42 @@
 __license__ = 'MIT'
 import json
 import os
-import contextlib
-import copy
+import contextvars
+import fcntl
+import fnmatch
 import subprocess
 import argparse
+import http.client
 import logging
 import asyncio
+import re
+import sys
+import tempfile
+import threading
 import toml
+import urllib.error
 
 from pathlib import Path
-from typing import Any, Dict, List, NamedTuple, Optional, Tuple, TypedDict
+from typing import IO, Any, Dict, List, NamedTuple, Optional, Set, Tuple, TypedDict
 from urllib.parse import urlparse, ParseResult, parse_qs
 
+if __name__ == '__main__':
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fetch_scheduler.fetch_scheduler import get_scheduler, run_command
+from manifest_fetcher.manifest_fetcher import fetch_manifest
+from lock_digests.lock_digests import LockDigests, get_digest
+from manifest_io.manifest_io import dump_json_array
+from metrics.metrics import get_git_object_stats, get_host, metrics
+
 
 CRATES_IO = 'https://static.crates.io/crates'
+CRATES_IO_SOURCES = [
+    'registry+https://github.com/rust-lang/crates.io-index',
+    'sparse+https://index.crates.io/',
+]
+DL_MARKERS = ['{crate}', '{version}', '{prefix}', '{lowerprefix}', '{sha256-checksum}']
+INDEX_CACHE = 'flatpak-cargo/index'
 CARGO_HOME = 'cargo'
 CARGO_CRATES = f'{CARGO_HOME}/vendor'
 VENDORED_SOURCES = 'vendored-sources'
@@ -24,16 +46,6 @@ GIT_CACHE = 'flatpak-cargo/git'
 COMMIT_LEN = 7
 
 
-@contextlib.contextmanager
-def _workdir(path: str):
-    oldpath = os.getcwd()
-    os.chdir(path)
-    try:
-        yield
-    finally:
-        os.chdir(oldpath)
-
-
 def _canonical_url(url: str) -> ParseResult:
     'Converts a string to a Cargo Canonical URL, as per https://github.com/rust-lang/cargo/blob/35c55a93200c84a4de4627f1770f76a8ad268a39/src/cargo/util/canonical_url.rs#L19'
     # Hrm. The upstream cargo does not replace those URLs, but if we don't then it doesn't work too well :(
@@ -67,108 +79,341 @@ def _git_repo_name(git_url: str, commit: str) -> str:
     return f'{name}-{commit[:COMMIT_LEN]}'
 
 
-def _fetch_git_repo(git_url: str, commit: str) -> str:
+def _get_clone_dir(git_url: str) -> str:
     repo_dir = git_url.replace('://', '_').replace('/', '_')
     cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
-    clone_dir = os.path.join(cache_dir, 'flatpak-cargo', repo_dir)
+    return os.path.join(cache_dir, 'flatpak-cargo', repo_dir)
+
+
+def _lock_clone_dir(git_url: str) -> IO:
+    'Waits until no other thread or process uses the clone, the lock is released by closing the returned file'
+    lock_path = f'{_get_clone_dir(git_url)}.lock'
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    lock_file = open(lock_path, 'w')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+    return lock_file
+
+
+def _fetch_git_repo(git_url: str, commit: str) -> str:
+    clone_dir = _get_clone_dir(git_url)
     if not os.path.isdir(os.path.join(clone_dir, '.git')):
-        subprocess.run(['git', 'clone', '--depth=1', git_url, clone_dir], check=True)
+        metrics.cache('cargo-git-clone', hit=False)
+        before = (0, 0)
+        run_command(['git', 'clone', '--depth=1', git_url, clone_dir])
+    else:
+        metrics.cache('cargo-git-clone', hit=True)
+        before = get_git_object_stats(clone_dir)
     rev_parse_proc = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=clone_dir, check=True,
                                     stdout=subprocess.PIPE)
     head = rev_parse_proc.stdout.decode().strip()
     if head[:COMMIT_LEN] != commit[:COMMIT_LEN]:
-        subprocess.run(['git', 'fetch', 'origin', commit], cwd=clone_dir, check=True)
+        run_command(['git', 'fetch', 'origin', commit], cwd=clone_dir)
+        # A checkout doesn't move the submodules initialized for an earlier commit,
+        # remove them to be initialized again, reusing their objects kept in .git/modules
+        subprocess.run(['git', 'submodule', 'deinit', '--all', '--force', '--quiet'], cwd=clone_dir, check=True)
         subprocess.run(['git', 'checkout', commit], cwd=clone_dir, check=True)
 
-    # Get the submodules as they might contain dependencies. This is a noop if
-    # there are no submodules in the repository
-    subprocess.run(['git', 'submodule', 'update', '--init', '--recursive'], cwd=clone_dir, check=True)
+    after = get_git_object_stats(clone_dir)
+    metrics.inc('git_fetched_objects_total', after[0] - before[0], host=get_host(git_url))
+    metrics.inc('git_fetched_bytes_total', after[1] - before[1], host=get_host(git_url))
 
     return clone_dir
 
-def _update_workspace_keys(pkg, workspace):
-    for key, item in pkg.items():
-        # There cannot be a 'workspace' key if the item is not a dict.
-        if not isinstance(item, dict):
-            continue;
-
-        # Recurse for keys under target.cfg(..)
-        if key == 'target':
-            for target in item.values():
-                _update_workspace_keys(target, workspace)
-            continue;
-        # dev-dependencies and build-dependencies should reference root dependencies table from workspace
-        elif key == 'dev-dependencies' or key == 'build-dependencies':
-            _update_workspace_keys(item, workspace.get('dependencies', None))
-            continue;
-
-        if not workspace or not key in workspace:
-            continue;
-
-        workspace_item = workspace[key]
-
-        if 'workspace' in item:
-            if isinstance(workspace_item, dict):
-                del item['workspace']
-
-                for dep_key, workspace_value in workspace_item.items():
-                    # features are additive
-                    if dep_key == 'features' and 'features' in item:
-                        item['features'] += workspace_value
-                    else:
-                        item[dep_key] = workspace_value
-            elif len(item) > 1:
-                del item['workspace']
-                item.update({ 'version': workspace_item })
+
+# Package fields holding a path relative to the manifest they are defined in
+_PACKAGE_PATH_KEYS = ['readme', 'license-file']
+_DEPENDENCY_KEYS = ['dependencies', 'dev-dependencies', 'build-dependencies']
+
+
+def _is_inherited(item: Any) -> bool:
+    return isinstance(item, dict) and item.get('workspace') is True
+
+
+class _Workspace:
+    'Resolves the workspace inheritance of the member crates, indexing the workspace tables once'
+    def __init__(self, workspace: _TomlType, path: str):
+        self.path = path
+        self._package: _TomlType = workspace.get('package', {})
+        self._dependencies: _TomlType = workspace.get('dependencies', {})
+        self._lints: Optional[_TomlType] = workspace.get('lints')
+        self._resolved_dependencies: Dict[Tuple[str, str], Any] = {}
+        self._normalized: Dict[str, _TomlType] = {}
+
+    def _rebase(self, path: str, member_path: str) -> str:
+        # Paths in the workspace tables are relative to the workspace root
+        return os.path.relpath(os.path.join(self.path, path), member_path)
+
+    def _resolve_package(self, package: _TomlType, member_path: str) -> _TomlType:
+        resolved = {}
+
+        for key, item in package.items():
+            if not _is_inherited(item) or key not in self._package:
+                resolved[key] = item
+            elif key in _PACKAGE_PATH_KEYS and isinstance(self._package[key], str):
+                resolved[key] = self._rebase(self._package[key], member_path)
             else:
-                pkg[key] = workspace_item
-        else:
-            _update_workspace_keys(item, workspace_item)
+                resolved[key] = self._package[key]
+
+        return resolved
+
+    def _resolve_workspace_dependency(self, name: str, member_path: str) -> Any:
+        key = (name, member_path)
+
+        if key not in self._resolved_dependencies:
+            dependency = self._dependencies[name]
+
+            if isinstance(dependency, dict) and 'path' in dependency:
+                dependency = {**dependency, 'path': self._rebase(dependency['path'], member_path)}
+
+            self._resolved_dependencies[key] = dependency
+
+        return self._resolved_dependencies[key]
+
+    def _resolve_dependencies(self, dependencies: _TomlType, member_path: str) -> _TomlType:
+        resolved = {}
+
+        for name, item in dependencies.items():
+            if not _is_inherited(item) or name not in self._dependencies:
+                resolved[name] = item
+                continue
+
+            workspace_item = self._resolve_workspace_dependency(name, member_path)
+            dependency = {key: value for key, value in item.items() if key != 'workspace'}
+
+            if not isinstance(workspace_item, dict):
+                resolved[name] = {**dependency, 'version': workspace_item} if dependency else workspace_item
+                continue
+
+            for key, workspace_value in workspace_item.items():
+                # features are additive
+                if key == 'features' and 'features' in dependency:
+                    dependency['features'] = dependency['features'] + workspace_value
+                else:
+                    dependency[key] = workspace_value
+
+            resolved[name] = dependency
+
+        return resolved
+
+    def _resolve_tables(self, tables: _TomlType, member_path: str) -> _TomlType:
+        resolved = dict(tables)
+
+        for key in _DEPENDENCY_KEYS:
+            if isinstance(tables.get(key), dict):
+                resolved[key] = self._resolve_dependencies(tables[key], member_path)
+
+        return resolved
+
+    def normalize(self, package: _TomlType, member_path: str) -> _TomlType:
+        'Returns the manifest of the member crate at member_path, with all inherited keys resolved'
+        if member_path in self._normalized:
+            return self._normalized[member_path]
+
+        normalized = self._resolve_tables(package, member_path)
+
+        if isinstance(package.get('package'), dict):
+            normalized['package'] = self._resolve_package(package['package'], member_path)
+
+        if isinstance(package.get('target'), dict):
+            normalized['target'] = {
+                cfg: self._resolve_tables(target, member_path) if isinstance(target, dict) else target
+                for cfg, target in package['target'].items()
+            }
+
+        if _is_inherited(package.get('lints')) and self._lints is not None:
+            normalized['lints'] = {
+                **{key: value for key, value in package['lints'].items() if key != 'workspace'},
+                **self._lints,
+            }
+
+        self._normalized[member_path] = normalized
+
+        return normalized
+
 
 class _GitPackage(NamedTuple):
     path: str
     package: _TomlType
-    workspace: Optional[_TomlType]
+    workspace: Optional[_Workspace]
 
     @property
     def normalized(self) -> _TomlType:
-        package = copy.deepcopy(self.package)
         if self.workspace is None:
-            return package
-
-        _update_workspace_keys(package, self.workspace)
+            return self.package
 
-        return package
+        return self.workspace.normalize(self.package, self.path)
 
 _GitPackagesType = Dict[str, _GitPackage]
 
 
-async def _get_git_repo_packages(git_url: str, commit: str) -> _GitPackagesType:
+def _get_submodules(repo_dir: str, path: str = '.') -> List[Tuple[str, str]]:
+    'Returns the submodules of the (sub)repo at path, as (parent repo path, path in parent repo)'
+    gitmodules = os.path.join(repo_dir, path, '.gitmodules')
+
+    if not os.path.isfile(gitmodules):
+        return []
+
+    stdout = subprocess.run(
+        ['git', 'config', '--file', gitmodules, '--get-regexp', r'^submodule\..*\.path$'],
+        stdout=subprocess.PIPE,
+    ).stdout.decode('utf-8')
+
+    return [(path, line.split(' ', 1)[1]) for line in stdout.splitlines()]
+
+
+def _is_initialized(repo_dir: str, path: str) -> bool:
+    return os.path.exists(os.path.join(repo_dir, path, '.git'))
+
+
+def _init_submodule(repo_dir: str, parent: str, path: str):
+    cwd = os.path.join(repo_dir, parent)
+
+    try:
+        run_command(['git', 'submodule', 'update', '--init', '--depth=1', '--', path], cwd=cwd)
+    except subprocess.CalledProcessError:
+        # Servers not allowing to fetch a commit by its hash need a full fetch
+        run_command(['git', 'submodule', 'update', '--init', '--', path], cwd=cwd)
+
+
+def _is_referenced(path: str, references: Set[str]) -> bool:
+    for reference in references:
+        if fnmatch.fnmatch(path, reference) or path == reference or reference.startswith(f'{path}/'):
+            return True
+
+    return False
+
+
+def _normalize_crate_name(name: str) -> str:
+    return name.lower().replace('_', '-')
+
+
+def _get_wanted_submodules(
+    repo_dir: str,
+    references: Set[str],
+    missing: Set[str],
+) -> List[Tuple[str, str]]:
+    'Returns the submodules to initialize, for the crates still missing and the workspaces found'
+    initialized = ['.']
+    pending = []
+
+    while initialized:
+        parent = initialized.pop()
+
+        for submodule in _get_submodules(repo_dir, parent):
+            full_path = os.path.normpath(os.path.join(*submodule))
+
+            if _is_initialized(repo_dir, full_path):
+                initialized.append(full_path)
+            else:
+                pending.append(submodule)
+
+    missing_names = set(_normalize_crate_name(name) for name in missing)
+    wanted = [
+        submodule for submodule in pending
+        if _is_referenced(os.path.normpath(os.path.join(*submodule)), references)
+        or (missing and _normalize_crate_name(os.path.basename(submodule[1])) in missing_names)
+    ]
+
+    if not wanted and missing and pending:
+        # The location of the missing crates is unknown, try the submodules one by one
+        wanted = pending[:1]
+
+    return wanted
+
+
+def _find_workspace(git_repo_dir: str, root_dir: str) -> Optional[_Workspace]:
+    'Returns the workspace of the nearest parent dir of root_dir in the repo having one, like cargo'
+    parent = os.path.normpath(root_dir)
+
+    while parent != '.':
+        parent = os.path.dirname(parent) or '.'
+        cargo_toml_path = os.path.join(git_repo_dir, parent, 'Cargo.toml')
+
+        if os.path.exists(cargo_toml_path):
+            cargo_toml = _load_toml(cargo_toml_path)
+
+            if cargo_toml.get('workspace'):
+                return _Workspace(cargo_toml['workspace'], parent)
+
+    return None
+
+
+def _scan_git_repo(git_repo_dir: str, packages: _GitPackagesType, references: Set[str], root_dir: str = '.'):
+    '''Adds the packages in the repo, and the paths of workspace members and path dependencies to references
+
+    Only the packages in root_dir are added, e.g. a submodule just initialized.
+    '''
+    def _get_cargo_toml_packages(root_dir: str, workspace: Optional[_Workspace] = None):
+        # Paths are relative to the repo, the working directory is left alone
+        assert not os.path.isabs(root_dir) and os.path.isdir(os.path.join(git_repo_dir, root_dir))
+        cargo_toml_path = os.path.join(git_repo_dir, root_dir, 'Cargo.toml')
+
+        if os.path.exists(cargo_toml_path):
+            cargo_toml = _load_toml(cargo_toml_path)
+
+            if cargo_toml.get('workspace'):
+                workspace = _Workspace(cargo_toml['workspace'], os.path.normpath(root_dir))
+
+                for member in cargo_toml['workspace'].get('members', []):
+                    references.add(os.path.normpath(os.path.join(root_dir, member)))
+
+            if 'package' in cargo_toml:
+                packages[cargo_toml['package']['name']] = _GitPackage(
+                    path=os.path.normpath(root_dir),
+                    package=cargo_toml,
+                    workspace=workspace
+                )
+
+                for key in ['dependencies', 'dev-dependencies', 'build-dependencies']:
+                    for dependency in cargo_toml.get(key, {}).values():
+                        if isinstance(dependency, dict) and 'path' in dependency:
+                            references.add(os.path.normpath(os.path.join(root_dir, dependency['path'])))
+        for child in os.scandir(os.path.join(git_repo_dir, root_dir)):
+            # The git dirs of the repo and its submodules don't hold crates
+            if child.is_dir() and child.name != '.git':
+                # the workspace can be referenced by any subdirectory
+                _get_cargo_toml_packages(os.path.join(root_dir, child.name), workspace)
+
+    _get_cargo_toml_packages(root_dir, _find_workspace(git_repo_dir, root_dir))
+
+
+async def _get_git_repo_packages(git_url: str, commit: str, crate_names: Set[str]) -> _GitPackagesType:
+    # The clone is shared with concurrent runs, which could check out another commit
+    lock_file = await asyncio.get_event_loop().run_in_executor(None, _lock_clone_dir, git_url)
+
+    with lock_file:
+        return await _load_git_repo_packages(git_url, commit, crate_names)
+
+
+async def _load_git_repo_packages(git_url: str, commit: str, crate_names: Set[str]) -> _GitPackagesType:
     logging.info('Loading packages from %s', git_url)
-    git_repo_dir = _fetch_git_repo(git_url, commit)
+    future = get_scheduler().submit(git_url, _fetch_git_repo, git_url, commit)
+    git_repo_dir = await asyncio.wrap_future(future)
     packages: _GitPackagesType = {}
+    # Paths of workspace members and path dependencies, relative to the repo
+    references: Set[str] = set()
 
-    def _get_cargo_toml_packages(root_dir: str, workspace: Optional[_TomlType] = None):
-        assert not os.path.isabs(root_dir) and os.path.isdir(root_dir)
-
-        with _workdir(root_dir):
-            if os.path.exists('Cargo.toml'):
-                cargo_toml = _load_toml('Cargo.toml')
-                workspace = cargo_toml.get('workspace') or workspace
-
-                if 'package' in cargo_toml:
-                    packages[cargo_toml['package']['name']] = _GitPackage(
-                        path=os.path.normpath(root_dir),
-                        package=cargo_toml,
-                        workspace=workspace
-                    )
-        for child in os.scandir(root_dir):
-            if child.is_dir():
-                # the workspace can be referenced by any subdirectory
-                _get_cargo_toml_packages(child.path, workspace)
+    scan_dirs = ['.']
+
+    # Submodules are only initialized when they hold locked crates or workspace
+    # members, skipping e.g. large test data. Only the submodules initialized
+    # are scanned again.
+    while True:
+        for scan_dir in scan_dirs:
+            _scan_git_repo(git_repo_dir, packages, references, scan_dir)
+
+        wanted = _get_wanted_submodules(git_repo_dir, references, crate_names - packages.keys())
+
+        if not wanted:
+            break
 
-    with _workdir(git_repo_dir):
-        _get_cargo_toml_packages('.')
+        for parent, path in wanted:
+            logging.info('Initializing submodule %s of %s', os.path.normpath(os.path.join(parent, path)), git_url)
+            future = get_scheduler().submit(git_url, _init_submodule, git_repo_dir, parent, path)
+            await asyncio.wrap_future(future)
+
+        scan_dirs = [os.path.normpath(os.path.join(parent, path)) for parent, path in wanted]
 
     assert packages, f"No packages found in {git_repo_dir}"
     logging.debug(
@@ -199,12 +444,27 @@ async def _get_git_repo_sources(
 
 _GitRepo = TypedDict('_GitRepo', {'lock': asyncio.Lock, 'commits': Dict[str, _GitPackagesType]})
 _GitReposType = Dict[str, _GitRepo]
+_GitPackagesCacheType = Dict[Tuple[str, str], _GitPackagesType]
 _VendorEntryType = Dict[str, Dict[str, str]]
+_Registry = TypedDict('_Registry', {'lock': asyncio.Lock, 'config': Optional[_TomlType]})
+_RegistriesType = Dict[str, _Registry]
+
+
+def _get_git_crate_names(cargo_lock: _TomlType, repo_url: str, commit: str) -> Set[str]:
+    'Returns the names of the crates locked from the repo at the commit'
+    return set(
+        package['name'] for package in cargo_lock['package']
+        if package.get('source', '').startswith('git+')
+        and _canonical_url(package['source']).geturl() == repo_url
+        and urlparse(package['source']).fragment == commit
+    )
 
 
 async def _get_git_package_sources(
     package: _TomlType,
+    cargo_lock: _TomlType,
     git_repos: _GitReposType,
+    packages_cache: Optional[_GitPackagesCacheType],
 ) -> Tuple[List[_FlatpakSourceType], _VendorEntryType]:
     name = package['name']
     source = package['source']
@@ -219,7 +479,20 @@ async def _get_git_package_sources(
     })
     async with git_repo['lock']:
         if commit not in git_repo['commits']:
-            git_repo['commits'][commit] = await _get_git_repo_packages(repo_url, commit)
+            crate_names = _get_git_crate_names(cargo_lock, repo_url, commit)
+            # Packages in submodules are only loaded when locked, so could be missing for another lock
+            cached = packages_cache is not None and crate_names <= packages_cache.get((repo_url, commit), {}).keys()
+
+            if packages_cache is not None:
+                metrics.cache('git-packages', hit=cached)
+
+            if packages_cache is not None and cached:
+                git_repo['commits'][commit] = packages_cache[(repo_url, commit)]
+            else:
+                git_repo['commits'][commit] = await _get_git_repo_packages(repo_url, commit, crate_names)
+
+                if packages_cache is not None:
+                    packages_cache[(repo_url, commit)] = git_repo['commits'][commit]
 
     cargo_vendored_entry: _VendorEntryType = {
         repo_url: {
@@ -267,10 +540,209 @@ async def _get_git_package_sources(
     return (git_sources, cargo_vendored_entry)
 
 
+class _HttpPool:
+    'Keeps a connection per host and thread open, for the many small index requests'
+    def __init__(self):
+        self._local = threading.local()
+
+    def _request(self, url: str, headers: Dict[str, str]) -> Tuple[int, Dict[str, str], bytes]:
+        u = urlparse(url)
+        connections = self._local.__dict__.setdefault('connections', {})
+        key = (u.scheme, u.netloc)
+
+        if key not in connections:
+            connection_class = http.client.HTTPSConnection if u.scheme == 'https' else http.client.HTTPConnection
+            connections[key] = connection_class(u.netloc, timeout=60)
+
+        try:
+            connections[key].request('GET', f'{u.path}?{u.query}' if u.query else u.path, headers=headers)
+            response = connections[key].getresponse()
+
+            return response.status, dict(response.getheaders()), response.read()
+        except (http.client.HTTPException, OSError):
+            connections.pop(key).close()
+            raise
+
+    def get(self, url: str, headers: Dict[str, str]) -> Tuple[int, Dict[str, str], bytes]:
+        try:
+            return self._request(url, headers)
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            # The server closed an idle connection, retry on a new one
+            return self._request(url, headers)
+
+
+_http_pool = _HttpPool()
+
+
+def _get_index_cache_path(url: str) -> str:
+    cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+
+    return os.path.join(cache_dir, INDEX_CACHE, *url.split('://', 1)[-1].split('/'))
+
+
+def _fetch_index_file(url: str) -> bytes:
+    'Gets a file of a sparse registry index, revalidating a cached copy by its ETag'
+    cache_path = _get_index_cache_path(url)
+    etag_path = f'{cache_path}.etag'
+    headers = {'User-Agent': 'flatpak-cargo'}
+
+    if os.path.isfile(cache_path) and os.path.isfile(etag_path):
+        with open(etag_path, 'r') as input:
+            headers['If-None-Match'] = input.read()
+
+    status, response_headers, body = _http_pool.get(url, headers)
+    metrics.cache('cargo-index', hit=status == 304)
+
+    if status == 304:
+        with open(cache_path, 'rb') as input:
+            return input.read()
+    elif status != 200:
+        raise urllib.error.HTTPError(url, status, f'Getting {url} failed', response_headers, None)  # type: ignore
+
+    metrics.inc('downloaded_bytes_total', len(body), host=get_host(url))
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(cache_path), delete=False) as out:
+        out.write(body)
+
+    os.replace(out.name, cache_path)
+    etag = {key.lower(): value for key, value in response_headers.items()}.get('etag')
+
+    if etag is not None:
+        with open(etag_path, 'w') as out:
+            out.write(etag)
+    elif os.path.isfile(etag_path):
+        os.remove(etag_path)
+
+    return body
+
+
+def _get_git_index_config(index_url: str) -> bytes:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_path = os.path.join(tmp_dir, 'config.json')
+
+        if not fetch_manifest('config.json', index_url, None, config_path):
+            raise ValueError(f'No config.json found in registry index {index_url}')
+
+        with open(config_path, 'rb') as input:
+            return input.read()
+
+
+def _get_index_path(name: str) -> str:
+    'Returns the path of the index file of a crate, as per https://doc.rust-lang.org/cargo/reference/registry-index.html#index-files'
+    if len(name) <= 2:
+        return f'{len(name)}/{name}'
+    elif len(name) == 3:
+        return f'3/{name[0]}/{name}'
+
+    return f'{name[0:2]}/{name[2:4]}/{name}'
+
+
+def _get_download_url(dl: str, name: str, version: str, checksum: str) -> str:
+    'Returns the download URL of a crate, as per https://doc.rust-lang.org/cargo/reference/registry-index.html#index-configuration'
+    if not any(marker in dl for marker in DL_MARKERS):
+        return f'{dl}/{name}/{version}/download'
+
+    prefix = os.path.dirname(_get_index_path(name))
+
+    return dl.replace('{crate}', name).replace('{version}', version).replace('{prefix}', prefix) \
+        .replace('{lowerprefix}', prefix.lower()).replace('{sha256-checksum}', checksum)
+
+
+def _get_registry_name(source: str) -> str:
+    u = urlparse(source.split('+', 1)[-1])
+
+    return re.sub(r'[^a-zA-Z0-9]+', '-', f'{u.netloc}{u.path}').strip('-')
+
+
+async def _get_registry(source: str, registries: _RegistriesType) -> _TomlType:
+    registry = registries.setdefault(source, {
+        'config': None,
+        'lock': asyncio.Lock(),
+    })
+    async with registry['lock']:
+        if registry['config'] is None:
+            index_url = source.split('+', 1)[-1].rstrip('/')
+
+            if source.startswith('sparse+'):
+                future = get_scheduler().submit(index_url, _fetch_index_file, f'{index_url}/config.json')
+                config = await asyncio.wrap_future(future)
+            else:
+                loop = asyncio.get_running_loop()
+                # Run in the context of the run, to fetch with its scheduler
+                config = await loop.run_in_executor(None, contextvars.copy_context().run, _get_git_index_config, index_url)
+
+            registry['config'] = json.loads(config)
+
+    return registry['config']
+
+
+async def _get_index_checksum(source: str, name: str, version: str) -> Optional[str]:
+    'Returns the checksum of the crate version in a sparse registry index'
+    url = f"{source.split('+', 1)[-1].rstrip('/')}/{_get_index_path(name.lower())}"
+    index_file = await asyncio.wrap_future(get_scheduler().submit(url, _fetch_index_file, url))
+
+    for line in index_file.decode('utf-8').splitlines():
+        if line.strip():
+            entry = json.loads(line)
+
+            if entry['vers'] == version:
+                return entry['cksum']
+
+    return None
+
+
+async def _get_registry_package_sources(
+    package: _TomlType,
+    checksum: Optional[str],
+    registries: _RegistriesType,
+) -> Optional[Tuple[List[_FlatpakSourceType], _VendorEntryType]]:
+    name = package['name']
+    version = package['version']
+    source = package['source']
+    config = await _get_registry(source, registries)
+
+    if source.startswith('sparse+'):
+        index_checksum = await _get_index_checksum(source, name, version)
+
+        if index_checksum is None:
+            logging.warning(f'{name} {version} not found in the index of {source}')
+        elif checksum is not None and checksum != index_checksum:
+            raise ValueError(f'Checksum of {name} {version} differs from the index of {source}')
+
+        checksum = checksum or index_checksum
+
+    if checksum is None:
+        logging.warning(f'{name} doesn\'t have checksum')
+        return None
+
+    logging.info("Adding package %s from %s", name, source)
+    crate_sources = [
+        {
+            'type': 'archive',
+            'archive-type': 'tar-gzip',
+            'url': _get_download_url(config['dl'].rstrip('/'), name, version, checksum),
+            'sha256': checksum,
+            'dest': f'{CARGO_CRATES}/{name}-{version}',
+        },
+        {
+            'type': 'inline',
+            'contents': json.dumps({'package': checksum, 'files': {}}),
+            'dest': f'{CARGO_CRATES}/{name}-{version}',
+            'dest-filename': '.cargo-checksum.json',
+        },
+    ]
+    registry = source if source.startswith('sparse+') else source[len('registry+'):]
+
+    return (crate_sources, {_get_registry_name(source): {'registry': registry, 'replace-with': VENDORED_SOURCES}})
+
+
 async def _get_package_sources(
     package: _TomlType,
     cargo_lock: _TomlType,
     git_repos: _GitReposType,
+    packages_cache: Optional[_GitPackagesCacheType],
+    registries: _RegistriesType,
 ) -> Optional[Tuple[List[_FlatpakSourceType], _VendorEntryType]]:
     metadata = cargo_lock.get('metadata')
     name = package['name']
@@ -282,7 +754,7 @@ async def _get_package_sources(
     source = package['source']
 
     if source.startswith('git+'):
-        return await _get_git_package_sources(package, git_repos)
+        return await _get_git_package_sources(package, cargo_lock, git_repos, packages_cache)
 
     key = f'checksum {name} {version} ({source})'
     if metadata is not None and key in metadata:
@@ -290,6 +762,12 @@ async def _get_package_sources(
     elif 'checksum' in package:
         checksum = package['checksum']
     else:
+        checksum = None
+
+    if source not in CRATES_IO_SOURCES:
+        return await _get_registry_package_sources(package, checksum, registries)
+
+    if checksum is None:
         logging.warning(f'{name} doesn\'t have checksum')
         return None
     crate_sources = [
@@ -310,6 +788,46 @@ async def _get_package_sources(
     return (crate_sources, {'crates-io': {'replace-with': VENDORED_SOURCES}})
 
 
+async def _get_recorded_package_sources(
+    package: _TomlType,
+    cargo_lock: _TomlType,
+    git_repos: _GitReposType,
+    packages_cache: Optional[_GitPackagesCacheType],
+    registries: _RegistriesType,
+    digests: Optional[LockDigests],
+) -> Optional[Tuple[List[_FlatpakSourceType], _VendorEntryType]]:
+    if digests is None:
+        return await _get_package_sources(package, cargo_lock, git_repos, packages_cache, registries)
+
+    metadata = cargo_lock.get('metadata') or {}
+    checksum_key = f"checksum {package['name']} {package['version']} ({package.get('source')})"
+    digest = get_digest([package, metadata.get(checksum_key)])
+    recorded = digests.get(digest)
+
+    if recorded is None:
+        pkg = await _get_package_sources(package, cargo_lock, git_repos, packages_cache, registries)
+        recorded = [[], {}] if pkg is None else list(pkg)
+
+    digests.set(digest, recorded)
+
+    return recorded[0], recorded[1]
+
+
+def _get_git_repo_commits(packages: List[_TomlType]) -> Dict[str, List[str]]:
+    'Returns the commits per repo used by the git packages, in order of first use'
+    repo_commits: Dict[str, List[str]] = {}
+
+    for package in packages:
+        if package.get('source', '').startswith('git+'):
+            commits = repo_commits.setdefault(_canonical_url(package['source']).geturl(), [])
+            commit = urlparse(package['source']).fragment
+
+            if commit not in commits:
+                commits.append(commit)
+
+    return repo_commits
+
+
 def _dedupe(current: list, new: list):
     deduped = 0
 
@@ -325,11 +843,57 @@ def _dedupe(current: list, new: list):
     return deduped
 
 
-async def generate_sources(cargo_lock_paths: List[str]) -> List[_FlatpakSourceType]:
+def _get_git_source_key(source: str) -> Tuple[str, str]:
+    return (_canonical_url(source).geturl(), urlparse(source).fragment)
+
+
+def _get_checkout_root(manifest_path: str) -> str:
+    'Returns the root of the cargo git checkout holding the manifest'
+    path = os.path.dirname(os.path.abspath(manifest_path))
+
+    # Cargo marks finished checkouts with .cargo-ok
+    while not os.path.exists(os.path.join(path, '.cargo-ok')) and not os.path.exists(os.path.join(path, '.git')):
+        parent = os.path.dirname(path)
+        assert parent != path, f'{manifest_path} is not in a git checkout'
+        path = parent
+
+    return path
+
+
+def load_metadata_packages(metadata_path: str) -> _GitPackagesCacheType:
+    'Returns the packages of the git crates in the output of cargo metadata, read from the cargo git checkouts'
+    with open(metadata_path, 'r') as f:
+        metadata = json.load(f)
+
+    checkouts: Dict[str, _GitPackagesType] = {}
+    packages_cache: _GitPackagesCacheType = {}
+
+    for package in metadata['packages']:
+        if not (package.get('source') or '').startswith('git+'):
+            continue
+
+        checkout_root = _get_checkout_root(package['manifest_path'])
+
+        if checkout_root not in checkouts:
+            checkouts[checkout_root] = {}
+            _scan_git_repo(checkout_root, checkouts[checkout_root], set())
+
+        git_packages = packages_cache.setdefault(_get_git_source_key(package['source']), {})
+        git_packages[package['name']] = checkouts[checkout_root][package['name']]
+
+    return packages_cache
+
+
+async def generate_sources(
+    cargo_lock_paths: List[str],
+    packages_cache: Optional[_GitPackagesCacheType] = None,
+    digests: Optional[LockDigests] = None,
+) -> List[_FlatpakSourceType]:
     sources: List[_FlatpakSourceType] = []
     cargo_vendored_sources = {
         VENDORED_SOURCES: {'directory': f'{CARGO_CRATES}'},
     }
+    registries: _RegistriesType = {}
     deduped = 0
 
     for cargo_lock_path in cargo_lock_paths:
@@ -339,7 +903,10 @@ async def generate_sources(cargo_lock_paths: List[str]) -> List[_FlatpakSourceTy
         logging.debug(cargo_lock_path)
         cargo_lock = _load_toml(cargo_lock_path)
 
-        pkg_coros = [_get_package_sources(p, cargo_lock, git_repos) for p in cargo_lock['package']]
+        pkg_coros = [
+            _get_recorded_package_sources(p, cargo_lock, git_repos, packages_cache, registries, digests)
+            for p in cargo_lock['package']
+        ]
         for pkg in await asyncio.gather(*pkg_coros):
             if pkg is None:
                 continue
@@ -348,10 +915,12 @@ async def generate_sources(cargo_lock_paths: List[str]) -> List[_FlatpakSourceTy
             package_sources.extend(pkg_sources)
             cargo_vendored_sources.update(cargo_vendored_entry)
 
-        logging.debug('Adding collected git repos:\n%s', json.dumps(list(git_repos), indent=4))
+        # Taken from the lock, as the repos of recorded packages are not fetched
+        repo_commits = _get_git_repo_commits(cargo_lock['package'])
+        logging.debug('Adding collected git repos:\n%s', json.dumps(list(repo_commits), indent=4))
         git_repo_coros = []
-        for git_url, git_repo in git_repos.items():
-            for git_commit in git_repo['commits']:
+        for git_url, git_commits in repo_commits.items():
+            for git_commit in git_commits:
                 git_repo_coros.append(_get_git_repo_sources(git_url, git_commit))
 
         deduped += _dedupe(sources, sum(await asyncio.gather(*git_repo_coros), []))
@@ -368,16 +937,19 @@ async def generate_sources(cargo_lock_paths: List[str]) -> List[_FlatpakSourceTy
     })
 
     print(f'Deduped {deduped} cargo source entries')
+    metrics.inc('sources_deduped_total', deduped, generator='cargo')
 
     return sources
 
 
-def main():
+def main(argv: Optional[List[str]] = None):
     parser = argparse.ArgumentParser()
     parser.add_argument('cargo_lock_paths', help='Comma separated list of paths to Cargo.lock files')
     parser.add_argument('-o', '--output', required=False, help='Where to write generated sources')
     parser.add_argument('-d', '--debug', action='store_true')
-    args = parser.parse_args()
+    parser.add_argument('--incremental', action='store_true', help='Only process the packages changed since the last run for the same output')
+    parser.add_argument('--metadata', metavar='PATH', help='Read the git crates from the checkouts in the output of cargo metadata, instead of cloning')
+    args = parser.parse_args(argv)
     if args.output is not None:
         outfile = args.output
     else:
@@ -389,10 +961,17 @@ def main():
     logging.basicConfig(level=loglevel)
 
     cargo_lock_paths = str(args.cargo_lock_paths).split(',')
-    generated_sources = asyncio.run(generate_sources(cargo_lock_paths))
+    digests = LockDigests(outfile) if args.incremental else None
+
+    packages_cache = load_metadata_packages(args.metadata) if args.metadata is not None else None
+
+    generated_sources = asyncio.run(generate_sources(cargo_lock_paths, packages_cache, digests))
 
     with open(outfile, 'w') as out:
-        json.dump(generated_sources, out, indent=4, sort_keys=False)
+        dump_json_array(generated_sources, out)
+
+    if digests is not None:
+        digests.save()
 
 
 if __name__ == '__main__':
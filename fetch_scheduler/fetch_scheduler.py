@@ -0,0 +1,315 @@
+__license__ = 'MIT'
+import argparse
+import collections
+import contextlib
+import contextvars
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from metrics.metrics import get_host, metrics
+
+DEFAULT_JOBS = 8
+DEFAULT_HOST_JOBS = 4
+DEFAULT_RETRIES = 3
+BACKOFF = 1.0
+MAX_BACKOFF = 30.0
+
+TRANSIENT_GIT_ERRORS = [
+    'Could not resolve host',
+    'Connection timed out',
+    'Connection reset',
+    'Operation timed out',
+    'early EOF',
+    'RPC failed',
+    'unexpected disconnect',
+    'The requested URL returned error: 429',
+    'The requested URL returned error: 5',
+]
+
+
+class TransientError(Exception):
+    pass
+
+
+class CancelledError(Exception):
+    pass
+
+
+def is_transient(error: BaseException) -> bool:
+    if isinstance(error, TransientError):
+        return True
+    elif isinstance(error, urllib.error.HTTPError):
+        return error.code == 429 or error.code >= 500
+
+    return isinstance(error, (urllib.error.URLError, ConnectionError, TimeoutError, socket.timeout))
+
+
+def parse_jobs(value: str) -> int:
+    'Parses the value of a --jobs option, which needs at least one worker'
+    jobs = int(value)
+
+    if jobs < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive number')
+
+    return jobs
+
+
+def run_after(dependencies: List[Future], submit: Callable[[], Future]) -> Future:
+    'Calls submit once all dependencies succeeded, returning a future for the submitted or first failed operation'
+    result: Future = Future()
+    lock = threading.Lock()
+    pending = set(dependencies)
+    # Submitted from the thread finishing the last dependency, in the context of the caller
+    context = contextvars.copy_context()
+
+    def follow(future: Future):
+        error = future.exception()
+
+        if error is not None:
+            result.set_exception(error)
+        else:
+            result.set_result(future.result())
+
+    def on_done(dependency: Future):
+        with lock:
+            if result.done() or dependency not in pending:
+                return
+
+            pending.remove(dependency)
+
+            if dependency.cancelled():
+                result.cancel()
+                return
+            elif dependency.exception() is not None:
+                result.set_exception(dependency.exception())
+                return
+            elif pending:
+                return
+
+        try:
+            context.run(submit).add_done_callback(follow)
+        except Exception as e:
+            result.set_exception(e)
+
+    if not dependencies:
+        try:
+            submit().add_done_callback(follow)
+        except Exception as e:
+            result.set_exception(e)
+
+    for dependency in list(pending):
+        dependency.add_done_callback(on_done)
+
+    return result
+
+
+def run_command(options: List[str], **kwargs) -> subprocess.CompletedProcess:
+    'Runs a network command like a checked subprocess.run(), flagging failures worth a retry'
+    try:
+        return subprocess.run(options, stderr=subprocess.PIPE, check=True, **kwargs)
+    except subprocess.CalledProcessError as error:
+        stderr = error.stderr.decode('utf-8', errors='replace') if error.stderr else ''
+        sys.stderr.write(stderr)
+
+        for message in TRANSIENT_GIT_ERRORS:
+            if message in stderr:
+                raise TransientError(f'{" ".join(options)}: {message}') from error
+        raise
+
+
+class _Operation(NamedTuple):
+    url: str
+    host: str
+    cancel_on_error: bool
+    func: Callable
+    args: tuple
+    kwargs: dict
+    future: Future
+    # The context of the submitter, for the operation to use the same scheduler and metrics
+    context: contextvars.Context
+
+
+class _Host:
+    def __init__(self):
+        self.running = 0
+        self.queue: Deque[Tuple[_Operation, int]] = collections.deque()
+
+
+class Scheduler:
+    '''Runs network operations with a global and a per host concurrency limit
+
+    Operations wait in a queue per host until the host has a free slot, only
+    then they take a worker, so a busy host doesn't hold up the other hosts.
+    '''
+    def __init__(self, jobs: int = DEFAULT_JOBS, host_jobs: int = DEFAULT_HOST_JOBS, retries: int = DEFAULT_RETRIES):
+        self._executor = ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='fetch')
+        self._host_jobs = host_jobs
+        self._retries = retries
+        self._hosts: Dict[str, _Host] = {}
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+
+    def _enqueue(self, operation: _Operation, attempt: int):
+        with self._lock:
+            host = self._hosts.setdefault(operation.host, _Host())
+
+            if host.running >= self._host_jobs:
+                host.queue.append((operation, attempt))
+                return
+
+            host.running += 1
+
+        if not self._dispatch(operation, attempt):
+            self._fail(operation, self._get_shutdown_error(operation))
+
+    def _release(self, operation: _Operation):
+        'Hands the slot of the host to its next queued operation'
+        while True:
+            with self._lock:
+                host = self._hosts[operation.host]
+
+                if not host.queue:
+                    host.running -= 1
+                    return
+
+                operation, attempt = host.queue.popleft()
+
+            if self._dispatch(operation, attempt):
+                return
+
+            self._set_exception(operation, self._get_shutdown_error(operation))
+
+    def _dispatch(self, operation: _Operation, attempt: int) -> bool:
+        'Returns False when the executor is shut down'
+        try:
+            self._executor.submit(operation.context.run, self._run, operation, attempt)
+        except RuntimeError:
+            return False
+
+        return True
+
+    def _get_shutdown_error(self, operation: _Operation) -> CancelledError:
+        return CancelledError(f'Not fetching {operation.url}, the scheduler is shut down')
+
+    def _set_exception(self, operation: _Operation, error: BaseException):
+        if not operation.future.cancelled():
+            operation.future.set_exception(error)
+
+    def _fail(self, operation: _Operation, error: BaseException):
+        self._release(operation)
+        self._set_exception(operation, error)
+
+    def _retry_later(self, operation: _Operation, attempt: int, delay: float):
+        def retry():
+            # Woken up early on cancellation, to fail right away
+            self._cancelled.wait(delay)
+            self._enqueue(operation, attempt)
+
+        threading.Thread(target=retry, name='fetch-retry', daemon=True).start()
+
+    def _run(self, operation: _Operation, attempt: int):
+        url = operation.url
+
+        if self._cancelled.is_set():
+            self._fail(operation, CancelledError(f'Not fetching {url}, cancelled by an earlier error'))
+            return
+
+        if attempt == 0 and not operation.future.set_running_or_notify_cancel():
+            self._release(operation)
+            return
+
+        start = time.perf_counter()
+        try:
+            result = operation.func(*operation.args, **operation.kwargs)
+        except Exception as e:
+            if attempt == self._retries or not is_transient(e):
+                if operation.cancel_on_error:
+                    self._cancelled.set()
+                self._fail(operation, e)
+                return
+            error = e
+        else:
+            self._release(operation)
+            operation.future.set_result(result)
+            return
+        finally:
+            metrics.observe('fetch_duration_seconds', time.perf_counter() - start, host=operation.host)
+
+        metrics.inc('fetch_retries_total', host=operation.host)
+
+        # Exponential backoff with jitter, to not retry in lockstep
+        delay = min(MAX_BACKOFF, BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.5)
+        print(f'Retrying {url} in {delay:.1f}s: {error}')
+        # The slot and the worker are free for other operations during the backoff
+        self._release(operation)
+        self._retry_later(operation, attempt + 1, delay)
+
+    def submit(self, url: str, func: Callable, *args, cancel_on_error: bool = True, **kwargs) -> Future:
+        future: Future = Future()
+        operation = _Operation(url, get_host(url), cancel_on_error, func, args, kwargs, future, contextvars.copy_context())
+        self._enqueue(operation, 0)
+
+        return future
+
+    def submit_after(
+        self, dependencies: List[Future], url: str, func: Callable, *args, cancel_on_error: bool = True, **kwargs,
+    ) -> Future:
+        'Submits the operation once the dependencies succeeded'
+        return run_after(dependencies, lambda: self.submit(url, func, *args, cancel_on_error=cancel_on_error, **kwargs))
+
+    def run(self, url: str, func: Callable, *args, cancel_on_error: bool = True, **kwargs) -> Any:
+        return self.submit(url, func, *args, cancel_on_error=cancel_on_error, **kwargs).result()
+
+    def cancel(self):
+        'Cancels the operations that have not started yet, after a failure outside of the scheduler'
+        self._cancelled.set()
+
+    def shutdown(self):
+        self._cancelled.set()
+        self._executor.shutdown(wait=False)
+
+
+_scheduler: Optional[Scheduler] = None
+# The scheduler of the current run, instead of the shared one
+_current_scheduler: 'contextvars.ContextVar[Optional[Scheduler]]' = contextvars.ContextVar('scheduler', default=None)
+
+
+def configure(jobs: int = DEFAULT_JOBS, host_jobs: int = DEFAULT_HOST_JOBS, retries: int = DEFAULT_RETRIES) -> Scheduler:
+    'Replaces the shared scheduler, clearing an earlier cancellation'
+    global _scheduler
+
+    if _scheduler is not None:
+        _scheduler.shutdown()
+
+    _scheduler = Scheduler(jobs, host_jobs, retries)
+
+    return _scheduler
+
+
+@contextlib.contextmanager
+def use_scheduler(scheduler: Scheduler) -> Iterator[Scheduler]:
+    'Makes get_scheduler() return scheduler in this context, e.g. for one of several runs in threads'
+    token = _current_scheduler.set(scheduler)
+
+    try:
+        yield scheduler
+    finally:
+        _current_scheduler.reset(token)
+
+
+def get_scheduler() -> Scheduler:
+    scheduler = _current_scheduler.get()
+
+    if scheduler is not None:
+        return scheduler
+    elif _scheduler is None:
+        return configure()
+
+    return _scheduler
@@ -4,36 +4,102 @@ __license__ = 'MIT'
 import subprocess
 import shutil
 import argparse
+import codecs
+import contextlib
+import io
+import itertools
 import os
 import sys
-import yaml
 import json
+import socket
+import socketserver
+import threading
 import urllib.parse
 import urllib.request
 import asyncio
 
-from typing import Optional
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
 from pathlib import Path
-from flutter_sdk_generator.flutter_sdk_generator import generate_sdk
+from flutter_sdk_generator.flutter_sdk_generator import complete_sdk, generate_sdk, get_host_arch, is_partial
 from flutter_app_fetcher.flutter_app_fetcher import fetch_flutter_app
+from manifest_fetcher.manifest_fetcher import fetch_manifest
+from fetch_scheduler.fetch_scheduler import DEFAULT_HOST_JOBS, DEFAULT_JOBS, Scheduler, get_scheduler, parse_jobs, run_command, use_scheduler
 from pubspec_generator.pubspec_generator import PUB_CACHE
-from cargo_generator.cargo_generator import generate_sources as generate_cargo_sources
-from pubspec_generator.pubspec_generator import generate_sources as generate_pubspec_sources
+from cargo_generator.cargo_generator import generate_sources as generate_cargo_sources, load_metadata_packages
+from pubspec_generator.pubspec_generator import dedupe_sources as dedupe_pubspec_sources
+from pubspec_generator.pubspec_generator import iter_package_sources as iter_pubspec_package_sources
+from pubspec_generator.pubspec_generator import get_workspace_members, get_workspace_root
+from flutter_tools_generator.flutter_tools_generator import has_flutter_tools, load_flutter_tools
+from lock_digests.lock_digests import LockDigests
+from rustup_generator.rustup_generator import get_rustup
+from source_verifier.source_verifier import main as verify_sources_main
+from manifest_io.manifest_io import dump_json, dump_json_array, dump_yaml, load_yaml
+from metrics.metrics import Metrics, metrics, use_metrics
 
 RUST_VERSION = '1.83.0'
 
 __version__ = '0.6.0'
-build_path = '.flatpak-builder/build'
+BUILD_PATH = '.flatpak-builder/build'
 sandbox_root = '/run/build'
+# Environment variables of the client applied to daemon jobs, instead of the ones of the daemon
+FORWARDED_ENV = [
+    'FLUTTER_SDK_RELEASES',
+    'FLUTTER_STORAGE_BASE_URL',
+    'PUB_HOSTED_URL',
+    'RUSTUP_DIST_SERVER',
+    'XDG_CACHE_HOME',
+]
+# Like GIT_CONFIG_GLOBAL and GIT_CONFIG_COUNT with its GIT_CONFIG_KEY_<n> and GIT_CONFIG_VALUE_<n>
+FORWARDED_ENV_PREFIX = 'GIT_CONFIG'
 
+# The contents per output path, sources and modules are written as JSON
+_OutputsType = Dict[str, Any]
 
-class Dumper(yaml.Dumper):
-    def increase_indent(self, flow=False, *args, **kwargs):
-        return super().increase_indent(flow=flow, indentless=False)
 
+def _is_forwarded(name: str) -> bool:
+    return name in FORWARDED_ENV or name.startswith(FORWARDED_ENV_PREFIX)
 
-def _get_manifest_from_git(manifest: str, from_git: str, from_git_branch: str):
+
+def _get_forwarded_env(environ: Mapping[str, str]) -> Dict[str, str]:
+    return {name: value for name, value in environ.items() if _is_forwarded(name)}
+
+
+@contextlib.contextmanager
+def _use_forwarded_env(env: Mapping[str, str]) -> Iterator[None]:
+    'Replaces the forwarded variables of this process by the ones in env, while running a job'
+    saved = dict(os.environ)
+
+    for name in _get_forwarded_env(os.environ):
+        del os.environ[name]
+
+    os.environ.update(_get_forwarded_env(env))
+
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+def _get_releases_path(environ: Mapping[str, str], work_dir: str = '.') -> str:
+    'Returns the releases dir set in environ, relative to work_dir, or the one next to this script'
+    if 'FLUTTER_SDK_RELEASES' in environ:
+        return os.path.join(work_dir, environ['FLUTTER_SDK_RELEASES'])
+
+    return f'{os.path.dirname(os.path.abspath(__file__))}/releases'
+
+
+def _get_build_path(work_dir: str) -> str:
+    return os.path.join(work_dir, BUILD_PATH)
+
+
+def _get_manifest_from_git(manifest: str, from_git: str, from_git_branch: str, work_dir: str = '.'):
     manifest_name = Path(manifest).name
+    build_path = _get_build_path(work_dir)
+
+    if fetch_manifest(manifest, from_git, from_git_branch, os.path.join(work_dir, manifest_name)):
+        return
+
     options = [
         'git',
         'clone',
@@ -56,10 +122,10 @@ def _get_manifest_from_git(manifest: str, from_git: str, from_git_branch: str):
     if os.path.isfile(manifest_path):
         return_code = 0
     else:
-        return_code = subprocess.run(options, stdout=subprocess.PIPE, check=True).returncode
+        return_code = get_scheduler().run(from_git, run_command, options, stdout=subprocess.PIPE).returncode
 
     if return_code == 0:
-        shutil.copyfile(manifest_path, manifest_name)
+        shutil.copyfile(manifest_path, os.path.join(work_dir, manifest_name))
         shutil.rmtree(f'{build_path}/{manifest_name}')
 
 
@@ -69,153 +135,609 @@ def _fetch_flutter_app(
     releases_path: str,
     app_pubspec: str,
     source: Optional[str]=None,
-    rust_version: Optional[str]=None
-):
-    with open(manifest_path, 'r') as input_stream:
+    rust_version: Optional[str]=None,
+    shared_path: Optional[str]=None,
+    git_mirrors_path: Optional[str]=None,
+    sparse_dirs: Optional[List[str]]=None,
+    work_dir: str='.',
+) -> Tuple[str, Optional[str], int, _OutputsType]:
+    with open(os.path.join(work_dir, manifest_path), 'r') as input_stream:
         suffix = (Path(manifest_path).suffix)
 
         if suffix == '.yml' or  suffix == '.yaml':
-            manifest = yaml.full_load(input_stream)
+            manifest = load_yaml(input_stream)
         else:
             manifest = json.load(input_stream)
 
         releases_path += '/flutter'
-        app_id, tag, build_id = fetch_flutter_app(manifest, app_module, build_path, releases_path, app_pubspec, rust_version)
-
-        # Write converted manifest to file
-        with open(f'{app_id}{suffix}', 'w') as output_stream:
-            if suffix == '.json':
-                json.dump(manifest, output_stream, indent=4, sort_keys=False)
-            else:
-                source = source if source is not None else manifest_path
-                prepend = f'''# Generated from {source}, do not edit
+        shared_module_path = None if shared_path is None else os.path.relpath(shared_path, work_dir)
+        app_id, tag, build_id = fetch_flutter_app(
+            manifest, app_module, _get_build_path(work_dir), releases_path, app_pubspec, rust_version,
+            shared_module_path, git_mirrors_path, sparse_dirs, work_dir,
+        )
+
+        # The converted manifest
+        if suffix == '.json':
+            converted: Any = manifest
+        else:
+            source = source if source is not None else manifest_path
+            output_stream = io.StringIO()
+            output_stream.write(f'''# Generated from {source}, do not edit
 # Visit the flatpak-flutter project at https://github.com/TheAppgineer/flatpak-flutter
-'''
-                output_stream.write(prepend)
-                yaml.dump(data=manifest, stream=output_stream, indent=2, sort_keys=False, Dumper=Dumper)
+''')
+            dump_yaml(manifest, output_stream)
+            converted = output_stream.getvalue()
 
         app = app_module if app_module is not None else app_id.split('.')[-1]
 
-        return app, tag, build_id
+        return app, tag, build_id, {os.path.join(work_dir, f'{app_id}{suffix}'): converted}
 
 
 def _create_pub_cache(build_path_app: str, pubspec_path = None):
     full_pubspec_path = build_path_app if pubspec_path is None else f'{build_path_app}/{pubspec_path}'
-    pub_cache = f'{os.getcwd()}/{build_path_app}/.{PUB_CACHE}'
+    pub_cache = os.path.abspath(f'{build_path_app}/.{PUB_CACHE}')
     flutter = 'flutter/bin/flutter'
     options = f'PUB_CACHE={pub_cache} {build_path_app}/{flutter} pub get -C {full_pubspec_path}'
 
     subprocess.run([options], stdout=subprocess.PIPE, shell=True, check=True)
 
 
-def _generate_pubspec_sources(app: str, app_pubspec:str, extra_pubspecs: str, build_id: int):
+def _get_output_path(name: str, shared_path: Optional[str], work_dir: str = '.') -> str:
+    return os.path.join(work_dir, name) if shared_path is None else f'{shared_path}/{name}'
+
+
+def _read_file(path: str) -> str:
+    with open(path, 'r') as input:
+        return input.read()
+
+
+def _write_file(path: str, contents: Any):
+    'Writes sources and modules as JSON, other contents as is'
+    # Replace atomically, other apps might be reading the same shared file,
+    # the temporary name is unique per process and thread writing it
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    with open(tmp_path, 'w') as out:
+        if isinstance(contents, str):
+            out.write(contents)
+        elif isinstance(contents, list):
+            dump_json_array(contents, out)
+            out.write('\n')
+        else:
+            dump_json(contents, out)
+
+    os.replace(tmp_path, path)
+
+
+def write_outputs(outputs: _OutputsType):
+    'Writes the outputs returned by generate()'
+    for path, contents in outputs.items():
+        _write_file(path, contents)
+
+
+def _count_sources(sources: Iterable[dict], file: str) -> Iterator[dict]:
+    for source in sources:
+        metrics.inc('sources_emitted_total', file=file, type=source.get('type', 'unknown'))
+        yield source
+
+
+def _count_module_sources(module: dict, file: str):
+    for source in module.get('sources', []):
+        if isinstance(source, dict):
+            metrics.inc('sources_emitted_total', file=file, type=source.get('type', 'unknown'))
+
+    for child in module.get('modules', []):
+        if isinstance(child, dict):
+            _count_module_sources(child, file)
+
+
+def _generate_pubspec_sources(
+    app: str,
+    app_pubspec:str,
+    extra_pubspecs: str,
+    build_id: int,
+    tag: str,
+    releases: str,
+    shared_path: Optional[str] = None,
+    incremental: bool = False,
+    work_dir: str = '.',
+) -> _OutputsType:
+    build_path = _get_build_path(work_dir)
     flutter_tools = 'flutter/packages/flutter_tools'
-    pubspec_paths = [
-        f'{build_path}/{app}/{app_pubspec}/pubspec.lock',
-        f'{build_path}/{app}/{flutter_tools}/pubspec.lock',
+    flutter_tools_lock = f'{build_path}/{app}/{flutter_tools}/pubspec.lock'
+    app_pubspec_dir = os.path.normpath(f'{build_path}/{app}/{app_pubspec}')
+    # Packages in a pub workspace share the lock of the workspace root
+    workspace_root = get_workspace_root(app_pubspec_dir)
+    workspace_members = set()
+
+    if workspace_root is not None:
+        # Compared by real path, the build path can be relative or a symlink
+        workspace_members = set(
+            os.path.realpath(member) for member in [workspace_root] + get_workspace_members(workspace_root)
+        )
+        print(f'Using the lock of the pub workspace at {workspace_root}, with {len(workspace_members)} packages')
+        app_pubspec_dir = workspace_root
+
+    app_pubspec_paths = [
+        f'{app_pubspec_dir}/pubspec.lock',
     ]
+    extra_pubspec_paths = []
+    seen = set()
+    outputs: _OutputsType = {}
+    pubspec_sources_path = os.path.join(work_dir, 'pubspec-sources.json')
+    digests = LockDigests(pubspec_sources_path) if incremental else None
+    # The flutter_tools dependencies are equal for all apps using this Flutter version
+    prebuilt = load_flutter_tools(f'{releases}/flutter/{tag}', f'{sandbox_root}/{app}')
+
+    if prebuilt is not None:
+        print(f'Using prebuilt flutter_tools sources of {tag}')
+        flutter_tools_sources = prebuilt[0]
+    else:
+        flutter_tools_sources = iter_pubspec_package_sources([flutter_tools_lock], seen, digests)
+
+    if shared_path is not None:
+        outputs[f'{shared_path}/pubspec-sources-flutter-{tag}.json'] = list(_count_sources(
+            dedupe_pubspec_sources(flutter_tools_sources, seen), f'pubspec-sources-flutter-{tag}.json',
+        ))
+        flutter_tools_sources = []
 
     if extra_pubspecs:
         paths = extra_pubspecs.split(',')
         for path in paths:
-            pubspec_paths.append(f'{build_path}/{app}/{path}/pubspec.lock')
+            extra_pubspec_dir = os.path.normpath(f'{build_path}/{app}/{path}')
 
-    pubspec_sources = generate_pubspec_sources(pubspec_paths)
-    pubspec_sources.append({
+            if os.path.realpath(extra_pubspec_dir) in workspace_members:
+                print(f'Skipping {path}, its lock is the one of the workspace')
+                continue
+
+            extra_pubspec_paths.append(f'{extra_pubspec_dir}/pubspec.lock')
+
+    package_sources = itertools.chain(
+        iter_pubspec_package_sources(app_pubspec_paths, seen, digests),
+        flutter_tools_sources,
+        iter_pubspec_package_sources(extra_pubspec_paths, seen, digests),
+    )
+    pubspec_sources = itertools.chain(dedupe_pubspec_sources(package_sources, seen), [{
         'type': 'file',
         'path': 'package_config.json',
         'dest': f'{flutter_tools}/.dart_tool',
-    })
+    }])
+    outputs[pubspec_sources_path] = list(_count_sources(pubspec_sources, 'pubspec-sources.json'))
+
+    if digests is not None:
+        digests.save()
+
+    if prebuilt is not None:
+        package_config = prebuilt[1]
+    else:
+        abs_path = str(Path(f'{build_path}/{app}').absolute())
+        package_config = ''
 
-    with open('pubspec-sources.json', 'w') as out:
-        json.dump(pubspec_sources, out, indent=4, sort_keys=False)
-        out.write('\n')
+        with open(f'{build_path}/{app}/{flutter_tools}/.dart_tool/package_config.json', 'r') as input:
+            for line in input.readlines():
+                package_config += line.replace(f'{app}-{build_id}', app).replace(abs_path, f'{sandbox_root}/{app}')
 
-    abs_path = str(Path(f'{build_path}/{app}').absolute())
-    package_config = ''
+    outputs[os.path.join(work_dir, 'package_config.json')] = package_config
 
-    with open(f'{build_path}/{app}/{flutter_tools}/.dart_tool/package_config.json', 'r') as input:
-        for line in input.readlines():
-            package_config += line.replace(f'{app}-{build_id}', app).replace(abs_path, f'{sandbox_root}/{app}')
+    return outputs
 
-    with open('package_config.json', 'w') as out:
-        out.write(package_config)
 
+def _generate_cargo_sources(
+    app: str,
+    cargo_locks: str,
+    releases: str,
+    rust_version: str,
+    packages_cache: Optional[dict] = None,
+    shared_path: Optional[str] = None,
+    incremental: bool = False,
+    work_dir: str = '.',
+    cargo_metadata: Optional[str] = None,
+) -> _OutputsType:
+    build_path = _get_build_path(work_dir)
+    outputs: _OutputsType = {}
 
-def _generate_cargo_sources(app: str, cargo_locks: str, releases: str):
     if cargo_locks:
         cargo_paths = []
+
+        if cargo_metadata is not None:
+            # The git crates already fetched by cargo are read from its checkouts, instead of cloning their repos
+            packages_cache = load_metadata_packages(cargo_metadata)
+
         paths = cargo_locks.split(',')
 
         for path in paths:
             cargo_paths.append(f'{build_path}/{app}/{path}/Cargo.lock')
 
-        cargo_sources = asyncio.run(generate_cargo_sources(cargo_paths))
+        cargo_sources_path = os.path.join(work_dir, 'cargo-sources.json')
+        digests = LockDigests(cargo_sources_path) if incremental else None
+        cargo_sources = asyncio.run(generate_cargo_sources(cargo_paths, packages_cache, digests))
+        outputs[cargo_sources_path] = list(_count_sources(cargo_sources, 'cargo-sources.json'))
 
-        with open('cargo-sources.json', 'w') as out:
-            json.dump(cargo_sources, out, indent=4, sort_keys=False)
-            out.write('\n')
+        if digests is not None:
+            digests.save()
+
+        rustup_path = _get_output_path(f'rustup-{rust_version}.json', shared_path, work_dir)
 
-        shutil.copyfile(f'{releases}/rust/{RUST_VERSION}/rustup.json', f'rustup-{RUST_VERSION}.json')
+        if os.path.isfile(f'{releases}/rust/{rust_version}/rustup.json'):
+            outputs[rustup_path] = _read_file(f'{releases}/rust/{rust_version}/rustup.json')
+        else:
+            outputs[rustup_path] = get_rustup(rust_version)
 
+    return outputs
 
-def _get_sdk_module(app: str, tag: str, releases: str):
-    shutil.copyfile(f'{releases}/flutter/flutter-shared.sh.patch', 'flutter-shared.sh.patch')
 
-    if os.path.isfile(f'{releases}/flutter/{tag}/flutter-sdk.json'):
-        shutil.copyfile(f'{releases}/flutter/{tag}/flutter-sdk.json', f'flutter-sdk-{tag}.json')
-    else:
-        generated_sdk = generate_sdk(f'{build_path}/{app}/flutter')
+def _get_sdk_origin(
+    tag: str,
+    releases: str,
+    shared_path: Optional[str] = None,
+    host_arch_only: bool = False,
+    work_dir: str = '.',
+) -> Tuple[str, str, Optional[Any]]:
+    '''Returns the path of the SDK module, where it comes from and the module found there
 
-        with open(f'flutter-sdk-{tag}.json', 'w') as out:
-            json.dump(generated_sdk, out, indent=4, sort_keys=False)
+    The module comes from the release dir, by completing or using an existing
+    one, or is generated from the Flutter checkout, which needs flutter to have
+    run for its version file.
+    '''
+    sdk_path = _get_output_path(f'flutter-sdk-{tag}.json', shared_path, work_dir)
+    existing_sdk = None
 
+    if os.path.isfile(sdk_path):
+        with open(sdk_path, 'r') as input:
+            existing_sdk = json.load(input)
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('MANIFEST', help='Path to the manifest')
+    if os.path.isfile(f'{releases}/flutter/{tag}/flutter-sdk.json'):
+        return sdk_path, 'release', existing_sdk
+    elif existing_sdk is not None and is_partial(existing_sdk) and not host_arch_only:
+        return sdk_path, 'complete', existing_sdk
+    elif shared_path is not None and existing_sdk is not None:
+        return sdk_path, 'shared', existing_sdk
+
+    return sdk_path, 'generate', existing_sdk
+
+
+def _get_sdk_module(
+    app: str,
+    tag: str,
+    releases: str,
+    sha256_cache: Optional[dict] = None,
+    shared_path: Optional[str] = None,
+    downloads_path: Optional[str] = None,
+    host_arch_only: bool = False,
+    work_dir: str = '.',
+) -> _OutputsType:
+    sdk_path, origin, existing_sdk = _get_sdk_origin(tag, releases, shared_path, host_arch_only, work_dir)
+    outputs: _OutputsType = {
+        _get_output_path('flutter-shared.sh.patch', shared_path, work_dir):
+            _read_file(f'{releases}/flutter/flutter-shared.sh.patch'),
+    }
+
+    if origin == 'release':
+        outputs[sdk_path] = _read_file(f'{releases}/flutter/{tag}/flutter-sdk.json')
+        sdk = json.loads(outputs[sdk_path])
+    elif origin == 'complete':
+        # Only the artifacts of the arches left out before need to be hashed
+        print(f'Completing {sdk_path}')
+        sdk = outputs[sdk_path] = complete_sdk(existing_sdk, sha256_cache, downloads_path)
+    elif origin == 'shared':
+        print(f'Using shared {sdk_path}')
+        sdk = existing_sdk
+    else:
+        arches = [get_host_arch()] if host_arch_only else None
+        sdk = outputs[sdk_path] = generate_sdk(
+            f'{_get_build_path(work_dir)}/{app}/flutter', sha256_cache, downloads_path, arches,
+        )
+
+    _count_module_sources(sdk, Path(sdk_path).name)
+
+    return outputs
+
+
+class _JobWriter(io.TextIOBase):
+    'Streams everything written to it as log messages to the client'
+    def __init__(self, wfile):
+        self._wfile = wfile
+        self._lock = threading.Lock()
+
+    def write(self, data: str) -> int:
+        if data:
+            # Also written to by the thread forwarding the output of child processes
+            with self._lock:
+                _send_message(self._wfile, {'type': 'log', 'data': data})
+
+        return len(data)
+
+
+@contextlib.contextmanager
+def _forward_output(writer: io.TextIOBase) -> Iterator[None]:
+    'Forwards everything written to stdout and stderr by file descriptor, like by child processes, to writer'
+    read_fd, write_fd = os.pipe()
+    saved_fds = [os.dup(1), os.dup(2)]
+
+    def forward():
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+        for data in iter(lambda: os.read(read_fd, 65536), b''):
+            writer.write(decoder.decode(data))
+
+        writer.write(decoder.decode(b'', final=True))
+        os.close(read_fd)
+
+    sys.__stdout__.flush()
+    sys.__stderr__.flush()
+    os.dup2(write_fd, 1)
+    os.dup2(write_fd, 2)
+    os.close(write_fd)
+    forwarder = threading.Thread(target=forward, name='forward-output')
+    forwarder.start()
+
+    try:
+        yield
+    finally:
+        # The forwarder stops at the end of the pipe, once the last write end is closed
+        for fd, saved_fd in enumerate(saved_fds, start=1):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+
+        forwarder.join()
+
+
+def _send_message(wfile, message: Dict[str, Any]):
+    wfile.write(f'{json.dumps(message)}\n'.encode('utf-8'))
+    wfile.flush()
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        job = json.loads(self.rfile.readline())
+        writer = _JobWriter(self.wfile)
+        work_dir = job['cwd']
+        env = job.get('env', {})
+        exit_code = 0
+        outputs: List[str] = []
+
+        try:
+            # Jobs run one at a time, so the output of child processes and the environment are the ones of this job
+            with contextlib.redirect_stdout(writer), contextlib.redirect_stderr(writer), _forward_output(writer), \
+                    _use_forwarded_env(env):
+                try:
+                    parser = _create_parser()
+                    args = parser.parse_args(job['argv'])
+
+                    if args.serve is not None:
+                        parser.error('--serve can not be used for a job')
+                    if args.MANIFEST is None:
+                        parser.error('the following arguments are required: MANIFEST')
+
+                    written = _run(args, self.server.caches, work_dir, _get_releases_path(env, work_dir))
+                    outputs = sorted(os.path.relpath(path, work_dir) for path in written)
+                except SystemExit as e:
+                    exit_code = e.code if isinstance(e.code, int) else 1
+                except Exception as e:
+                    print(f'Error: {e}')
+                    exit_code = 1
+
+            _send_message(self.wfile, {'type': 'result', 'exit-code': exit_code, 'outputs': outputs})
+        except BrokenPipeError:
+            pass
+
+
+class _JobServer(socketserver.UnixStreamServer):
+    # Jobs run one at a time, as their output is redirected to the client
+    def __init__(self, socket_path: str):
+        super().__init__(socket_path, _JobHandler)
+        self.caches: Dict[str, dict] = {
+            'git-packages': {},
+            'sha256': {},
+        }
+
+
+def _serve(socket_path: str):
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    with _JobServer(socket_path) as server:
+        print(f'Waiting for jobs on {socket_path}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
+
+
+def _submit_job(socket_path: str, argv: List[str]) -> int:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        env = _get_forwarded_env(os.environ)
+        sock.sendall(f"{json.dumps({'argv': argv, 'cwd': os.getcwd(), 'env': env})}\n".encode('utf-8'))
+
+        for line in sock.makefile('r', encoding='utf-8'):
+            message = json.loads(line)
+
+            if message['type'] == 'log':
+                sys.stdout.write(message['data'])
+                sys.stdout.flush()
+            elif message['type'] == 'result':
+                for output in message['outputs']:
+                    print(f'Written: {output}')
+
+                return message['exit-code']
+
+    print('Error: Connection to daemon closed before job finished')
+
+    return 1
+
+
+def _create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(epilog='Run "%(prog)s verify --help" to check generated manifests against upstream')
+    parser.add_argument('MANIFEST', nargs='?', help='Path to the manifest')
     parser.add_argument('-V', '--version', action='version', version=f'%(prog)s-{__version__}')
     parser.add_argument('--app-module', metavar='NAME', help='Name of the app module in the manifest')
     parser.add_argument('--app-pubspec', metavar='PATH', help='Path to the app pubspec')
     parser.add_argument('--extra-pubspecs', metavar='PATHS', help='Comma separated list of extra pubspec paths')
     parser.add_argument('--cargo-locks', metavar='PATHS', help='Comma separated list of Cargo.lock paths')
+    parser.add_argument('--rust-version', metavar='VERSION', default=RUST_VERSION, help='Rust toolchain to use with --cargo-locks')
+    parser.add_argument('--cargo-metadata', metavar='PATH', help='Output of cargo metadata, to read the git crates of --cargo-locks from the cargo git checkouts')
     parser.add_argument('--from-git', metavar='URL', required=False, help='Get input files from git repo')
     parser.add_argument('--from-git-branch', metavar='BRANCH', required=False, help='Branch to use in --from-git')
+    parser.add_argument('--incremental', action='store_true', help='Only process the lock entries changed since the last run')
     parser.add_argument('--keep-build-dirs', action='store_true', help="Don't remove build directories after processing")
-
-    args = parser.parse_args()
+    parser.add_argument('--keep-downloads', action='store_true', help='Keep downloaded SDK artifacts in the flatpak-builder downloads cache')
+    parser.add_argument('--host-arch-only', action='store_true', help='Only hash the SDK artifacts for the host arch, a later run without it completes the module')
+    parser.add_argument('--partial-clone', action='store_true', help='Clone the app repo without blobs, only checking out the files needed')
+    parser.add_argument('--seed-git-mirrors', action='store_true', help='Add the cloned git repos to the flatpak-builder git mirrors')
+    parser.add_argument('-j', '--jobs', metavar='N', type=parse_jobs, default=DEFAULT_JOBS, help='Maximum number of parallel downloads')
+    parser.add_argument('--shared-modules', metavar='PATH', required=False, help='Directory for modules and sources shared between apps')
+    parser.add_argument('--metrics', metavar='DIR', required=False, help='Write Prometheus and JSON metrics of the run to DIR')
+    parser.add_argument('--serve', metavar='SOCKET', required=False, help='Run as daemon, processing jobs received on SOCKET')
+    parser.add_argument('--daemon', metavar='SOCKET', required=False, help='Submit the job to the daemon listening on SOCKET, with the mirror, cache dir and git config variables of this environment')
+
+    return parser
+
+
+def generate(
+    args: argparse.Namespace,
+    caches: Optional[Dict[str, dict]] = None,
+    work_dir: str = '.',
+    scheduler: Optional[Scheduler] = None,
+    run_metrics: Optional[Metrics] = None,
+    releases_path: Optional[str] = None,
+) -> _OutputsType:
+    '''Generates the manifest, sources and modules of the app in work_dir, like running in that directory
+
+    Returns the contents to write per output path, see write_outputs(). The network operations go
+    through scheduler and the metrics are recorded in run_metrics, both created for the run when not
+    given. Neither the working directory nor shared state is changed, so runs for several apps can
+    use threads.
+    '''
+    own_scheduler = scheduler is None
+    scheduler = scheduler if scheduler is not None else Scheduler(args.jobs, min(args.jobs, DEFAULT_HOST_JOBS))
+    run_metrics = run_metrics if run_metrics is not None else Metrics()
+
+    try:
+        with use_scheduler(scheduler), use_metrics(run_metrics), run_metrics.stage('total'):
+            return _generate(args, caches, work_dir, releases_path or _get_releases_path(os.environ, work_dir))
+    finally:
+        if own_scheduler:
+            scheduler.shutdown()
+
+
+def _run(
+    args: argparse.Namespace,
+    caches: Optional[Dict[str, dict]] = None,
+    work_dir: str = '.',
+    releases_path: Optional[str] = None,
+) -> List[str]:
+    'Generates and writes the outputs, returning their paths'
+    run_metrics = Metrics()
+
+    try:
+        outputs = generate(args, caches, work_dir, run_metrics=run_metrics, releases_path=releases_path)
+        write_outputs(outputs)
+
+        return list(outputs)
+    finally:
+        if args.metrics is not None:
+            run_metrics.write(os.path.join(work_dir, args.metrics))
+
+
+def _generate(
+    args: argparse.Namespace,
+    caches: Optional[Dict[str, dict]],
+    work_dir: str,
+    releases_path: str,
+) -> _OutputsType:
     manifest_path = args.MANIFEST
+    build_path = _get_build_path(work_dir)
     raw_url = None
 
-    if 'FLUTTER_SDK_RELEASES' in os.environ:
-        releases_path = os.environ['FLUTTER_SDK_RELEASES']
-    else:
-        releases_path = f'{str(Path(sys.argv[0]).parent)}/releases'
-
     if args.from_git:
         url = urllib.parse.urlparse(args.from_git)
         manifest_path = Path(manifest_path).name
 
-        if url.hostname == 'github.com' and args.from_git_branch is not None:
-            path = str(url.path).split('.git')[0]
-            raw_url = f'https://raw.githubusercontent.com{path}/{args.from_git_branch}/{args.MANIFEST}'
-            urllib.request.urlretrieve(raw_url, manifest_path)
-        else:
-            _get_manifest_from_git(args.MANIFEST, args.from_git, args.from_git_branch)
+        with metrics.stage('fetch-manifest'):
+            if url.hostname == 'github.com' and args.from_git_branch is not None:
+                path = str(url.path).split('.git')[0]
+                raw_url = f'https://raw.githubusercontent.com{path}/{args.from_git_branch}/{args.MANIFEST}'
+                get_scheduler().run(raw_url, urllib.request.urlretrieve, raw_url, os.path.join(work_dir, manifest_path))
+            else:
+                _get_manifest_from_git(args.MANIFEST, args.from_git, args.from_git_branch, work_dir)
 
     app_pubspec = '.' if args.app_pubspec is None else args.app_pubspec
-    rust_version = None if args.cargo_locks is None else RUST_VERSION
-    app, tag, build_id = _fetch_flutter_app(manifest_path, args.app_module, releases_path, app_pubspec, raw_url, rust_version)
+    rust_version = None if args.cargo_locks is None else args.rust_version
+    shared_path = None if args.shared_modules is None else os.path.join(work_dir, args.shared_modules)
+
+    git_mirrors_path = f'{Path(build_path).parent}/git' if args.seed_git_mirrors else None
+    sparse_dirs = None
+
+    if args.partial_clone:
+        sparse_dirs = [app_pubspec]
+        sparse_dirs += args.extra_pubspecs.split(',') if args.extra_pubspecs else []
+        sparse_dirs += args.cargo_locks.split(',') if args.cargo_locks else []
+
+    with metrics.stage('fetch-app'):
+        app, tag, build_id, outputs = _fetch_flutter_app(
+            manifest_path, args.app_module, releases_path, app_pubspec, raw_url, rust_version, shared_path,
+            git_mirrors_path, sparse_dirs, work_dir,
+        )
+    caches = caches if caches is not None else {}
 
     if tag is not None:
-        _create_pub_cache(f'{build_path}/{app}', args.app_pubspec)
-        _generate_pubspec_sources(app, app_pubspec, args.extra_pubspecs, build_id)
-        _generate_cargo_sources(app, args.cargo_locks, releases_path)
-        _get_sdk_module(app, tag, releases_path)
+        app_pubspec_dir = os.path.normpath(f'{build_path}/{app}/{app_pubspec}')
+        app_lock = f'{get_workspace_root(app_pubspec_dir) or app_pubspec_dir}/pubspec.lock'
+
+        # Running flutter is only needed for the package config of flutter_tools, a lock for the app,
+        # and the version file of the checkout an SDK module is generated from
+        sdk_origin = _get_sdk_origin(tag, releases_path, shared_path, args.host_arch_only, work_dir)[1]
+
+        if has_flutter_tools(f'{releases_path}/flutter/{tag}') and os.path.isfile(app_lock) and sdk_origin != 'generate':
+            print(f'Skipping pub get, using the prebuilt flutter_tools of {tag} and the lock of the app')
+        else:
+            with metrics.stage('pub-get'):
+                _create_pub_cache(f'{build_path}/{app}', args.app_pubspec)
+        with metrics.stage('pubspec-sources'):
+            outputs.update(_generate_pubspec_sources(
+                app, app_pubspec, args.extra_pubspecs, build_id, tag, releases_path, shared_path, args.incremental,
+                work_dir,
+            ))
+        with metrics.stage('cargo-sources'):
+            outputs.update(_generate_cargo_sources(
+                app, args.cargo_locks, releases_path, args.rust_version, caches.get('git-packages'), shared_path,
+                args.incremental, work_dir,
+                None if args.cargo_metadata is None else os.path.join(work_dir, args.cargo_metadata),
+            ))
+        downloads_path = f'{Path(build_path).parent}/downloads' if args.keep_downloads else None
+        with metrics.stage('sdk-module'):
+            outputs.update(_get_sdk_module(
+                app, tag, releases_path, caches.get('sha256'), shared_path, downloads_path, args.host_arch_only,
+                work_dir,
+            ))
 
         if not args.keep_build_dirs:
             shutil.rmtree(f'{build_path}/{app}-{build_id}')
             os.remove(f'{build_path}/{app}')
 
+    return outputs
+
+
+def main():
+    # The verify subcommand checks generated manifests, instead of generating them
+    if sys.argv[1:2] == ['verify']:
+        exit(verify_sources_main(sys.argv[2:]))
+
+    parser = _create_parser()
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        _serve(args.serve)
+    elif args.MANIFEST is None:
+        parser.error('the following arguments are required: MANIFEST')
+    elif args.daemon is not None:
+        exit(_submit_job(args.daemon, sys.argv[1:]))
+    else:
+        _run(args)
+
 if __name__ == '__main__':
     main()
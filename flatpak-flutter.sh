@@ -54,7 +54,7 @@ echo
 echo "To change build target: ./flatpak-flutter.sh </path/to/app_id> [options]"
 
 action "Starting online build"
-$HOME_PATH/flatpak-flutter.py $@ flatpak-flutter.$MANIFEST_TYPE
+$HOME_PATH/flatpak-flutter.py --keep-downloads --seed-git-mirrors $@ flatpak-flutter.$MANIFEST_TYPE
 
 if [ $? != 0 ]; then
     fail "Online build failed, please verify output for details"
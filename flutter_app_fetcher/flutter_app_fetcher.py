@@ -1,14 +1,30 @@
 __license__ = 'MIT'
 import subprocess
 import yaml
+import contextvars
 import glob
+import os
+import re
 import shutil
 
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from fetch_scheduler.fetch_scheduler import get_scheduler, run_after, run_command
+from metrics.metrics import get_git_object_stats, get_host, metrics
 
 
 FLUTTER_URL = 'https://github.com/flutter/flutter'
+FLUTTER_GIT_URL = f'{FLUTTER_URL}.git'
+# Files read during pre-processing, next to each pubspec and Cargo.lock
+SPARSE_FILES = ['pubspec.yaml', 'pubspec.lock', 'pubspec_overrides.yaml', 'l10n.yaml', 'Cargo.lock', 'Cargo.toml']
+# The ARB files of flutter gen-l10n, run by pub get for apps with an l10n.yaml
+DEFAULT_ARB_DIR = 'lib/l10n'
+PATH_DEPENDENCY_KEYS = ['dependencies', 'dev_dependencies', 'dependency_overrides']
+
+
+class PatchError(Exception):
+    pass
 
 
 class Dumper(yaml.Dumper):
@@ -16,29 +32,291 @@ class Dumper(yaml.Dumper):
         return super().increase_indent(flow=flow, indentless=False)
 
 
-def _fetch_repos(repos: list):
+def _clone_repo(url: str, ref: str, path: str):
+    options = [
+        'git',
+        'clone',
+        '--branch',
+        ref,
+        '--depth',
+        '1',
+        url,
+        path,
+    ]
+
+    try:
+        run_command(options, stdout=subprocess.PIPE)
+    except subprocess.CalledProcessError:
+        command = [f'git clone {url} {path} && cd {path} && git reset --hard {ref}']
+        run_command(command, stdout=subprocess.PIPE, shell=True)
+
+
+def _get_sparse_pattern(path: str) -> str:
+    return '/' + os.path.normpath(path).lstrip('/')
+
+
+def _get_dir_patterns(path: str) -> List[str]:
+    return [_get_sparse_pattern(os.path.join(path, file)) for file in SPARSE_FILES]
+
+
+def _set_sparse_checkout(path: str, patterns: List[str]):
+    options = ['git', '-C', path, 'sparse-checkout', 'set', '--no-cone', '--stdin']
+    run_command(options, input='\n'.join(patterns).encode('utf-8'), stdout=subprocess.PIPE)
+
+
+def _get_path_dependencies(path: str, pubspec_dir: str) -> List[str]:
+    'Returns the paths of the path dependencies and workspace packages in the pubspec, relative to the repo'
+    paths = []
+
+    for file in ['pubspec.yaml', 'pubspec_overrides.yaml']:
+        pubspec_path = os.path.join(path, pubspec_dir, file)
+
+        if not os.path.isfile(pubspec_path):
+            continue
+
+        with open(pubspec_path, 'r') as stream:
+            pubspec = yaml.safe_load(stream) or {}
+
+        if pubspec.get('resolution') == 'workspace':
+            # The workspace root is in one of the parent dirs
+            parent = os.path.normpath(pubspec_dir)
+
+            while parent not in ['.', '']:
+                parent = os.path.dirname(parent) or '.'
+                paths.append(parent)
+
+        for member in pubspec.get('workspace') or []:
+            paths.append(os.path.normpath(os.path.join(pubspec_dir, str(member))))
+
+        for key in PATH_DEPENDENCY_KEYS:
+            for dependency in (pubspec.get(key) or {}).values():
+                if isinstance(dependency, dict) and 'path' in dependency:
+                    dependency_dir = os.path.normpath(os.path.join(pubspec_dir, str(dependency['path'])))
+
+                    # Dependencies outside the repo are provided by other sources
+                    if not dependency_dir.startswith('..'):
+                        paths.append(dependency_dir)
+
+    return paths
+
+
+def _get_arb_dir(path: str, pubspec_dir: str) -> Optional[str]:
+    'Returns the dir of the ARB files of the l10n.yaml next to the pubspec, relative to the repo'
+    l10n_path = os.path.join(path, pubspec_dir, 'l10n.yaml')
+
+    if not os.path.isfile(l10n_path):
+        return None
+
+    with open(l10n_path, 'r') as stream:
+        l10n = yaml.safe_load(stream) or {}
+
+    return os.path.normpath(os.path.join(pubspec_dir, str(l10n.get('arb-dir', DEFAULT_ARB_DIR))))
+
+
+def _clone_repo_sparse(url: str, ref: str, path: str, patterns: List[str], dirs: List[str]):
+    'Clones without blobs, only checking out the patterns and the files of dirs and their path dependencies'
+    os.makedirs(path, exist_ok=True)
+    run_command(['git', 'init', '--quiet', path])
+    run_command(['git', '-C', path, 'remote', 'add', 'origin', url])
+    patterns = patterns + [pattern for dir in dirs for pattern in _get_dir_patterns(dir)]
+    _set_sparse_checkout(path, patterns)
+
+    try:
+        run_command(['git', '-C', path, 'fetch', '--quiet', '--filter=blob:none', '--depth', '1', 'origin', ref])
+        run_command(['git', '-C', path, 'checkout', '--quiet', 'FETCH_HEAD'])
+    except subprocess.CalledProcessError:
+        # Servers not allowing to fetch a commit by its hash need a fetch of all refs
+        run_command(['git', '-C', path, 'fetch', '--quiet', '--filter=blob:none', 'origin'])
+        run_command(['git', '-C', path, 'checkout', '--quiet', ref])
+
+    # Blobs of path dependencies are fetched on demand, once their pubspec is read
+    pending = list(dirs)
+    seen = set(os.path.normpath(dir) for dir in dirs)
+    arb_dirs: Set[str] = set()
+
+    while pending:
+        added = []
+        added_patterns = []
+
+        # Workspace members can be globs, matched now the patterns are checked out
+        pubspec_dirs = [os.path.relpath(dir, path) for dir in glob.glob(os.path.join(path, pending.pop()))]
+        dependency_dirs = [dir for pubspec_dir in pubspec_dirs for dir in _get_path_dependencies(path, pubspec_dir)]
+
+        for dependency_dir in dependency_dirs:
+            if dependency_dir not in seen:
+                seen.add(dependency_dir)
+                added.append(dependency_dir)
+                added_patterns += _get_dir_patterns(dependency_dir)
+
+        for pubspec_dir in pubspec_dirs:
+            arb_dir = _get_arb_dir(path, pubspec_dir)
+
+            if arb_dir is not None and arb_dir not in arb_dirs:
+                arb_dirs.add(arb_dir)
+                added_patterns.append(_get_sparse_pattern(arb_dir) + '/')
+
+        if added_patterns:
+            patterns += added_patterns
+            _set_sparse_checkout(path, patterns)
+            pending += added
+
+
+def _get_git_mirror_name(url: str) -> str:
+    # Equals builder_uri_to_filename() of flatpak-builder
+    return re.sub('[/:]+', '_', url)
+
+
+def _seed_git_mirror(url: str, ref: str, path: str, git_mirrors_path: str):
+    'Adds the objects of a clone to the flatpak-builder mirror of its remote'
+    # The Flutter source is replaced by the SDK module, which uses this URL
+    mirror_url = FLUTTER_GIT_URL if url.startswith(FLUTTER_URL) else url
+    mirror_path = os.path.join(git_mirrors_path, _get_git_mirror_name(mirror_url))
+    commit = subprocess.run(
+        ['git', '-C', path, 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, check=True,
+    ).stdout.decode('utf-8').strip()
+
+    if not os.path.isdir(mirror_path):
+        subprocess.run(['git', 'init', '--bare', '--quiet', mirror_path], check=True)
+        subprocess.run(['git', '-C', mirror_path, 'config', 'remote.origin.url', mirror_url], check=True)
+        subprocess.run(['git', '-C', mirror_path, 'config', 'remote.origin.fetch', '+refs/*:refs/*'], check=True)
+        subprocess.run(['git', '-C', mirror_path, 'config', 'remote.origin.mirror', 'true'], check=True)
+    elif subprocess.run(['git', '-C', mirror_path, 'cat-file', '-e', f'{commit}^{{commit}}'],
+                        stderr=subprocess.DEVNULL).returncode == 0:
+        metrics.cache('git-mirror', hit=True)
+        return
+
+    metrics.cache('git-mirror', hit=False)
+
+    print(f'Seeding git mirror of {mirror_url}')
+    options = [
+        'git',
+        '-C',
+        mirror_path,
+        'fetch',
+        '--quiet',
+        '--update-shallow',
+        os.path.abspath(path),
+        '+refs/tags/*:refs/tags/*',
+        'HEAD',
+    ]
+    subprocess.run(options, check=True)
+
+
+def _fetch_repo(
+    url: str,
+    ref: str,
+    path: str,
+    git_mirrors_path: Optional[str],
+    sparse: Optional[Tuple[List[str], List[str]]] = None,
+):
+    if sparse is not None:
+        _clone_repo_sparse(url, ref, path, *sparse)
+    else:
+        _clone_repo(url, ref, path)
+    objects, size = get_git_object_stats(path)
+    metrics.inc('git_fetched_objects_total', objects, host=get_host(url))
+    metrics.inc('git_fetched_bytes_total', size, host=get_host(url))
+
+    if git_mirrors_path is not None:
+        if sparse is not None:
+            # The objects missing from a partial clone can't be added to the mirror
+            print(f'Not seeding git mirror of {url}, it is a partial clone')
+        else:
+            _seed_git_mirror(url, ref, path, git_mirrors_path)
+
+
+def _get_repo_path(path: str, repo_paths: Iterable[str]) -> Optional[str]:
+    'Returns the path of the innermost repo holding path'
+    path = os.path.normpath(path)
+    holding = [
+        repo_path for repo_path in repo_paths
+        if path == os.path.normpath(repo_path) or path.startswith(f'{os.path.normpath(repo_path)}/')
+    ]
+
+    return max(holding, key=len) if holding else None
+
+
+def _fetch_repos(
+    repos: list,
+    git_mirrors_path: Optional[str] = None,
+    sparse: Optional[Dict[str, Tuple[List[str], List[str]]]] = None,
+) -> Dict[str, Future]:
+    'Starts fetching the repos, returning the future per path'
     def by_path_depth(fetch_repo):
         return len(str(fetch_repo[2]).split('/'))
 
     repos.sort(key=by_path_depth)
+    scheduler = get_scheduler()
+    futures: Dict[str, Future] = {}
 
-    for url, ref, path in repos:
-        options = [
-            'git',
-            'clone',
-            '--branch',
-            ref,
-            '--depth',
-            '1',
-            url,
-            path,
-        ]
+    if git_mirrors_path is not None:
+        os.makedirs(git_mirrors_path, exist_ok=True)
 
-        try:
-            subprocess.run(options, stdout=subprocess.PIPE, check=True)
-        except subprocess.CalledProcessError:
-            command = [f'git clone {url} {path} && cd {path} && git reset --hard {ref}']
-            subprocess.run(command, stdout=subprocess.PIPE, shell=True, check=True)
+    # A nested repo is cloned as soon as the repo it is nested in is cloned
+    for url, ref, path in repos:
+        parent = _get_repo_path(os.path.dirname(path), futures)
+        dependencies = [futures[parent]] if parent is not None else []
+        futures[path] = scheduler.submit_after(
+            dependencies, url, _fetch_repo, url, ref, path, git_mirrors_path, (sparse or {}).get(path),
+        )
+
+    return futures
+
+
+def _group_patches(
+    patches: List[Tuple[str, str, str, List[str]]],
+    fetch_path: str,
+    repo_paths: Iterable[str],
+) -> List[Tuple[Set[str], List[Tuple[str, str, str]]]]:
+    '''Returns the patches per group of repos they change, in the order of the manifest
+
+    The patches changing a common repo, by their dest or the files they change,
+    are in one group, to be applied in order. Groups are applied in parallel.
+    '''
+    repo_paths = list(repo_paths)
+    groups: List[Tuple[Set[str], List[Tuple[int, str, str, str]]]] = []
+
+    for idx, (path, patch_path, dest, targets) in enumerate(patches):
+        dest_path = os.path.normpath(f'{fetch_path}/{dest}')
+        repo_path = _get_repo_path(dest_path, repo_paths) or dest_path
+        changed = set([repo_path] + [
+            _get_repo_path(f'{fetch_path}/{target}', repo_paths) or repo_path for target in targets
+        ])
+        group = [(idx, path, patch_path, dest_path)]
+
+        for overlapping in [group for group in groups if group[0] & changed]:
+            groups.remove(overlapping)
+            changed |= overlapping[0]
+            group += overlapping[1]
+
+        groups.append((changed, sorted(group)))
+
+    return [
+        (changed, [(path, patch_path, dest_path) for _, path, patch_path, dest_path in group])
+        for changed, group in groups
+    ]
+
+
+def _apply_patches(patches: List[Tuple[str, str, str]]):
+    'Applies the patches in order, each after a dry run to not leave a partially patched tree behind'
+    try:
+        for path, patch_path, dest_path in patches:
+            print(f'Apply patch: {path}')
+
+            for options in [['--dry-run'], []]:
+                with open(patch_path, 'rb') as stream:
+                    process = subprocess.run(
+                        ['patch', '-p1', '--forward', *options],
+                        cwd=dest_path, stdin=stream, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                    )
+
+                if process.returncode != 0:
+                    output = process.stdout.decode('utf-8', errors='replace')
+                    raise PatchError(f'Patch {path} does not apply to {dest_path}:\n{output}')
+    except PatchError:
+        # No use to wait for the clones of the other repos
+        get_scheduler().cancel()
+        raise
 
 
 def _add_submodule(module, submodule):
@@ -91,7 +369,36 @@ def _process_build_commands(module, app_pubspec: str):
         module['build-commands'] = build_commands
 
 
-def _process_sources(module, fetch_path: str, releases_path: str, rust_version: Optional[str]) -> Optional[str]:
+def _get_module_path(name: str, shared_path: Optional[str]) -> str:
+    return name if shared_path is None else f'{shared_path}/{name}'
+
+
+def _get_patch_targets(patch_path: str, dest: str) -> List[str]:
+    'Returns the paths of the files changed by the patch, relative to the fetch path'
+    targets = []
+
+    with open(patch_path, 'r') as stream:
+        for line in stream:
+            if line.startswith('+++ ') or line.startswith('--- '):
+                file = line[4:].split('\t')[0].strip()
+
+                # Strip the first component, like patch -p1
+                if file != '/dev/null' and '/' in file:
+                    targets.append(os.path.join(dest, file.split('/', 1)[1]))
+
+    return targets
+
+
+def _process_sources(
+    module,
+    fetch_path: str,
+    releases_path: str,
+    rust_version: Optional[str],
+    shared_path: Optional[str],
+    git_mirrors_path: Optional[str],
+    sparse_dirs: Optional[List[str]] = None,
+    work_dir: str = '.',
+) -> Optional[str]:
     if not 'sources' in module:
         return None
 
@@ -121,47 +428,90 @@ def _process_sources(module, fetch_path: str, releases_path: str, rust_version:
                 if str(source['url']).startswith(FLUTTER_URL) and 'tag' in source:
                     idxs.append(idx)
 
-                    _add_submodule(module, f"flutter-sdk-{source['tag']}.json")
+                    _add_submodule(module, _get_module_path(f"flutter-sdk-{source['tag']}.json", shared_path))
 
                     tag = source['tag']
 
             if source['type'] == 'patch' and '.flutter.patch' in str(source['path']):
                 idxs.append(idx)
 
-    _fetch_repos(repos)
-
     for patch in glob.glob(f'{releases_path}/{tag}/*.flutter.patch'):
-        shutil.copyfile(patch, Path(patch).name)
+        shutil.copyfile(patch, os.path.join(work_dir, Path(patch).name))
+
+    # Missing patches are reported before anything is cloned
+    patches = []
 
     for source in sources:
-        if 'type' in source:
-            if source['type'] == 'patch':
-                if not 'path' in source:
-                    continue
+        if source.get('type') == 'patch' and 'path' in source:
+            path = str(source['path'])
+            patch_path = os.path.join(work_dir, path)
+
+            if not os.path.isfile(patch_path):
+                raise PatchError(f'Patch {path} not found')
+
+            dest = source.get('dest', '')
+            patches.append((path, patch_path, dest, _get_patch_targets(patch_path, dest)))
+
+    sparse = None
+
+    if sparse_dirs is not None:
+        # Only the app repo, holding the app pubspec, is cloned partially, other repos are used in full
+        repo_paths = [repo_path for _, _, repo_path in repos]
+        app_repo_path = _get_repo_path(f'{fetch_path}/{sparse_dirs[0]}', repo_paths)
+
+        if app_repo_path is None:
+            print(f'Warning: No git source holds the app pubspec at {sparse_dirs[0]}, cloning in full')
+        else:
+            def in_app_repo(paths: List[str]) -> List[str]:
+                'Returns the paths inside the app repo, relative to its clone path'
+                return [
+                    os.path.relpath(f'{fetch_path}/{path}', app_repo_path) for path in paths
+                    if _get_repo_path(f'{fetch_path}/{path}', repo_paths) == app_repo_path
+                ]
+
+            patch_targets = [target for *_, targets in patches for target in targets]
+            sparse = {app_repo_path: (
+                [_get_sparse_pattern(target) for target in in_app_repo(patch_targets)], in_app_repo(sparse_dirs),
+            )}
+
+    clones = _fetch_repos(repos, git_mirrors_path, sparse)
+
+    with ThreadPoolExecutor(thread_name_prefix='patch') as executor:
+        futures = list(clones.values()) + [
+            run_after(
+                [clones[repo_path] for repo_path in repo_paths if repo_path in clones],
+                # Patches run in the context of the run, to cancel its scheduler on failure
+                lambda group=group: executor.submit(contextvars.copy_context().run, _apply_patches, group),
+            )
+            for repo_paths, group in _group_patches(patches, fetch_path, clones)
+        ]
 
-                dest = source['dest'] if 'dest' in source else ''
-                path = str(source['path'])
-                print(f'Apply patch: {path}')
-                command = f'(cd {fetch_path}/{dest} && patch -p1) < {path}'
-                subprocess.run([command], stdout=subprocess.PIPE, shell=True, check=True)
+        # The first failure is raised right away, e.g. a patch not applying
+        for future in as_completed(futures):
+            future.result()
 
     for idx in reversed(idxs):
         del sources[idx]
 
-    for patch in glob.glob('*.offline.patch'):
+    for patch in glob.glob(os.path.join(work_dir, '*.offline.patch')):
         sources += [
             {
                 'type': 'patch',
-                'path': patch
+                'path': Path(patch).name
             }
         ]
 
+    pubspec_sources = ["pubspec-sources.json"]
+
+    if shared_path is not None:
+        pubspec_sources.insert(0, _get_module_path(f'pubspec-sources-flutter-{tag}.json', shared_path))
+
     if rust_version is not None:
-        module['sources'] = ["pubspec-sources.json", 'cargo-sources.json'] + sources
+        module['sources'] = pubspec_sources + ['cargo-sources.json'] + sources
 
-        _add_submodule(module, f"rustup-{rust_version}.json")
+        _add_submodule(module, _get_module_path(f"rustup-{rust_version}.json", shared_path))
     else:
-        module['sources'] = ["pubspec-sources.json"] + sources
+        module['sources'] = pubspec_sources + sources
 
     return tag
 
@@ -172,8 +522,13 @@ def fetch_flutter_app(
     build_path: str,
     releases_path: str,
     app_pubspec: str,
-    rust_version: Optional[str]
+    rust_version: Optional[str],
+    shared_path: Optional[str] = None,
+    git_mirrors_path: Optional[str] = None,
+    sparse_dirs: Optional[List[str]] = None,
+    work_dir: str = '.',
 ) -> Tuple[str, Optional[str], int]:
+    'Fetches the app module to build_path, the paths in the manifest are relative to work_dir'
     if 'app-id' in manifest:
         app_id = 'app-id'
     elif 'id' in manifest:
@@ -199,7 +554,10 @@ def fetch_flutter_app(
 
         build_path_app = f'{build_path}/{app}'
         build_id = len(glob.glob(f'{build_path_app}-*')) + 1
-        tag = _process_sources(module, f'{build_path_app}-{build_id}', releases_path, rust_version)
+        tag = _process_sources(
+            module, f'{build_path_app}-{build_id}', releases_path, rust_version, shared_path, git_mirrors_path,
+            sparse_dirs, work_dir,
+        )
 
         options = [f'cd {build_path} && ln -snf {app}-{build_id} {app}']
         subprocess.run(options, stdout=subprocess.PIPE, shell=True, check=True)
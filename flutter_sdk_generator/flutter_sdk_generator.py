@@ -1,29 +1,170 @@
 #!/usr/bin/env python3
 
 __license__ = 'MIT'
-import json
+import os
 import subprocess
 import argparse
 import hashlib
+import json
+import platform
+import sys
+import tempfile
+import urllib.parse
 import urllib.request
 
-from typing import Any, Dict
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+if __name__ == '__main__':
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fetch_scheduler.fetch_scheduler import get_scheduler
+from manifest_io.manifest_io import dump_json
+from metrics.metrics import get_host, metrics
+
+
+STORAGE_URL = 'https://storage.googleapis.com'
+CHUNK_SIZE = 1024 * 1024
+ARCHES = ['x86_64', 'aarch64']
+# Marks a module without the sha256 of the artifacts of the listed arches
+MISSING_ARCHES_KEY = 'x-missing-arches'
 
 
 _FlatpakSourceType = Dict[str, Any]
 
 
-def _get_remote_sha256(url: str) -> str:
+def _get_download_url(url: str) -> str:
+    # Same variable as used by the flutter tool to download from a mirror
+    base_url = os.environ.get('FLUTTER_STORAGE_BASE_URL')
+
+    if base_url and url.startswith(STORAGE_URL):
+        return base_url.rstrip('/') + url[len(STORAGE_URL):]
+
+    return url
+
+
+def _get_download_path(downloads_path: str, url: str, sha256: str) -> str:
+    # The layout of the downloads directory in the flatpak-builder state dir
+    return os.path.join(downloads_path, sha256, os.path.basename(urllib.parse.urlparse(url).path))
+
+
+def _get_remote_sha256(
+    url: str,
+    sha256_cache: Optional[Dict[str, str]] = None,
+    downloads_path: Optional[str] = None,
+) -> str:
+    # Artifact URLs contain the engine hash, so their content never changes
+    if sha256_cache is not None and url in sha256_cache:
+        if downloads_path is None or os.path.isfile(_get_download_path(downloads_path, url, sha256_cache[url])):
+            metrics.cache('sha256', hit=True)
+            return sha256_cache[url]
+
+    if sha256_cache is not None:
+        metrics.cache('sha256', hit=False)
+
     print(f'Getting sha256 of {url}...')
     sha256 = hashlib.sha256()
 
-    with urllib.request.urlopen(url) as response:
-        data = response.read()
-        sha256.update(data)
+    if downloads_path is not None:
+        os.makedirs(downloads_path, exist_ok=True)
+        output = tempfile.NamedTemporaryFile(dir=downloads_path, prefix='.download-', delete=False)
+    else:
+        output = None
+
+    try:
+        # Downloads run in parallel, so don't keep whole artifacts in memory
+        with urllib.request.urlopen(_get_download_url(url)) as response:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                sha256.update(chunk)
+                metrics.inc('downloaded_bytes_total', len(chunk), host=get_host(url))
+
+                if output is not None:
+                    output.write(chunk)
+    except BaseException:
+        if output is not None:
+            output.close()
+            os.remove(output.name)
+        raise
+
+    if output is not None:
+        output.close()
+        download_path = _get_download_path(downloads_path, url, sha256.hexdigest())
+        os.makedirs(os.path.dirname(download_path), exist_ok=True)
+        os.replace(output.name, download_path)
+
+    if sha256_cache is not None:
+        sha256_cache[url] = sha256.hexdigest()
 
     return sha256.hexdigest()
 
 
+def _get_remote_sha256s(
+    urls: List[str],
+    sha256_cache: Optional[Dict[str, str]] = None,
+    downloads_path: Optional[str] = None,
+) -> Dict[str, str]:
+    scheduler = get_scheduler()
+    futures = {url: scheduler.submit(url, _get_remote_sha256, url, sha256_cache, downloads_path) for url in urls}
+
+    return {url: future.result() for url, future in futures.items()}
+
+
+def get_host_arch() -> str:
+    machine = platform.machine().lower()
+
+    return 'aarch64' if machine in ['arm64', 'aarch64'] else machine
+
+
+def _drop_missing_sha256s(sdk: _FlatpakSourceType, arches: List[str]) -> _FlatpakSourceType:
+    missing_arches = [arch for arch in ARCHES if arch not in arches]
+
+    if missing_arches:
+        print(f'Warning: no sha256 for {", ".join(missing_arches)}, complete the module before publishing')
+        sdk[MISSING_ARCHES_KEY] = missing_arches
+        sdk['sources'] = [
+            {key: value for key, value in source.items() if not (key == 'sha256' and value is None)}
+            for source in sdk['sources']
+        ]
+
+    return sdk
+
+
+def is_partial(sdk: _FlatpakSourceType) -> bool:
+    return MISSING_ARCHES_KEY in sdk
+
+
+def complete_sdk(
+    sdk: _FlatpakSourceType,
+    sha256_cache: Optional[Dict[str, str]] = None,
+    downloads_path: Optional[str] = None,
+) -> _FlatpakSourceType:
+    'Adds the sha256 of the artifacts left out of a module generated for the host arch only'
+    missing_arches = sdk.get(MISSING_ARCHES_KEY, [])
+    missing_sources = [
+        source for source in sdk['sources']
+        if 'sha256' not in source and any(arch in missing_arches for arch in source.get('only-arches', []))
+    ]
+    sha256s = _get_remote_sha256s([source['url'] for source in missing_sources], sha256_cache, downloads_path)
+    sources = []
+
+    for source in sdk['sources']:
+        if any(source is missing_source for missing_source in missing_sources):
+            # Keep the key order of a module generated in one go
+            completed = {}
+
+            for key, value in source.items():
+                completed[key] = value
+
+                if key == 'url':
+                    completed['sha256'] = sha256s[value]
+
+            source = completed
+
+        sources.append(source)
+
+    return {**{key: value for key, value in sdk.items() if key != MISSING_ARCHES_KEY}, 'sources': sources}
+
+
 def _get_commit(sdk_path: str) -> str:
     stdout = subprocess.run([f'git -C {sdk_path} rev-parse HEAD'], stdout=subprocess.PIPE, shell=True, check=True).stdout
 
@@ -32,6 +173,9 @@ def _get_commit(sdk_path: str) -> str:
 
 def generate_sdk(
     sdk_path: str,
+    sha256_cache: Optional[Dict[str, str]] = None,
+    downloads_path: Optional[str] = None,
+    arches: Optional[List[str]] = None,
 ) -> _FlatpakSourceType:
     sdk_version = open(f'{sdk_path}/version', 'r').readline().strip()
     sdk_commit = _get_commit(sdk_path)
@@ -39,9 +183,9 @@ def generate_sdk(
     gradle_wrapper = open(f'{sdk_path}/bin/internal/gradle_wrapper.version', 'r').readline().strip()
     material_fonts = open(f'{sdk_path}/bin/internal/material_fonts.version', 'r').readline().strip()
 
-    engine = f'https://storage.googleapis.com/flutter_infra_release/flutter/{engine}'
-    material_fonts = f'https://storage.googleapis.com/{material_fonts}'
-    gradle_wrapper = f'https://storage.googleapis.com/{gradle_wrapper}'
+    engine = f'{STORAGE_URL}/flutter_infra_release/flutter/{engine}'
+    material_fonts = f'{STORAGE_URL}/{material_fonts}'
+    gradle_wrapper = f'{STORAGE_URL}/{gradle_wrapper}'
 
     dart_sdk_x64 = f'{engine}/dart-sdk-linux-x64.zip'
     dart_sdk_arm64 = f'{engine}/dart-sdk-linux-arm64.zip'
@@ -58,7 +202,38 @@ def generate_sdk(
     flutter_gtk_arm64_profile = f'{engine}/linux-arm64-profile/linux-arm64-flutter-gtk.zip'
     flutter_gtk_arm64_release = f'{engine}/linux-arm64-release/linux-arm64-flutter-gtk.zip'
 
-    return {
+    arches = ARCHES if arches is None else arches
+    arch_urls = {
+        'x86_64': [
+            dart_sdk_x64,
+            artifacts_x64,
+            font_subset_x64,
+            flutter_gtk_x64_profile,
+            flutter_gtk_x64_release,
+        ],
+        'aarch64': [
+            dart_sdk_arm64,
+            artifacts_arm64,
+            font_subset_arm64,
+            flutter_gtk_arm64_profile,
+            flutter_gtk_arm64_release,
+        ],
+    }
+    urls = [
+        material_fonts,
+        gradle_wrapper,
+        sky_engine,
+        flutter_gpu,
+        flutter_patched_sdk,
+        flutter_patched_sdk_product,
+    ]
+
+    for arch in arches:
+        urls += arch_urls[arch]
+
+    sha256s = _get_remote_sha256s(urls, sha256_cache, downloads_path)
+
+    return _drop_missing_sha256s({
         'name': 'flutter',
         'buildsystem': 'simple',
         'build-commands': [
@@ -84,7 +259,7 @@ def generate_sdk(
                     'x86_64'
                 ],
                 'url': dart_sdk_x64,
-                'sha256': _get_remote_sha256(dart_sdk_x64),
+                'sha256': sha256s.get(dart_sdk_x64),
                 'strip-components': 0,
                 'dest': 'flutter/bin/cache'
             },
@@ -94,45 +269,45 @@ def generate_sdk(
                     'aarch64'
                 ],
                 'url': dart_sdk_arm64,
-                'sha256': _get_remote_sha256(dart_sdk_arm64),
+                'sha256': sha256s.get(dart_sdk_arm64),
                 'strip-components': 0,
                 'dest': 'flutter/bin/cache'
             },
             {
                 'type': 'archive',
                 'url': material_fonts,
-                'sha256': _get_remote_sha256(material_fonts),
+                'sha256': sha256s.get(material_fonts),
                 'dest': 'flutter/bin/cache/artifacts/material_fonts'
             },
             {
                 'type': 'archive',
                 'url': gradle_wrapper,
-                'sha256': _get_remote_sha256(gradle_wrapper),
+                'sha256': sha256s.get(gradle_wrapper),
                 'strip-components': 0,
                 'dest': 'flutter/bin/cache/artifacts/gradle_wrapper'
             },
             {
                 'type': 'archive',
                 'url': sky_engine,
-                'sha256': _get_remote_sha256(sky_engine),
+                'sha256': sha256s.get(sky_engine),
                 'dest': 'flutter/bin/cache/pkg/sky_engine'
             },
             {
                 'type': 'archive',
                 'url': flutter_gpu,
-                'sha256': _get_remote_sha256(flutter_gpu),
+                'sha256': sha256s.get(flutter_gpu),
                 'dest': 'flutter/bin/cache/pkg/flutter_gpu'
             },
             {
                 'type': 'archive',
                 'url': flutter_patched_sdk,
-                'sha256': _get_remote_sha256(flutter_patched_sdk),
+                'sha256': sha256s.get(flutter_patched_sdk),
                 'dest': 'flutter/bin/cache/artifacts/engine/common/flutter_patched_sdk'
             },
             {
                 'type': 'archive',
                 'url': flutter_patched_sdk_product,
-                'sha256': _get_remote_sha256(flutter_patched_sdk_product),
+                'sha256': sha256s.get(flutter_patched_sdk_product),
                 'dest': 'flutter/bin/cache/artifacts/engine/common/flutter_patched_sdk_product'
             },
             {
@@ -141,7 +316,7 @@ def generate_sdk(
                     'x86_64'
                 ],
                 'url': artifacts_x64,
-                'sha256': _get_remote_sha256(artifacts_x64),
+                'sha256': sha256s.get(artifacts_x64),
                 'strip-components': 0,
                 'dest': 'flutter/bin/cache/artifacts/engine/linux-x64'
             },
@@ -151,7 +326,7 @@ def generate_sdk(
                     'x86_64'
                 ],
                 'url': font_subset_x64,
-                'sha256': _get_remote_sha256(font_subset_x64),
+                'sha256': sha256s.get(font_subset_x64),
                 'dest': 'flutter/bin/cache/artifacts/engine/linux-x64'
             },
             {
@@ -160,7 +335,7 @@ def generate_sdk(
                     'x86_64'
                 ],
                 'url': flutter_gtk_x64_profile,
-                'sha256': _get_remote_sha256(flutter_gtk_x64_profile),
+                'sha256': sha256s.get(flutter_gtk_x64_profile),
                 'strip-components': 0,
                 'dest': 'flutter/bin/cache/artifacts/engine/linux-x64-profile'
             },
@@ -170,7 +345,7 @@ def generate_sdk(
                     'x86_64'
                 ],
                 'url': flutter_gtk_x64_release,
-                'sha256': _get_remote_sha256(flutter_gtk_x64_release),
+                'sha256': sha256s.get(flutter_gtk_x64_release),
                 'strip-components': 0,
                 'dest': 'flutter/bin/cache/artifacts/engine/linux-x64-release'
             },
@@ -180,7 +355,7 @@ def generate_sdk(
                     'aarch64'
                 ],
                 'url': artifacts_arm64,
-                'sha256': _get_remote_sha256(artifacts_arm64),
+                'sha256': sha256s.get(artifacts_arm64),
                 'strip-components': 0,
                 'dest': 'flutter/bin/cache/artifacts/engine/linux-arm64'
             },
@@ -190,7 +365,7 @@ def generate_sdk(
                     'aarch64'
                 ],
                 'url': font_subset_arm64,
-                'sha256': _get_remote_sha256(font_subset_arm64),
+                'sha256': sha256s.get(font_subset_arm64),
                 'dest': 'flutter/bin/cache/artifacts/engine/linux-arm64'
             },
             {
@@ -199,7 +374,7 @@ def generate_sdk(
                     'aarch64'
                 ],
                 'url': flutter_gtk_arm64_profile,
-                'sha256': _get_remote_sha256(flutter_gtk_arm64_profile),
+                'sha256': sha256s.get(flutter_gtk_arm64_profile),
                 'strip-components': 0,
                 'dest': 'flutter/bin/cache/artifacts/engine/linux-arm64-profile'
             },
@@ -209,7 +384,7 @@ def generate_sdk(
                     'aarch64'
                 ],
                 'url': flutter_gtk_arm64_release,
-                'sha256': _get_remote_sha256(flutter_gtk_arm64_release),
+                'sha256': sha256s.get(flutter_gtk_arm64_release),
                 'strip-components': 0,
                 'dest': 'flutter/bin/cache/artifacts/engine/linux-arm64-release'
             },
@@ -228,24 +403,34 @@ def generate_sdk(
                 ]
             }
         ]
-    }
+    }, arches)
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('sdk_path', help='Path to the Flutter SDK')
+    parser.add_argument('sdk_path', help='Path to the Flutter SDK, or to the module with --complete')
     parser.add_argument('-o', '--output', required=False, help='Where to write generated sources')
+    parser.add_argument('--downloads', metavar='PATH', required=False, help='Keep the downloaded artifacts in the flatpak-builder downloads directory at PATH')
+    parser.add_argument('--host-arch-only', action='store_true', help='Only get the sha256 of the artifacts for the host arch')
+    parser.add_argument('--complete', action='store_true', help='Add the missing sha256 to the module at sdk_path, generated with --host-arch-only')
     args = parser.parse_args()
 
     if args.output is not None:
         outfile = args.output
+    elif args.complete:
+        outfile = args.sdk_path
     else:
         outfile = 'flutter-sdk.json'
 
-    generated_sdk = generate_sdk(args.sdk_path)
+    if args.complete:
+        with open(args.sdk_path, 'r') as input:
+            generated_sdk = complete_sdk(json.load(input), downloads_path=args.downloads)
+    else:
+        arches = [get_host_arch()] if args.host_arch_only else None
+        generated_sdk = generate_sdk(args.sdk_path, downloads_path=args.downloads, arches=arches)
 
     with open(outfile, 'w') as out:
-        json.dump(generated_sdk, out, indent=4, sort_keys=False)
+        dump_json(generated_sdk, out)
 
 
 if __name__ == '__main__':
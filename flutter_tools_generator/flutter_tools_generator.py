@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+__license__ = 'MIT'
+import os
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+if __name__ == '__main__':
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fetch_scheduler.fetch_scheduler import get_scheduler, run_command
+from flutter_app_fetcher.flutter_app_fetcher import FLUTTER_GIT_URL
+from manifest_io.manifest_io import dump_json_array
+from pubspec_generator.pubspec_generator import PUB_CACHE, iter_package_sources
+
+FLUTTER_TOOLS = 'packages/flutter_tools'
+SOURCES_FILE = 'pubspec-sources-flutter.json'
+PACKAGE_CONFIG_FILE = 'package_config.json'
+# Replaced by the directory of the app module in the sandbox, holding flutter and the pub cache
+BUILD_ROOT = '@BUILD_ROOT@'
+
+
+_FlatpakSourceType = Dict[str, Any]
+
+
+def generate_flutter_tools(sdk_path: str) -> Tuple[List[_FlatpakSourceType], str]:
+    'Returns the sources of the flutter_tools dependencies and the package config template'
+    flutter_tools_path = f'{sdk_path}/{FLUTTER_TOOLS}'
+    sources = list(iter_package_sources([f'{flutter_tools_path}/pubspec.lock'], set()))
+    # The pub cache of the SDK is found next to it
+    root_path = str(Path(sdk_path).parent)
+
+    with open(f'{flutter_tools_path}/.dart_tool/package_config.json', 'r') as input:
+        package_config = input.read()
+
+    for path in [os.path.realpath(root_path), os.path.abspath(root_path)]:
+        package_config = package_config.replace(path, BUILD_ROOT)
+
+    return sources, package_config
+
+
+def has_flutter_tools(release_path: str) -> bool:
+    return os.path.isfile(f'{release_path}/{SOURCES_FILE}') and os.path.isfile(f'{release_path}/{PACKAGE_CONFIG_FILE}')
+
+
+def load_flutter_tools(release_path: str, build_root: str) -> Optional[Tuple[List[_FlatpakSourceType], str]]:
+    'Returns the prebuilt flutter_tools sources and package config of a Flutter release, if available'
+    sources_path = f'{release_path}/{SOURCES_FILE}'
+    package_config_path = f'{release_path}/{PACKAGE_CONFIG_FILE}'
+
+    if not has_flutter_tools(release_path):
+        return None
+
+    with open(sources_path, 'r') as input:
+        sources = json.load(input)
+
+    with open(package_config_path, 'r') as input:
+        package_config = input.read().replace(BUILD_ROOT, build_root)
+
+    return sources, package_config
+
+
+def fetch_sdk(tag: str, root_path: str) -> str:
+    'Clones the Flutter SDK at tag into root_path and runs flutter once, for it to get the flutter_tools dependencies'
+    sdk_path = f'{root_path}/flutter'
+    options = ['git', 'clone', '--depth', '1', '--branch', tag, FLUTTER_GIT_URL, sdk_path]
+    get_scheduler().run(FLUTTER_GIT_URL, run_command, options)
+    # Like in the app build directory, the pub cache is next to the SDK
+    env = {**os.environ, 'PUB_CACHE': f'{root_path}/.{PUB_CACHE}'}
+    subprocess.run([f'{sdk_path}/bin/flutter', '--version'], env=env, check=True)
+
+    return sdk_path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sdk_path', nargs='?', help='Path to the Flutter SDK, after running flutter once')
+    parser.add_argument('-o', '--output', metavar='PATH', required=False, help='Release directory to write to, e.g. releases/flutter/<tag>')
+    parser.add_argument('--tag', required=False, help='Clone and set up the Flutter SDK at TAG, instead of using sdk_path')
+    args = parser.parse_args()
+    release_path = args.output if args.output is not None else '.'
+
+    if (args.sdk_path is None) == (args.tag is None):
+        parser.error('either sdk_path or --tag is required')
+
+    if args.tag is not None:
+        with tempfile.TemporaryDirectory() as root_path:
+            sources, package_config = generate_flutter_tools(fetch_sdk(args.tag, root_path))
+    else:
+        sources, package_config = generate_flutter_tools(args.sdk_path)
+
+    os.makedirs(release_path, exist_ok=True)
+
+    with open(f'{release_path}/{SOURCES_FILE}', 'w') as out:
+        dump_json_array(sources, out)
+        out.write('\n')
+
+    with open(f'{release_path}/{PACKAGE_CONFIG_FILE}', 'w') as out:
+        out.write(package_config)
+
+
+if __name__ == '__main__':
+    main()
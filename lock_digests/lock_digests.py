@@ -0,0 +1,59 @@
+__license__ = 'MIT'
+import hashlib
+import json
+import os
+import tempfile
+
+from typing import Any, Dict, Optional
+
+from metrics.metrics import metrics
+
+# Increase when the sources generated for a lock entry change
+FORMAT_VERSION = 2
+
+
+def get_digest(entry: Any) -> str:
+    return hashlib.sha256(json.dumps(entry, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _get_digests_path(output_path: str) -> str:
+    cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    name = hashlib.sha1(os.path.abspath(output_path).encode('utf-8')).hexdigest()
+
+    return os.path.join(cache_dir, 'flatpak-flutter', 'lock-digests', f'{name}.json')
+
+
+class LockDigests:
+    'The sources generated per lock entry digest for an output file, to only process changed entries on updates'
+    def __init__(self, output_path: str):
+        self._path = _get_digests_path(output_path)
+        self._previous: Dict[str, Any] = {}
+        self._current: Dict[str, Any] = {}
+
+        try:
+            with open(self._path, 'r') as input:
+                recorded = json.load(input)
+
+            if recorded.get('version') == FORMAT_VERSION:
+                self._previous = recorded['entries']
+        except (OSError, ValueError):
+            pass
+
+    def get(self, digest: str) -> Optional[Any]:
+        metrics.cache('lock-digests', hit=digest in self._previous)
+
+        return self._previous.get(digest)
+
+    def set(self, digest: str, sources: Any):
+        self._current[digest] = sources
+
+    def save(self):
+        'Records the entries of this run, dropping the entries of removed packages'
+        reused = len([digest for digest in self._current if digest in self._previous])
+        print(f'Reused the sources of {reused} of {len(self._current)} lock entries')
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self._path), delete=False) as out:
+            json.dump({'version': FORMAT_VERSION, 'entries': self._current}, out)
+
+        os.replace(out.name, self._path)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+__license__ = 'MIT'
+import argparse
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import sys
+import urllib.error
+import urllib.request
+
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlparse
+
+if __name__ == '__main__':
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fetch_scheduler.fetch_scheduler import TransientError, get_scheduler, run_command
+from metrics.metrics import get_host, metrics
+
+
+GITLAB_HOSTS = ['gitlab.com', 'gitlab.gnome.org', 'gitlab.freedesktop.org', 'invent.kde.org', 'framagit.org']
+GITEA_HOSTS = ['codeberg.org', 'gitea.com']
+COMMIT_LEN = 40
+
+
+def _get_cache_path(url: str, commit: str, manifest: str) -> str:
+    repo_dir = url.replace('://', '_').replace('/', '_')
+    cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+
+    return os.path.join(cache_dir, 'flatpak-flutter', 'manifests', repo_dir, commit, manifest)
+
+
+def _resolve_commit(url: str, branch: Optional[str]) -> Optional[str]:
+    ref = branch if branch is not None else 'HEAD'
+    options = ['git', 'ls-remote', url, ref, f'{ref}^{{}}']
+    result = get_scheduler().run(url, subprocess.run, options, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    commit = None
+
+    if result.returncode == 0:
+        for line in result.stdout.decode('utf-8').splitlines():
+            sha, name = line.split('\t')
+
+            # Prefer the commit an annotated tag points to
+            if name.endswith('^{}'):
+                return sha
+            if commit is None:
+                commit = sha
+
+    if commit is None and branch is not None and len(branch) == COMMIT_LEN:
+        commit = branch
+
+    return commit
+
+
+def _get_raw_url(url: str, commit: str, manifest: str) -> Optional[str]:
+    parsed = urlparse(url)
+
+    if parsed.scheme not in ['http', 'https'] or parsed.hostname is None:
+        return None
+
+    host = parsed.hostname
+    path = parsed.path.rstrip('/')
+
+    if path.endswith('.git'):
+        path = path[:-len('.git')]
+
+    if host == 'github.com':
+        return f'https://raw.githubusercontent.com{path}/{commit}/{manifest}'
+    elif host in GITLAB_HOSTS or host.startswith('gitlab.'):
+        return f'{parsed.scheme}://{parsed.netloc}{path}/-/raw/{commit}/{manifest}'
+    elif host in GITEA_HOSTS or host.startswith('gitea.'):
+        return f'{parsed.scheme}://{parsed.netloc}{path}/raw/commit/{commit}/{manifest}'
+
+    return None
+
+
+def _fetch_raw(url: str, branch: Optional[str], commit: Optional[str], manifest: str, dest: str) -> bool:
+    ref = commit if commit is not None else branch
+
+    if ref is None:
+        return False
+
+    raw_url = _get_raw_url(url, ref, manifest)
+
+    if raw_url is None:
+        return False
+
+    try:
+        get_scheduler().run(raw_url, urllib.request.urlretrieve, raw_url, dest, cancel_on_error=False)
+    except (urllib.error.URLError, OSError):
+        return False
+
+    metrics.inc('downloaded_bytes_total', os.path.getsize(dest), host=get_host(raw_url))
+
+    return True
+
+
+def _fetch_archive(url: str, branch: Optional[str], commit: Optional[str], manifest: str, dest: str) -> bool:
+    # Servers usually only allow archives of named refs
+    ref = branch if branch is not None else 'HEAD'
+    options = ['git', 'archive', f'--remote={url}', ref, manifest]
+    result = get_scheduler().run(url, subprocess.run, options, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    if result.returncode != 0:
+        return False
+
+    with tarfile.open(fileobj=io.BytesIO(result.stdout)) as tar:
+        member = tar.extractfile(manifest)
+
+        if member is None:
+            return False
+
+        with open(dest, 'wb') as out:
+            shutil.copyfileobj(member, out)
+
+    return True
+
+
+def _sparse_checkout(url: str, branch: Optional[str], manifest: str, clone_path: str):
+    options = ['git', 'clone', '--filter=blob:none', '--no-checkout', '--depth', '1']
+
+    if branch is not None:
+        options += ['--branch', branch]
+
+    shutil.rmtree(clone_path, ignore_errors=True)
+    run_command(options + [url, clone_path], stdout=subprocess.PIPE)
+    run_command(['git', '-C', clone_path, 'sparse-checkout', 'set', '--no-cone', f'/{manifest}'])
+    # Only fetches the blob of the manifest
+    run_command(['git', '-C', clone_path, 'checkout'], stdout=subprocess.PIPE)
+
+
+def _fetch_sparse(url: str, branch: Optional[str], commit: Optional[str], manifest: str, dest: str) -> bool:
+    with tempfile.TemporaryDirectory() as tmp_path:
+        clone_path = f'{tmp_path}/repo'
+
+        try:
+            get_scheduler().run(url, _sparse_checkout, url, branch, manifest, clone_path, cancel_on_error=False)
+        except (subprocess.CalledProcessError, TransientError):
+            return False
+
+        if not os.path.isfile(f'{clone_path}/{manifest}'):
+            return False
+
+        shutil.copyfile(f'{clone_path}/{manifest}', dest)
+
+    return True
+
+
+def fetch_manifest(manifest: str, url: str, branch: Optional[str], dest: str) -> bool:
+    'Retrieves a single file from a git repo, trying the cheapest methods first'
+    commit = _resolve_commit(url, branch)
+
+    if commit is not None:
+        cache_path = _get_cache_path(url, commit, manifest)
+
+        metrics.cache('manifest', hit=os.path.isfile(cache_path))
+
+        if os.path.isfile(cache_path):
+            print(f'Using cached {manifest} of {commit}')
+            shutil.copyfile(cache_path, dest)
+            return True
+
+    fetchers = [
+        ('raw file endpoint', _fetch_raw),
+        ('git archive', _fetch_archive),
+        ('sparse checkout', _fetch_sparse),
+    ]
+
+    for method, fetcher in fetchers:
+        if fetcher(url, branch, commit, manifest, dest):
+            print(f'Fetched {manifest} using {method}')
+
+            if commit is not None:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                shutil.copyfile(dest, cache_path)
+
+            return True
+
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('url', help='URL of the git repo')
+    parser.add_argument('manifest', help='Path of the manifest in the git repo')
+    parser.add_argument('-b', '--branch', required=False, help='Branch or tag to get the manifest from')
+    parser.add_argument('-o', '--output', required=False, help='Where to write the manifest')
+    args = parser.parse_args()
+
+    if args.output is not None:
+        outfile = args.output
+    else:
+        outfile = os.path.basename(args.manifest)
+
+    if not fetch_manifest(args.manifest, args.url, args.branch, outfile):
+        print(f'Error: Unable to fetch {args.manifest} from {args.url}')
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+__license__ = 'MIT'
+import json
+import yaml
+
+from typing import Any, IO, Iterable
+
+INDENT = '    '
+
+# The libyaml based loader produces the same documents, only faster
+Loader = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+
+
+class Dumper(yaml.Dumper):
+    # The libyaml based CDumper always emits block sequences indentless, which
+    # can't be overridden, so the pure Python emitter is kept for the output
+    def increase_indent(self, flow=False, *args, **kwargs):
+        return super().increase_indent(flow=flow, indentless=False)
+
+
+def load_yaml(stream: IO) -> Any:
+    return yaml.load(stream, Loader=Loader)
+
+
+def dump_yaml(data: Any, stream: IO):
+    yaml.dump(data=data, stream=stream, indent=2, sort_keys=False, Dumper=Dumper)
+
+
+def _encode(value: Any, indent: str) -> str:
+    # Equals json.dumps(value, indent=4) nested at the given indent, with the
+    # scalars left to the C encoder
+    if isinstance(value, dict) and value:
+        inner = indent + INDENT
+        items = [f'{inner}{json.dumps(key)}: {_encode(item, inner)}' for key, item in value.items()]
+
+        return '{\n' + ',\n'.join(items) + f'\n{indent}}}'
+    elif isinstance(value, (list, tuple)) and value:
+        inner = indent + INDENT
+        items = [f'{inner}{_encode(item, inner)}' for item in value]
+
+        return '[\n' + ',\n'.join(items) + f'\n{indent}]'
+
+    return json.dumps(value)
+
+
+def dump_json(data: Any, stream: IO):
+    'Writes the same as json.dump(data, stream, indent=4)'
+    stream.write(_encode(data, ''))
+
+
+def dump_json_array(items: Iterable[Any], stream: IO):
+    'Writes the same as dump_json(), writing each item as soon as it is produced'
+    separator = '[\n'
+
+    for item in items:
+        stream.write(f'{separator}{INDENT}{_encode(item, INDENT)}')
+        separator = ',\n'
+
+    stream.write('[]' if separator == '[\n' else '\n]')
@@ -0,0 +1,188 @@
+__license__ = 'MIT'
+import contextlib
+import contextvars
+import json
+import os
+import subprocess
+import threading
+import time
+
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+PREFIX = 'flatpak_flutter'
+DURATION_BUCKETS = [0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0]
+
+# name: (type, help)
+METRICS = {
+    'downloaded_bytes_total': ('counter', 'Bytes downloaded, per host'),
+    'git_fetched_objects_total': ('counter', 'Git objects fetched, per host'),
+    'git_fetched_bytes_total': ('counter', 'Bytes of git objects fetched, per host'),
+    'fetch_duration_seconds': ('histogram', 'Duration of network operations, per host'),
+    'fetch_retries_total': ('counter', 'Network operations retried, per host'),
+    'sources_emitted_total': ('counter', 'Sources written, per output file and source type'),
+    'sources_deduped_total': ('counter', 'Duplicate source entries dropped, per generator'),
+    'cache_requests_total': ('counter', 'Cache lookups, per cache and result'),
+    'stage_duration_seconds': ('gauge', 'Duration of the last run of each processing stage'),
+}
+
+_LabelsType = Tuple[Tuple[str, str], ...]
+
+
+def get_host(url: str) -> str:
+    return urlparse(url).hostname or 'localhost'
+
+
+def get_git_object_stats(path: str) -> Tuple[int, int]:
+    'Returns the number of objects and their size in bytes of a git repo'
+    stdout = subprocess.run(
+        ['git', '-C', path, 'count-objects', '-v'], stdout=subprocess.PIPE, check=True,
+    ).stdout.decode('utf-8')
+    stats = dict(line.split(': ') for line in stdout.splitlines())
+
+    return (
+        int(stats['count']) + int(stats['in-pack']),
+        (int(stats['size']) + int(stats['size-pack'])) * 1024,
+    )
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values: Dict[str, Dict[_LabelsType, float]] = {}
+        self._histograms: Dict[str, Dict[_LabelsType, List[float]]] = {}
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+            self._histograms.clear()
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        key = tuple(sorted(labels.items()))
+
+        with self._lock:
+            values = self._values.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str):
+        with self._lock:
+            self._values.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def observe(self, name: str, value: float, **labels: str):
+        with self._lock:
+            self._histograms.setdefault(name, {}).setdefault(tuple(sorted(labels.items())), []).append(value)
+
+    def cache(self, cache: str, hit: bool):
+        self.inc('cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+    @contextlib.contextmanager
+    def stage(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.set('stage_duration_seconds', time.perf_counter() - start, stage=stage)
+
+    def _format_labels(self, labels: _LabelsType, extra: str = '') -> str:
+        items = [f'{key}="{value}"' for key, value in labels] + ([extra] if extra else [])
+
+        return '{' + ','.join(items) + '}' if items else ''
+
+    def to_prometheus(self) -> str:
+        lines = []
+
+        with self._lock:
+            for name, (metric_type, description) in METRICS.items():
+                if name not in self._values and name not in self._histograms:
+                    continue
+
+                lines.append(f'# HELP {PREFIX}_{name} {description}')
+                lines.append(f'# TYPE {PREFIX}_{name} {metric_type}')
+
+                for labels, value in sorted(self._values.get(name, {}).items()):
+                    lines.append(f'{PREFIX}_{name}{self._format_labels(labels)} {value}')
+
+                for labels, observed in sorted(self._histograms.get(name, {}).items()):
+                    for bucket in DURATION_BUCKETS + [float('inf')]:
+                        count = len([value for value in observed if value <= bucket])
+                        le = '+Inf' if bucket == float('inf') else str(bucket)
+                        bucket_labels = self._format_labels(labels, f'le="{le}"')
+                        lines.append(f'{PREFIX}_{name}_bucket{bucket_labels} {count}')
+
+                    lines.append(f'{PREFIX}_{name}_sum{self._format_labels(labels)} {sum(observed)}')
+                    lines.append(f'{PREFIX}_{name}_count{self._format_labels(labels)} {len(observed)}')
+
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self) -> dict:
+        summary: dict = {}
+        cache_ratios: Dict[str, Dict[str, float]] = {}
+
+        with self._lock:
+            for name, values in self._values.items():
+                summary[name] = [{'labels': dict(labels), 'value': value} for labels, value in sorted(values.items())]
+
+                if name == 'cache_requests_total':
+                    for labels, value in values.items():
+                        label_dict = dict(labels)
+                        cache_ratios.setdefault(label_dict['cache'], {'hit': 0, 'miss': 0})[label_dict['result']] = value
+
+            for name, histograms in self._histograms.items():
+                summary[name] = [
+                    {'labels': dict(labels), 'count': len(observed), 'sum': sum(observed), 'max': max(observed)}
+                    for labels, observed in sorted(histograms.items())
+                ]
+
+        summary['cache_hit_ratio'] = {
+            cache: counts['hit'] / (counts['hit'] + counts['miss']) for cache, counts in sorted(cache_ratios.items())
+        }
+
+        return summary
+
+    def write(self, path: str):
+        'Writes the Prometheus textfile and the JSON summary to the directory at path'
+        os.makedirs(path, exist_ok=True)
+
+        # Written under a temporary name first, for scrapers not to see partial files
+        for filename, contents in [
+            (f'{PREFIX}.prom', self.to_prometheus()),
+            (f'{PREFIX}.json', json.dumps(self.to_json(), indent=4) + '\n'),
+        ]:
+            tmp_path = os.path.join(path, f'.{filename}.tmp')
+
+            with open(tmp_path, 'w') as out:
+                out.write(contents)
+
+            os.replace(tmp_path, os.path.join(path, filename))
+
+
+_shared_metrics = Metrics()
+# The metrics of the current run, instead of the shared ones
+_current_metrics: 'contextvars.ContextVar[Optional[Metrics]]' = contextvars.ContextVar('metrics', default=None)
+
+
+def get_metrics() -> Metrics:
+    current = _current_metrics.get()
+
+    return current if current is not None else _shared_metrics
+
+
+@contextlib.contextmanager
+def use_metrics(run_metrics: Metrics) -> Iterator[Metrics]:
+    'Records the metrics of this context in run_metrics, e.g. for one of several runs in threads'
+    token = _current_metrics.set(run_metrics)
+
+    try:
+        yield run_metrics
+    finally:
+        _current_metrics.reset(token)
+
+
+class _CurrentMetrics:
+    'Forwards to the metrics of the current run, see use_metrics()'
+    def __getattr__(self, name: str) -> Any:
+        return getattr(get_metrics(), name)
+
+
+# Used by all modules of a run
+metrics = _CurrentMetrics()
@@ -4,11 +4,22 @@
 
 __license__ = 'MIT'
 import argparse
+import glob
 import hashlib
 import json
-import yaml
+import os
+import re
+import sys
 
-from typing import Any, Dict, List, Optional
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set
+
+if __name__ == '__main__':
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from manifest_io.manifest_io import dump_json_array, load_yaml
+from metrics.metrics import metrics
+from lock_digests.lock_digests import LockDigests, get_digest
 
 PUB_DEV = 'https://pub.dev/api/archives'
 PUB_CACHE = 'pub-cache'
@@ -18,23 +29,95 @@ GIT_CACHE = f'.{PUB_CACHE}/git/cache'
 _FlatpakSourceType = Dict[str, Any]
 
 
+def _load_pubspec(pubspec_dir: str) -> Dict[str, Any]:
+    path = os.path.join(pubspec_dir, 'pubspec.yaml')
+
+    if not os.path.isfile(path):
+        return {}
+
+    with open(path, 'r') as stream:
+        return load_yaml(stream) or {}
+
+
+def get_workspace_root(pubspec_dir: str) -> Optional[str]:
+    'Returns the absolute root dir of the pub workspace the package is in, if any'
+    pubspec_dir = os.path.abspath(pubspec_dir)
+    pubspec = _load_pubspec(pubspec_dir)
+
+    if pubspec.get('resolution') != 'workspace':
+        return pubspec_dir if 'workspace' in pubspec else None
+
+    # Like pub, look for the root in the parent dirs, a nested workspace is part of the outer one
+    parent = os.path.dirname(pubspec_dir)
+
+    while True:
+        parent_pubspec = _load_pubspec(parent)
+
+        if 'workspace' in parent_pubspec and parent_pubspec.get('resolution') != 'workspace':
+            return parent
+
+        if parent == os.path.dirname(parent):
+            raise FileNotFoundError(f'No workspace root found for {pubspec_dir}')
+
+        parent = os.path.dirname(parent)
+
+
+def get_workspace_members(root_dir: str) -> List[str]:
+    'Returns the absolute dirs of the packages in the workspace, including nested workspaces'
+    members = []
+    root_dir = os.path.abspath(root_dir)
+
+    for pattern in _load_pubspec(root_dir).get('workspace') or []:
+        for member in sorted(glob.glob(os.path.join(root_dir, str(pattern)))):
+            if os.path.isfile(os.path.join(member, 'pubspec.yaml')):
+                members.append(os.path.abspath(member))
+                members += get_workspace_members(member)
+
+    return members
+
+
+def _get_repo_name(repo_url: str) -> str:
+    'Returns the name pub uses for the cache directories of the repo'
+    name = repo_url.rstrip('/').split('/')[-1]
+
+    if name.endswith('.git'):
+        name = name[:-len('.git')]
+
+    return re.sub(r'[^a-zA-Z0-9._-]', '_', name)
+
+
+def _get_repo_key(package: Any) -> Optional[str]:
+    if package.get('source') != 'git':
+        return None
+
+    return f"git {package['description']['url']} {package['description']['resolved-ref']}"
+
+
 def _get_git_package_sources(
+    name: str,
     package: Any,
 ) -> List[_FlatpakSourceType]:
     repo_url = str(package['description']['url'])
-    split = repo_url.split('/')
-    name = split[len(split) - 1].split('.git')[0]
     commit = package['description']['resolved-ref']
     assert commit, 'The commit needs to be indicated in the description'
-    dest = f'.{PUB_CACHE}/git/{name}-{commit}'
+    path = str(package['description'].get('path', '.'))
+    assert not os.path.isabs(path) and not os.path.normpath(path).startswith('..'), \
+        f'The path of {name} needs to be inside the repo'
+    checkout = f'{_get_repo_name(repo_url)}-{commit}'
+    dest = f'.{PUB_CACHE}/git/{checkout}'
+
+    print(f'Adding package {name} from {repo_url} at {os.path.normpath(f"{dest}/{path}")}')
 
     sha1 = hashlib.sha1()
     sha1.update(repo_url.encode('utf-8'))
 
-    cache_path = f'{GIT_CACHE}/{name}-{sha1.hexdigest()}'
+    cache_path = f'{GIT_CACHE}/{_get_repo_name(repo_url)}-{sha1.hexdigest()}'
+    # The repo cache of pub is the git dir of the checkout, other commits of the
+    # same repo add their objects as alternates, instead of copying the objects
     commands = [
-        f'mkdir -p {cache_path}',
-        f'cp -rf {dest}/.git/* {cache_path}'
+        f'mkdir -p {GIT_CACHE}',
+        f'if [ ! -e {cache_path} ]; then ln -s ../{checkout}/.git {cache_path}; '
+        f'else echo "$PWD/{dest}/.git/objects" >> {cache_path}/objects/info/alternates; fi',
     ]
 
     git_sources: List[_FlatpakSourceType] = [
@@ -65,7 +148,7 @@ def _get_package_sources(
     source = package['source']
 
     if source == 'git':
-        return _get_git_package_sources(package)
+        return _get_git_package_sources(name, package)
 
     if source != 'hosted':
         return None
@@ -96,36 +179,82 @@ def _get_package_sources(
     return sources
 
 
-def generate_sources(
+def iter_package_sources(
     pubspec_paths: List[str],
-) -> List[_FlatpakSourceType]:
-    pubspec_sources = []
-    deduped = 0
-
+    seen: Set[str],
+    digests: Optional[LockDigests] = None,
+) -> Iterator[_FlatpakSourceType]:
+    'Yields the sources of the packages, without skipping duplicates'
     for path in pubspec_paths:
-        stream = open(path, 'r')
-        pubspec_lock = yaml.load(stream, Loader=yaml.FullLoader)
+        with open(path, 'r') as stream:
+            pubspec_lock = load_yaml(stream)
+
+        for name, package in pubspec_lock['packages'].items():
+            digest = get_digest([name, package])
+            sources = digests.get(digest) if digests is not None else None
+
+            if sources is None:
+                sources = _get_package_sources(name, package) or []
+
+            if digests is not None:
+                digests.set(digest, sources)
+
+            # Pub finds the package at its path inside the checkout of the whole
+            # repo, so all packages of a repo at the same commit share one checkout
+            repo_key = _get_repo_key(package)
+
+            if repo_key is not None:
+                if repo_key in seen:
+                    continue
+
+                seen.add(repo_key)
 
-        for name in pubspec_lock['packages']:
-            sources = _get_package_sources(name, pubspec_lock['packages'][name])
+            yield from sources
 
-            if sources is not None:
-                for source in sources:
-                    if source in pubspec_sources:
-                        deduped += 1
-                    else:
-                        pubspec_sources.append(source)
+
+def dedupe_sources(
+    sources: Iterable[_FlatpakSourceType],
+    seen: Set[str],
+) -> Iterator[_FlatpakSourceType]:
+    'Yields the sources, skipping sources that are already seen'
+    deduped = 0
+
+    for source in sources:
+        key = json.dumps(source, sort_keys=True)
+
+        if key in seen:
+            deduped += 1
+        else:
+            seen.add(key)
+            yield source
 
     print(f'Deduped {deduped} pubspec source entries')
+    metrics.inc('sources_deduped_total', deduped, generator='pubspec')
+
+
+def iter_sources(
+    pubspec_paths: List[str],
+    seen: Optional[Set[str]] = None,
+    digests: Optional[LockDigests] = None,
+) -> Iterator[_FlatpakSourceType]:
+    'Yields the sources of the packages, skipping sources that are already seen'
+    seen = seen if seen is not None else set()
 
-    return pubspec_sources
+    return dedupe_sources(iter_package_sources(pubspec_paths, seen, digests), seen)
 
 
-def main():
+def generate_sources(
+    pubspec_paths: List[str],
+) -> List[_FlatpakSourceType]:
+    return list(iter_sources(pubspec_paths))
+
+
+def main(argv: Optional[List[str]] = None):
     parser = argparse.ArgumentParser()
     parser.add_argument('pubspec_paths', help='Comma separated list of paths to pubspec.lock files')
     parser.add_argument('-o', '--output', required=False, help='Where to write generated sources')
-    args = parser.parse_args()
+    parser.add_argument('--incremental', action='store_true', help='Only process the packages changed since the last run for the same output')
+    args = parser.parse_args(argv)
 
     if args.output is not None:
         outfile = args.output
@@ -133,12 +262,15 @@ def main():
         outfile = 'pubspec-sources.json'
 
     pubspec_paths = str(args.pubspec_paths).split(',')
-    pubspec_sources = generate_sources(pubspec_paths)
+    digests = LockDigests(outfile) if args.incremental else None
 
     with open(outfile, 'w') as out:
-        json.dump(pubspec_sources, out, indent=4, sort_keys=False)
+        dump_json_array(iter_sources(pubspec_paths, digests=digests), out)
         out.write('\n')
 
+    if digests is not None:
+        digests.save()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+__license__ = 'MIT'
+import os
+import argparse
+import hashlib
+import json
+import sys
+import tempfile
+import toml
+import urllib.request
+
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+if __name__ == '__main__':
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fetch_scheduler.fetch_scheduler import get_scheduler
+from manifest_io.manifest_io import dump_json
+from metrics.metrics import get_host, metrics
+
+
+STATIC_URL = 'https://static.rust-lang.org'
+RUSTUP_VERSION = '1.27.1'
+DIST_PATH = 'static.rust-lang.org/dist'
+
+# Flatpak arch: Rust target
+TARGETS = {
+    'x86_64': 'x86_64-unknown-linux-gnu',
+    'aarch64': 'aarch64-unknown-linux-gnu',
+}
+
+# The components installed by the minimal profile
+COMPONENTS = ['cargo', 'rust-std', 'rustc']
+
+
+_FlatpakSourceType = Dict[str, Any]
+
+
+def _get_download_url(url: str) -> str:
+    # Same variable as used by rustup to download from a mirror
+    base_url = os.environ.get('RUSTUP_DIST_SERVER')
+
+    if base_url and url.startswith(STATIC_URL):
+        return base_url.rstrip('/') + url[len(STATIC_URL):]
+
+    return url
+
+
+def _get_cache_path(version: str, rustup_version: str) -> str:
+    cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+
+    return os.path.join(cache_dir, 'flatpak-flutter', 'rustup', f'rustup-{version}-{rustup_version}.json')
+
+
+def _download(url: str) -> bytes:
+    print(f'Downloading {url}...')
+
+    with urllib.request.urlopen(_get_download_url(url)) as response:
+        data = response.read()
+
+    metrics.inc('downloaded_bytes_total', len(data), host=get_host(url))
+
+    return data
+
+
+def _get_rustup_init_sha256(rustup_version: str, target: str) -> str:
+    url = f'{STATIC_URL}/rustup/archive/{rustup_version}/{target}/rustup-init.sha256'
+
+    return get_scheduler().run(url, _download, url).decode('utf-8').split()[0]
+
+
+def generate_rustup(
+    version: str,
+    rustup_version: str = RUSTUP_VERSION,
+    channel_path: Optional[str] = None,
+) -> _FlatpakSourceType:
+    'Generates the rustup module from the channel manifest, which has the sha256 of all components'
+    channel_name = f'channel-rust-{version}.toml'
+    channel_url = f'{STATIC_URL}/dist/{channel_name}'
+
+    if channel_path is not None:
+        with open(channel_path, 'rb') as input:
+            channel_data = input.read()
+    else:
+        channel_data = get_scheduler().run(channel_url, _download, channel_url)
+
+    channel_sha256 = hashlib.sha256(channel_data).hexdigest()
+    # The .sha256 file only holds the sha256 of the channel manifest, in sha256sum format
+    channel_sha256_sha256 = hashlib.sha256(f'{channel_sha256}  {channel_name}\n'.encode('utf-8')).hexdigest()
+    channel = toml.loads(channel_data.decode('utf-8'))
+    dist_dest = f'{DIST_PATH}/{channel["date"]}'
+
+    sources: list = []
+
+    for arch, target in TARGETS.items():
+        sources.append({
+            'type': 'file',
+            'only-arches': [
+                arch
+            ],
+            'url': f'{STATIC_URL}/rustup/archive/{rustup_version}/{target}/rustup-init',
+            'sha256': _get_rustup_init_sha256(rustup_version, target),
+            'dest-filename': 'rustup-init'
+        })
+
+    sources.append({
+        'type': 'file',
+        'url': channel_url,
+        'sha256': channel_sha256,
+        'dest': DIST_PATH
+    })
+    sources.append({
+        'type': 'file',
+        'url': f'{channel_url}.sha256',
+        'sha256': channel_sha256_sha256,
+        'dest': DIST_PATH
+    })
+
+    for arch, target in TARGETS.items():
+        for component in COMPONENTS:
+            package = channel['pkg'][component]['target'][target]
+            assert package.get('available'), f'{component} {version} is not available for {target}'
+
+            sources.append({
+                'type': 'file',
+                'only-arches': [
+                    arch
+                ],
+                'url': package.get('xz_url', package['url']),
+                'sha256': package.get('xz_hash', package['hash']),
+                'dest': dist_dest
+            })
+
+    return {
+        'name': 'rustup',
+        'buildsystem': 'simple',
+        'build-options': {
+            'env': {
+                'CARGO_HOME': '/var/lib/rustup',
+                'RUSTUP_HOME': '/var/lib/rustup',
+                'RUSTUP_DIST_SERVER': 'file:///run/build/rustup/static.rust-lang.org'
+            }
+        },
+        'build-commands': [
+            f'chmod +x rustup-init && ./rustup-init -y --default-toolchain {version} --profile minimal --no-modify-path',
+            f'ln -s /var/lib/rustup/toolchains/{version}-${{FLATPAK_ARCH}}-unknown-linux-gnu /var/lib/rustup/toolchains/stable-${{FLATPAK_ARCH}}-unknown-linux-gnu'
+        ],
+        'sources': sources
+    }
+
+
+def get_rustup(
+    version: str,
+    rustup_version: str = RUSTUP_VERSION,
+    channel_path: Optional[str] = None,
+) -> _FlatpakSourceType:
+    'Returns the rustup module, generated once per Rust and rustup version'
+    cache_path = _get_cache_path(version, rustup_version)
+    metrics.cache('rustup', hit=os.path.isfile(cache_path))
+
+    if os.path.isfile(cache_path):
+        print(f'Using cached rustup module of Rust {version}')
+
+        with open(cache_path, 'r') as input:
+            return json.load(input)
+
+    rustup = generate_rustup(version, rustup_version, channel_path)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(cache_path), delete=False) as out:
+        json.dump(rustup, out)
+
+    os.replace(out.name, cache_path)
+
+    return rustup
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('version', help='Rust version, e.g. 1.83.0')
+    parser.add_argument('-o', '--output', required=False, help='Where to write generated module')
+    parser.add_argument('--rustup-version', metavar='VERSION', default=RUSTUP_VERSION, help='Version of rustup-init to use')
+    parser.add_argument('--channel', metavar='PATH', required=False, help='Local copy of the channel manifest, instead of downloading it')
+    args = parser.parse_args(argv)
+
+    if args.output is not None:
+        outfile = args.output
+    else:
+        outfile = f'rustup-{args.version}.json'
+
+    rustup = generate_rustup(args.version, args.rustup_version, args.channel)
+
+    with open(outfile, 'w') as out:
+        dump_json(rustup, out)
+
+
+if __name__ == '__main__':
+    main()
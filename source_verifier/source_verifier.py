@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+__license__ = 'MIT'
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import urllib.request
+
+from concurrent.futures import as_completed
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+if __name__ == '__main__':
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fetch_scheduler.fetch_scheduler import DEFAULT_HOST_JOBS, DEFAULT_JOBS, configure, get_scheduler, parse_jobs
+from flutter_sdk_generator.flutter_sdk_generator import STORAGE_URL
+from rustup_generator.rustup_generator import STATIC_URL
+from metrics.metrics import get_host, metrics
+
+PUB_URL = 'https://pub.dev'
+CHUNK_SIZE = 1024 * 1024
+# Source types downloaded by flatpak-builder, checked by their sha256
+URL_SOURCE_TYPES = ['archive', 'file']
+# Environment variables the tools use to download from a mirror
+MIRROR_ENV = {
+    STORAGE_URL: 'FLUTTER_STORAGE_BASE_URL',
+    STATIC_URL: 'RUSTUP_DIST_SERVER',
+    PUB_URL: 'PUB_HOSTED_URL',
+}
+
+
+_FlatpakSourceType = Dict[str, Any]
+
+
+class Result(NamedTuple):
+    url: str
+    sha256: str
+    actual: Optional[str]
+    size: int
+    error: Optional[str]
+
+    @property
+    def ok(self) -> bool:
+        return self.actual == self.sha256
+
+
+def get_mirrors(mirrors: Optional[List[str]] = None) -> Dict[str, str]:
+    'Returns the mirror per URL prefix, from the environment and the PREFIX=URL mirrors'
+    mirror_map = {prefix: os.environ[env] for prefix, env in MIRROR_ENV.items() if os.environ.get(env)}
+
+    for mirror in mirrors or []:
+        prefix, _, url = mirror.partition('=')
+        assert url, f'{mirror} is not formatted as PREFIX=URL'
+        mirror_map[prefix] = url
+
+    return mirror_map
+
+
+def _get_download_url(url: str, mirrors: Dict[str, str]) -> str:
+    # The longest prefix is the most specific mirror
+    for prefix in sorted(mirrors, key=len, reverse=True):
+        if url.startswith(prefix):
+            return mirrors[prefix].rstrip('/') + url[len(prefix.rstrip('/')):]
+
+    return url
+
+
+def iter_url_sources(manifest: Any) -> Iterator[_FlatpakSourceType]:
+    'Yields the sources with a URL, from a list of sources or a module with nested modules'
+    if isinstance(manifest, list):
+        for item in manifest:
+            yield from iter_url_sources(item)
+    elif isinstance(manifest, dict):
+        if manifest.get('type') in URL_SOURCE_TYPES and 'url' in manifest:
+            yield manifest
+
+        for key in ['sources', 'modules']:
+            yield from iter_url_sources(manifest.get(key, []))
+
+
+def _verify_source(url: str, download_url: str, sha256: str) -> Result:
+    digest = hashlib.sha256()
+    size = 0
+
+    # Stream the download, only the hash state is kept in memory
+    with urllib.request.urlopen(download_url) as response:
+        for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+            metrics.inc('downloaded_bytes_total', len(chunk), host=get_host(download_url))
+
+    return Result(url, sha256, digest.hexdigest(), size, None)
+
+
+def verify_sources(
+    paths: List[str],
+    mirrors: Optional[Dict[str, str]] = None,
+) -> List[Result]:
+    'Downloads the URL sources in the generated manifests at paths in parallel, checking their sha256'
+    mirrors = mirrors if mirrors is not None else get_mirrors()
+    urls: Dict[Tuple[str, str], None] = {}
+    skipped = 0
+
+    for path in paths:
+        with open(path, 'r') as input:
+            for source in iter_url_sources(json.load(input)):
+                if 'sha256' in source:
+                    urls[(source['url'], source['sha256'])] = None
+                else:
+                    skipped += 1
+
+    if skipped:
+        print(f'Skipped {skipped} sources without sha256')
+
+    scheduler = get_scheduler()
+    futures = {}
+
+    for url, sha256 in urls:
+        # The per host limit applies to the mirror actually downloaded from
+        download_url = _get_download_url(url, mirrors)
+        future = scheduler.submit(download_url, _verify_source, url, download_url, sha256, cancel_on_error=False)
+        futures[future] = (url, sha256)
+
+    results = []
+
+    for future in as_completed(futures):
+        url, sha256 = futures[future]
+
+        try:
+            result = future.result()
+        except Exception as e:
+            result = Result(url, sha256, None, 0, str(e))
+
+        metrics.inc('verified_sources_total', result='ok' if result.ok else 'mismatch' if result.error is None else 'error')
+
+        if result.error is not None:
+            print(f'Error: {url}: {result.error}')
+        elif not result.ok:
+            print(f'Mismatch: {url}\n  expected {sha256}\n  got      {result.actual}')
+
+        results.append(result)
+
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='+', metavar='PATH', help='Generated sources or module to verify')
+    parser.add_argument('-j', '--jobs', metavar='N', type=parse_jobs, default=DEFAULT_JOBS, help='Maximum number of parallel downloads')
+    parser.add_argument('--mirror', metavar='PREFIX=URL', action='append', help='Download URLs starting with PREFIX from URL instead')
+    args = parser.parse_args(argv)
+
+    configure(jobs=args.jobs, host_jobs=min(args.jobs, DEFAULT_HOST_JOBS))
+    start = time.perf_counter()
+    results = verify_sources(args.paths, get_mirrors(args.mirror))
+    elapsed = time.perf_counter() - start
+    size = sum(result.size for result in results)
+    failed = [result for result in results if not result.ok]
+
+    print(f'Verified {len(results)} sources, {size / 1e6:.1f} MB in {elapsed:.1f}s '
+          f'({size / 1e6 / max(elapsed, 1e-6):.1f} MB/s), {len(failed)} failed')
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,193 @@
+__license__ = 'MIT'
+import hashlib
+import http.server
+import importlib.util
+import json
+import os
+import subprocess
+import threading
+import time
+
+from pathlib import Path
+from types import ModuleType
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+import pytest
+
+from fetch_scheduler.fetch_scheduler import Scheduler, use_scheduler
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def sha256(data: Union[str, bytes]) -> str:
+    return hashlib.sha256(data.encode('utf-8') if isinstance(data, str) else data).hexdigest()
+
+
+def read_json(path) -> Any:
+    with open(path, 'r') as input:
+        return json.load(input)
+
+
+def write_json(path, data: Any) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, 'w') as out:
+        json.dump(data, out)
+
+    return str(path)
+
+
+def write_files(path, files: Dict[str, str]):
+    'Writes the files, by their path relative to path'
+    for name, contents in files.items():
+        os.makedirs(os.path.dirname(os.path.join(path, name)), exist_ok=True)
+
+        with open(os.path.join(path, name), 'w') as out:
+            out.write(contents)
+
+
+def cargo_lock(packages: List[Dict[str, str]]) -> str:
+    'Returns a Cargo.lock with the packages, by their keys'
+    lock = 'version = 3\n'
+
+    for package in packages:
+        lock += '\n[[package]]\n' + ''.join(f'{key} = "{value}"\n' for key, value in package.items())
+
+    return lock
+
+
+def make_repo(path, files: Dict[str, str], tag: Optional[str] = None) -> str:
+    'Commits the files to a new or existing git repo at path, returning the commit'
+    write_files(path, files)
+
+    if not os.path.isdir(os.path.join(path, '.git')):
+        subprocess.run(['git', 'init', '--quiet', str(path)], check=True)
+
+    subprocess.run(['git', '-C', str(path), 'add', '-A'], check=True)
+    subprocess.run(
+        ['git', '-C', str(path), '-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '--quiet',
+         '--allow-empty', '-m', 'commit'],
+        check=True,
+    )
+
+    if tag is not None:
+        subprocess.run(['git', '-C', str(path), 'tag', tag], check=True)
+
+    return subprocess.run(
+        ['git', '-C', str(path), 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, check=True,
+    ).stdout.decode('utf-8').strip()
+
+
+class _File(NamedTuple):
+    body: bytes
+    etag: Optional[str] = None
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # Keeps the connection open, like the registry hosts
+    protocol_version = 'HTTP/1.1'
+    server: '_Server'
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        file = self.server.files.get(self.path.split('?', 1)[0])
+
+        with self.server.lock:
+            self.server.running += 1
+            self.server.peak = max(self.server.peak, self.server.running)
+
+        # Answers slowly, when set, so concurrent requests overlap
+        time.sleep(self.server.delay)
+
+        with self.server.lock:
+            self.server.running -= 1
+
+        if file is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif file.etag is not None and self.headers.get('If-None-Match') == file.etag:
+            self.send_response(304)
+            self.send_header('ETag', file.etag)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(file.body)))
+
+            if file.etag is not None:
+                self.send_header('ETag', file.etag)
+
+            self.end_headers()
+            self.wfile.write(file.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.files: Dict[str, _File] = {}
+        self.requests: List[Tuple[str, Dict[str, str]]] = []
+        self.delay = 0.0
+        self.lock = threading.Lock()
+        self.running = 0
+        # The most requests handled at the same time
+        self.peak = 0
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def add(self, path: str, body: bytes, etag: Optional[str] = None):
+        self.files[path] = _File(body, etag)
+
+    def requested(self) -> List[str]:
+        return [path for path, _ in self.requests]
+
+
+@pytest.fixture
+def server() -> Iterator[_Server]:
+    'A local HTTP server serving the files added to it'
+    server = _Server()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def scheduler() -> Iterator[Scheduler]:
+    'A scheduler of its own per test, so a failing test doesn\'t cancel the others'
+    scheduler = Scheduler(retries=0)
+
+    with use_scheduler(scheduler):
+        yield scheduler
+
+    scheduler.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch) -> str:
+    'Keeps the caches of the generators out of the home dir'
+    path = str(tmp_path / 'cache')
+    monkeypatch.setenv('XDG_CACHE_HOME', path)
+
+    return path
+
+
+@pytest.fixture(scope='session')
+def flatpak_flutter() -> ModuleType:
+    'The flatpak-flutter script, which can\'t be imported by its name'
+    spec = importlib.util.spec_from_file_location('flatpak_flutter', ROOT / 'flatpak-flutter.py')
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
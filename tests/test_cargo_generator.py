@@ -0,0 +1,105 @@
+__license__ = 'MIT'
+import asyncio
+import json
+
+import pytest
+
+from conftest import cargo_lock, sha256, write_files
+from cargo_generator.cargo_generator import _fetch_index_file, _get_download_url, _get_index_path, generate_sources
+
+
+def _index_file(name: str, version: str, checksum: str) -> bytes:
+    entries = [
+        {'name': name, 'vers': '0.0.1', 'cksum': sha256('old'), 'deps': [], 'features': {}},
+        {'name': name, 'vers': version, 'cksum': checksum, 'deps': [], 'features': {}},
+    ]
+
+    return ''.join(f'{json.dumps(entry)}\n' for entry in entries).encode('utf-8')
+
+
+def _write_lock(path, source: str, packages) -> str:
+    write_files(path, {'Cargo.lock': cargo_lock([
+        {'name': name, 'version': version, 'source': source, 'checksum': checksum}
+        for name, version, checksum in packages
+    ])})
+
+    return str(path / 'Cargo.lock')
+
+
+def _archive_urls(sources):
+    return {source['dest']: (source['url'], source['sha256']) for source in sources if source['type'] == 'archive'}
+
+
+@pytest.mark.parametrize('name, path', [
+    ('a', '1/a'),
+    ('ab', '2/ab'),
+    ('abc', '3/a/abc'),
+    ('serde', 'se/rd/serde'),
+])
+def test_index_path(name, path):
+    assert _get_index_path(name) == path
+
+
+@pytest.mark.parametrize('dl, url', [
+    ('https://dl.example', 'https://dl.example/MyCrate/1.0.0/download'),
+    ('https://dl.example/{crate}-{version}.crate', 'https://dl.example/MyCrate-1.0.0.crate'),
+    ('https://dl.example/{prefix}/{crate}', 'https://dl.example/My/Cr/MyCrate'),
+    ('https://dl.example/{lowerprefix}/{crate}', 'https://dl.example/my/cr/MyCrate'),
+    ('https://dl.example/{sha256-checksum}', f"https://dl.example/{'0' * 64}"),
+])
+def test_download_url(dl, url):
+    assert _get_download_url(dl, 'MyCrate', '1.0.0', '0' * 64) == url
+
+
+def test_sparse_registry(server, scheduler, tmp_path):
+    source = f'sparse+{server.url}/index/'
+    packages = [(name, '1.0.0', sha256(name)) for name in ['a', 'ab', 'abc', 'MyCrate']]
+    server.add('/index/config.json', json.dumps({'dl': f'{server.url}/dl/{{lowerprefix}}/{{crate}}/{{sha256-checksum}}'}).encode())
+
+    for name, version, checksum in packages:
+        server.add(f'/index/{_get_index_path(name.lower())}', _index_file(name, version, checksum))
+
+    lock_path = _write_lock(tmp_path, source, packages)
+    sources = asyncio.run(generate_sources([lock_path]))
+
+    assert _archive_urls(sources) == {
+        'cargo/vendor/a-1.0.0': (f"{server.url}/dl/1/a/{sha256('a')}", sha256('a')),
+        'cargo/vendor/ab-1.0.0': (f"{server.url}/dl/2/ab/{sha256('ab')}", sha256('ab')),
+        'cargo/vendor/abc-1.0.0': (f"{server.url}/dl/3/a/abc/{sha256('abc')}", sha256('abc')),
+        'cargo/vendor/MyCrate-1.0.0': (f"{server.url}/dl/my/cr/MyCrate/{sha256('MyCrate')}", sha256('MyCrate')),
+    }
+    assert sorted(server.requested()) == [
+        '/index/1/a', '/index/2/ab', '/index/3/a/abc', '/index/config.json', '/index/my/cr/mycrate',
+    ]
+    assert f'registry = "{source}"' in sources[-1]['contents']
+
+
+def test_index_etag(server, scheduler):
+    url = f'{server.url}/index/se/rd/serde'
+    body = _index_file('serde', '1.0.0', sha256('serde'))
+    server.add('/index/se/rd/serde', body, etag='"v1"')
+
+    assert _fetch_index_file(url) == body
+    assert _fetch_index_file(url) == body
+
+    (_, first), (_, second) = server.requests
+    assert 'If-None-Match' not in first
+    assert second['If-None-Match'] == '"v1"'
+
+    # A changed file replaces the cached copy and its ETag
+    changed = _index_file('serde', '1.0.1', sha256('serde'))
+    server.add('/index/se/rd/serde', changed, etag='"v2"')
+
+    assert _fetch_index_file(url) == changed
+    assert _fetch_index_file(url) == changed
+    assert server.requests[-1][1]['If-None-Match'] == '"v2"'
+
+
+def test_checksum_mismatch(server, scheduler, tmp_path):
+    source = f'sparse+{server.url}/index/'
+    server.add('/index/config.json', json.dumps({'dl': f'{server.url}/dl'}).encode())
+    server.add('/index/3/a/abc', _index_file('abc', '1.0.0', sha256('index')))
+    lock_path = _write_lock(tmp_path, source, [('abc', '1.0.0', sha256('lock'))])
+
+    with pytest.raises(ValueError, match='abc 1.0.0 differs'):
+        asyncio.run(generate_sources([lock_path]))
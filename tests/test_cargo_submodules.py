@@ -0,0 +1,96 @@
+__license__ = 'MIT'
+import asyncio
+import os
+import subprocess
+
+import pytest
+import toml
+
+from conftest import cargo_lock, make_repo, write_files
+from cargo_generator import cargo_generator
+from cargo_generator.cargo_generator import _get_clone_dir, _scan_git_repo, generate_sources
+
+GIT_URL = 'https://git.example.invalid/main'
+
+
+def _add_submodule(repo_path, url: str, path: str) -> str:
+    subprocess.run(
+        ['git', '-C', str(repo_path), 'submodule', 'add', '--quiet', url, path],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+    return make_repo(repo_path, {})
+
+
+@pytest.fixture
+def git_file_protocol(monkeypatch):
+    'Allows local submodules, and clones the main repo by its URL from a local path'
+    def allow(upstream):
+        config = {
+            'protocol.file.allow': 'always',
+            f'url.file://{upstream}/.insteadOf': 'https://git.example.invalid/',
+        }
+        monkeypatch.setenv('GIT_CONFIG_COUNT', str(len(config)))
+
+        for idx, (key, value) in enumerate(config.items()):
+            monkeypatch.setenv(f'GIT_CONFIG_KEY_{idx}', key)
+            monkeypatch.setenv(f'GIT_CONFIG_VALUE_{idx}', value)
+
+    return allow
+
+
+def test_lazy_nested_submodules(tmp_path, scheduler, git_file_protocol, monkeypatch):
+    upstream = tmp_path / 'upstream'
+    git_file_protocol(upstream)
+    make_repo(upstream / 'a', {'Cargo.toml': '[package]\nname = "a"\nversion = { workspace = true }\n'})
+    make_repo(upstream / 'inner', {'Cargo.toml': '[package]\nname = "inner"\nversion = "0.3.0"\n'})
+    make_repo(upstream / 'outer', {'README': 'No crates\n'})
+    _add_submodule(upstream / 'outer', f'{upstream}/inner', 'inner')
+    make_repo(upstream / 'big', {'Cargo.toml': '[package]\nname = "big"\nversion = "1.0.0"\n', 'data': 'x' * 1000})
+    make_repo(upstream / 'main', {
+        'Cargo.toml': '[workspace]\nmembers = ["crates/a", "vendor/outer/inner"]\n\n'
+                      '[workspace.package]\nversion = "0.2.0"\n',
+    })
+    _add_submodule(upstream / 'main', f'{upstream}/a', 'crates/a')
+    _add_submodule(upstream / 'main', f'{upstream}/outer', 'vendor/outer')
+    commit = _add_submodule(upstream / 'main', f'{upstream}/big', 'vendor/big')
+
+    source = f'git+{GIT_URL}?rev={commit[:7]}#{commit}'
+    lock_path = tmp_path / 'Cargo.lock'
+    lock_path.write_text(cargo_lock([
+        {'name': name, 'version': version, 'source': source} for name, version in [('a', '0.2.0'), ('inner', '0.3.0')]
+    ]))
+
+    scanned = []
+
+    def scan_git_repo(git_repo_dir, packages, references, root_dir='.'):
+        scanned.append(root_dir)
+        _scan_git_repo(git_repo_dir, packages, references, root_dir)
+
+    monkeypatch.setattr(cargo_generator, '_scan_git_repo', scan_git_repo)
+    sources = asyncio.run(generate_sources([str(lock_path)]))
+    cargo_tomls = {
+        source['dest']: toml.loads(source['contents'])
+        for source in sources if source.get('dest-filename') == 'Cargo.toml'
+    }
+    clone_dir = _get_clone_dir(GIT_URL)
+
+    # The version of a is inherited from the workspace of the repo holding the submodule
+    assert cargo_tomls == {
+        'cargo/vendor/a': {'package': {'name': 'a', 'version': '0.2.0'}},
+        'cargo/vendor/inner': {'package': {'name': 'inner', 'version': '0.3.0'}},
+    }
+    # Only the submodules holding the locked crates are initialized, and only these are scanned again
+    assert os.listdir(os.path.join(clone_dir, 'vendor', 'big')) == []
+    assert sorted(scanned) == ['.', 'crates/a', 'vendor/outer', 'vendor/outer/inner']
+
+
+def test_scan_skips_git_dirs(tmp_path):
+    write_files(tmp_path, {
+        'Cargo.toml': '[package]\nname = "main"\nversion = "1.0.0"\n',
+        '.git/modules/sub/Cargo.toml': '[package]\nname = "not-a-crate"\nversion = "1.0.0"\n',
+    })
+    packages = {}
+    _scan_git_repo(str(tmp_path), packages, set())
+
+    assert list(packages) == ['main']
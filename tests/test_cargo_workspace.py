@@ -0,0 +1,112 @@
+__license__ = 'MIT'
+import toml
+
+from conftest import write_files
+from cargo_generator.cargo_generator import _scan_git_repo
+
+WORKSPACE = {
+    'Cargo.toml': '''
+[workspace]
+members = ["crates/app", "crates/shared"]
+
+[workspace.package]
+version = "1.2.3"
+edition = "2021"
+license = "MIT"
+readme = "README.md"
+license-file = "LICENSE"
+
+[workspace.dependencies]
+serde = { version = "1.0", features = ["derive"] }
+log = "0.4"
+shared = { path = "crates/shared", version = "1.2.3" }
+
+[workspace.lints.rust]
+unsafe_code = "forbid"
+''',
+    'crates/app/Cargo.toml': '''
+[package]
+name = "app"
+description = "Not inherited"
+version = { workspace = true }
+edition = { workspace = true }
+license = { workspace = true }
+readme = { workspace = true }
+license-file = { workspace = true }
+
+[dependencies]
+serde = { workspace = true, features = ["rc"] }
+log = { workspace = true }
+shared = { workspace = true }
+anyhow = "1.0"
+
+[dev-dependencies]
+log = { workspace = true, features = ["std"] }
+
+[target.'cfg(unix)'.dependencies]
+serde = { workspace = true, features = ["std"] }
+
+[lints]
+workspace = true
+''',
+    'crates/shared/Cargo.toml': '''
+[package]
+name = "shared"
+version = { workspace = true }
+readme = "README.md"
+''',
+}
+
+
+def _resolve(tmp_path):
+    write_files(tmp_path, WORKSPACE)
+    packages = {}
+    references = set()
+    _scan_git_repo(str(tmp_path), packages, references)
+
+    # As written to the vendored crate
+    return {name: toml.loads(toml.dumps(package.normalized)) for name, package in packages.items()}, references
+
+
+def test_package_inheritance(tmp_path):
+    packages, references = _resolve(tmp_path)
+
+    assert references == {'crates/app', 'crates/shared'}
+    assert packages['app']['package'] == {
+        'name': 'app',
+        'description': 'Not inherited',
+        'version': '1.2.3',
+        'edition': '2021',
+        'license': 'MIT',
+        # Paths are relative to the workspace root, rebased to the member
+        'readme': '../../README.md',
+        'license-file': '../../LICENSE',
+    }
+    # Paths of the member itself stay relative to the member
+    assert packages['shared']['package'] == {'name': 'shared', 'version': '1.2.3', 'readme': 'README.md'}
+
+
+def test_dependency_inheritance(tmp_path):
+    packages, _ = _resolve(tmp_path)
+    app = packages['app']
+
+    assert app['dependencies'] == {
+        # Features are added to the ones of the workspace
+        'serde': {'version': '1.0', 'features': ['rc', 'derive']},
+        'log': '0.4',
+        'shared': {'path': '../shared', 'version': '1.2.3'},
+        'anyhow': '1.0',
+    }
+    assert app['dev-dependencies'] == {'log': {'version': '0.4', 'features': ['std']}}
+    assert app['target'] == {
+        'cfg(unix)': {'dependencies': {'serde': {'version': '1.0', 'features': ['std', 'derive']}}},
+    }
+    assert app['lints'] == {'rust': {'unsafe_code': 'forbid'}}
+
+
+def test_no_workspace(tmp_path):
+    write_files(tmp_path, {'Cargo.toml': '[package]\nname = "single"\nversion = "0.1.0"\n'})
+    packages = {}
+    _scan_git_repo(str(tmp_path), packages, set())
+
+    assert packages['single'].normalized == {'package': {'name': 'single', 'version': '0.1.0'}}
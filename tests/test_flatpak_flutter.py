@@ -0,0 +1,101 @@
+__license__ = 'MIT'
+import os
+
+import pytest
+import toml
+
+from conftest import cargo_lock, write_files, write_json
+from flutter_sdk_generator.flutter_sdk_generator import MISSING_ARCHES_KEY
+from flutter_tools_generator.flutter_tools_generator import PACKAGE_CONFIG_FILE, SOURCES_FILE, has_flutter_tools
+
+TAG = '3.99.0'
+
+
+@pytest.fixture
+def releases(tmp_path) -> str:
+    'A release dir with prebuilt flutter_tools sources, but no SDK module'
+    path = tmp_path / 'releases'
+    (path / 'flutter' / TAG).mkdir(parents=True)
+
+    for name in [SOURCES_FILE, PACKAGE_CONFIG_FILE]:
+        (path / 'flutter' / TAG / name).write_text('[]\n')
+
+    assert has_flutter_tools(str(path / 'flutter' / TAG))
+
+    return str(path)
+
+
+def test_sdk_origin(flatpak_flutter, releases, tmp_path):
+    work_dir = str(tmp_path / 'work')
+    shared_path = str(tmp_path / 'shared')
+    os.makedirs(work_dir)
+
+    # Without any module, it is generated from the checkout, which needs flutter to run
+    assert flatpak_flutter._get_sdk_origin(TAG, releases, None, False, work_dir)[1] == 'generate'
+    assert flatpak_flutter._get_sdk_origin(TAG, releases, shared_path, False, work_dir)[1] == 'generate'
+
+    write_json(f'{shared_path}/flutter-sdk-{TAG}.json', {'name': 'flutter', 'sources': []})
+    assert flatpak_flutter._get_sdk_origin(TAG, releases, shared_path, False, work_dir)[1] == 'shared'
+
+    write_json(f'{work_dir}/flutter-sdk-{TAG}.json', {'name': 'flutter', 'sources': [], MISSING_ARCHES_KEY: ['aarch64']})
+    assert flatpak_flutter._get_sdk_origin(TAG, releases, None, False, work_dir)[1] == 'complete'
+    assert flatpak_flutter._get_sdk_origin(TAG, releases, None, True, work_dir)[1] == 'generate'
+
+    write_json(f'{releases}/flutter/{TAG}/flutter-sdk.json', {'name': 'flutter', 'sources': []})
+    assert flatpak_flutter._get_sdk_origin(TAG, releases, None, True, work_dir)[1] == 'release'
+
+
+def test_forwarded_env(flatpak_flutter, monkeypatch):
+    monkeypatch.setenv('FLUTTER_STORAGE_BASE_URL', 'http://daemon.invalid')
+    monkeypatch.setenv('GIT_CONFIG_COUNT', '1')
+    monkeypatch.setenv('HOME', '/daemon')
+    client_env = {
+        'PUB_HOSTED_URL': 'http://client.invalid',
+        'GIT_CONFIG_GLOBAL': '/client/gitconfig',
+        'HOME': '/client',
+    }
+
+    with flatpak_flutter._use_forwarded_env(flatpak_flutter._get_forwarded_env(client_env)):
+        # The variables of the daemon are replaced, not merged with the ones of the client
+        assert 'FLUTTER_STORAGE_BASE_URL' not in os.environ
+        assert 'GIT_CONFIG_COUNT' not in os.environ
+        assert os.environ['PUB_HOSTED_URL'] == 'http://client.invalid'
+        assert os.environ['GIT_CONFIG_GLOBAL'] == '/client/gitconfig'
+        assert os.environ['HOME'] == '/daemon'
+
+    assert os.environ['FLUTTER_STORAGE_BASE_URL'] == 'http://daemon.invalid'
+    assert os.environ['GIT_CONFIG_COUNT'] == '1'
+    assert 'PUB_HOSTED_URL' not in os.environ or os.environ['PUB_HOSTED_URL'] != 'http://client.invalid'
+
+
+def test_cargo_metadata(flatpak_flutter, tmp_path):
+    work_dir = tmp_path / 'work'
+    commit = 'abcdef0'.ljust(40, '0')
+    source = f'git+https://github.com/example/lib?rev=abcdef0#{commit}'
+    # A checkout made by cargo, the repo isn't cloned
+    checkout = tmp_path / 'cargo' / 'git' / 'checkouts' / 'lib-0123456789abcdef' / 'abcdef0'
+    write_files(checkout, {
+        '.cargo-ok': '',
+        'Cargo.toml': '[workspace]\nmembers = ["lib"]\n\n[workspace.package]\nversion = "0.2.0"\n',
+        'lib/Cargo.toml': '[package]\nname = "lib"\nversion = { workspace = true }\n',
+    })
+    write_files(work_dir / '.flatpak-builder' / 'build' / 'app' / 'rust', {
+        'Cargo.lock': cargo_lock([{'name': 'lib', 'version': '0.2.0', 'source': source}]),
+    })
+    write_files(tmp_path / 'releases', {'rust/1.83.0/rustup.json': '{}'})
+    metadata_path = write_json(work_dir / 'metadata.json', {
+        'packages': [{'name': 'lib', 'source': source, 'manifest_path': str(checkout / 'lib' / 'Cargo.toml')}],
+    })
+
+    outputs = flatpak_flutter._generate_cargo_sources(
+        'app', 'rust', str(tmp_path / 'releases'), '1.83.0', None, None, False, str(work_dir), metadata_path,
+    )
+    sources = outputs[os.path.join(str(work_dir), 'cargo-sources.json')]
+    [cargo_toml] = [
+        source for source in sources
+        if source.get('dest-filename') == 'Cargo.toml' and source['dest'] == 'cargo/vendor/lib'
+    ]
+
+    assert {'type': 'git', 'url': 'https://github.com/example/lib', 'commit': commit,
+            'dest': 'flatpak-cargo/git/lib-abcdef0'} in sources
+    assert toml.loads(cargo_toml['contents']) == {'package': {'name': 'lib', 'version': '0.2.0'}}
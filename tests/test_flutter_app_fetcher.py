@@ -0,0 +1,83 @@
+__license__ = 'MIT'
+import os
+
+from conftest import make_repo
+from flutter_app_fetcher.flutter_app_fetcher import FLUTTER_GIT_URL, _group_patches, _process_sources
+
+TAG = '3.99.0'
+
+FLUTTER_PATCH = '''diff --git a/bin/internal/shared.sh b/bin/internal/shared.sh
+--- a/bin/internal/shared.sh
++++ b/bin/internal/shared.sh
+@@ -1 +1 @@
+-a
++b
+'''
+
+# Changes the app and, after the Flutter patch, the Flutter repo nested in it
+APP_PATCH = '''diff --git a/flutter/bin/internal/shared.sh b/flutter/bin/internal/shared.sh
+--- a/flutter/bin/internal/shared.sh
++++ b/flutter/bin/internal/shared.sh
+@@ -1 +1 @@
+-b
++c
+diff --git a/lib/main.dart b/lib/main.dart
+--- a/lib/main.dart
++++ b/lib/main.dart
+@@ -1 +1 @@
+-a
++b
+'''
+
+
+def test_group_patches():
+    patches = [
+        ('app.patch', 'app.patch', '', ['lib/main.dart']),
+        ('shared.flutter.patch', 'shared.flutter.patch', 'flutter', ['flutter/bin/internal/shared.sh']),
+        ('plugin.patch', 'plugin.patch', 'plugin', ['plugin/lib/plugin.dart']),
+        ('cross.patch', 'cross.patch', '', ['flutter/bin/internal/shared.sh', 'lib/main.dart']),
+    ]
+    groups = _group_patches(patches, 'build', ['build', 'build/flutter', 'build/plugin'])
+
+    assert groups == [
+        ({'build/plugin'}, [('plugin.patch', 'plugin.patch', 'build/plugin')]),
+        ({'build', 'build/flutter'}, [
+            ('app.patch', 'app.patch', 'build'),
+            ('shared.flutter.patch', 'shared.flutter.patch', 'build/flutter'),
+            ('cross.patch', 'cross.patch', 'build'),
+        ]),
+    ]
+
+
+def test_cross_repo_patch(tmp_path, scheduler, monkeypatch):
+    upstream = tmp_path / 'upstream'
+    make_repo(upstream / 'flutter.git', {'bin/internal/shared.sh': 'a\n'}, tag=TAG)
+    app_commit = make_repo(upstream / 'app', {'pubspec.yaml': 'name: app\n', 'lib/main.dart': 'a\n'})
+    # Clones the Flutter repo from upstream instead
+    monkeypatch.setenv('GIT_CONFIG_COUNT', '1')
+    monkeypatch.setenv('GIT_CONFIG_KEY_0', f'url.file://{upstream}/.insteadOf')
+    monkeypatch.setenv('GIT_CONFIG_VALUE_0', 'https://github.com/flutter/')
+
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    (work_dir / 'shared.flutter.patch').write_text(FLUTTER_PATCH)
+    (work_dir / 'app.patch').write_text(APP_PATCH)
+    module = {
+        'name': 'app',
+        'sources': [
+            {'type': 'git', 'url': f'file://{upstream}/app', 'commit': app_commit},
+            {'type': 'git', 'url': FLUTTER_GIT_URL, 'tag': TAG, 'dest': 'flutter'},
+            {'type': 'patch', 'path': 'shared.flutter.patch', 'dest': 'flutter'},
+            {'type': 'patch', 'path': 'app.patch'},
+        ],
+    }
+    fetch_path = str(tmp_path / 'build' / 'app-1')
+
+    assert _process_sources(module, fetch_path, str(tmp_path / 'releases'), None, None, None, None, str(work_dir)) == TAG
+
+    # The app patch is applied after the Flutter patch, as in the manifest
+    with open(os.path.join(fetch_path, 'flutter/bin/internal/shared.sh'), 'r') as input:
+        assert input.read() == 'c\n'
+
+    with open(os.path.join(fetch_path, 'lib/main.dart'), 'r') as input:
+        assert input.read() == 'b\n'
@@ -0,0 +1,80 @@
+__license__ = 'MIT'
+import yaml
+
+from conftest import cargo_lock, read_json, sha256
+from cargo_generator import cargo_generator
+from pubspec_generator import pubspec_generator
+
+
+def _pubspec_lock(versions):
+    packages = {
+        name: {
+            'dependency': 'transitive',
+            'description': {'name': name, 'sha256': sha256(f'{name}-{version}'), 'url': 'https://pub.dev'},
+            'source': 'hosted',
+            'version': version,
+        }
+        for name, version in versions.items()
+    }
+    packages['plugin'] = {
+        'dependency': 'direct main',
+        'description': {
+            'path': 'plugin', 'ref': 'main', 'resolved-ref': 'a' * 40, 'url': 'https://github.com/example/plugins.git',
+        },
+        'source': 'git',
+        'version': '1.0.0',
+    }
+    packages['local'] = {
+        'dependency': 'direct main',
+        'description': {'path': '../local', 'relative': True},
+        'source': 'path',
+        'version': '0.0.1',
+    }
+
+    return yaml.safe_dump({'packages': packages, 'sdks': {'dart': '>=3.0.0 <4.0.0'}})
+
+
+def _cargo_lock(versions):
+    return cargo_lock([
+        {
+            'name': name,
+            'version': version,
+            'source': 'registry+https://github.com/rust-lang/crates.io-index',
+            'checksum': sha256(f'{name}-{version}'),
+        }
+        for name, version in versions.items()
+    ] + [{'name': 'app', 'version': '0.1.0'}])
+
+
+def _check_incremental(tmp_path, lock_name, make_lock, main):
+    'Generates, updates one lock entry, and compares the incremental update to a full generation'
+    versions = {name: '1.0.0' for name in ['alpha', 'beta', 'gamma', 'delta']}
+    lock_path = tmp_path / lock_name
+    incremental_path = tmp_path / 'incremental.json'
+    full_path = tmp_path / 'full.json'
+
+    lock_path.write_text(make_lock(versions))
+    main([str(lock_path), '-o', str(incremental_path), '--incremental'])
+    first = read_json(incremental_path)
+
+    versions['gamma'] = '1.1.0'
+    lock_path.write_text(make_lock(versions))
+    main([str(lock_path), '-o', str(incremental_path), '--incremental'])
+    main([str(lock_path), '-o', str(full_path)])
+
+    assert read_json(incremental_path) == read_json(full_path)
+    assert read_json(incremental_path) != first
+    assert incremental_path.read_text() == full_path.read_text()
+
+
+def test_pubspec_incremental(tmp_path, capsys):
+    _check_incremental(tmp_path, 'pubspec.lock', _pubspec_lock, pubspec_generator.main)
+
+    # Only the updated entry is processed again
+    assert 'Reused the sources of 5 of 6 lock entries' in capsys.readouterr().out
+
+
+def test_cargo_incremental(tmp_path, capsys):
+    _check_incremental(tmp_path, 'Cargo.lock', _cargo_lock, cargo_generator.main)
+
+    assert 'Reused the sources of 4 of 5 lock entries' in capsys.readouterr().out
@@ -0,0 +1,169 @@
+__license__ = 'MIT'
+import os
+import subprocess
+
+import pytest
+
+from conftest import make_repo, sha256, write_files
+from pubspec_generator.pubspec_generator import (
+    generate_sources, get_workspace_members, get_workspace_root, iter_package_sources,
+)
+
+TAG = '3.99.0'
+
+
+def _hosted(name: str, version: str = '1.0.0') -> str:
+    return (
+        f'  {name}:\n'
+        f'    dependency: transitive\n'
+        f'    description:\n'
+        f'      name: {name}\n'
+        f'      sha256: "{sha256(name)}"\n'
+        f'      url: "https://pub.dev"\n'
+        f'    source: hosted\n'
+        f'    version: "{version}"\n'
+    )
+
+
+def _lock(*packages: str) -> str:
+    return 'packages:\n' + ''.join(packages)
+
+
+# A workspace with a nested workspace, which shares the lock of the outer one
+WORKSPACE = {
+    'pubspec.yaml': 'name: root\nworkspace:\n  - packages/ui\n  - packages/core\n',
+    'pubspec.lock': _lock(_hosted('http')),
+    'packages/ui/pubspec.yaml': 'name: ui\nresolution: workspace\n',
+    'packages/core/pubspec.yaml': 'name: core\nresolution: workspace\nworkspace:\n  - plugins/*\n',
+    'packages/core/plugins/p1/pubspec.yaml': 'name: p1\nresolution: workspace\n',
+    'packages/core/plugins/p2/pubspec.yaml': 'name: p2\nresolution: workspace\n',
+    'tools/gen/pubspec.yaml': 'name: gen\n',
+    'tools/gen/pubspec.lock': _lock(_hosted('args')),
+}
+
+
+def test_nested_workspace(tmp_path, monkeypatch):
+    root = tmp_path / 'app'
+    write_files(root, WORKSPACE)
+    monkeypatch.chdir(tmp_path)
+
+    for member in ['.', 'packages/ui', 'packages/core', 'packages/core/plugins/p2']:
+        assert get_workspace_root(f'app/{member}') == str(root)
+
+    assert get_workspace_root('app/tools/gen') is None
+    assert get_workspace_members('app') == [
+        str(root / 'packages/ui'),
+        str(root / 'packages/core'),
+        str(root / 'packages/core/plugins/p1'),
+        str(root / 'packages/core/plugins/p2'),
+    ]
+
+    write_files(root, {'packages/lost/pubspec.yaml': 'name: lost\nresolution: workspace\n'})
+    os.remove(root / 'pubspec.yaml')
+
+    with pytest.raises(FileNotFoundError):
+        get_workspace_root('app/packages/lost')
+
+
+@pytest.mark.parametrize('relative', [False, True])
+def test_workspace_sources(flatpak_flutter, tmp_path, monkeypatch, capsys, relative):
+    'The sources come from the lock of the outer workspace, wherever the work dir is'
+    work_dir = tmp_path / 'work'
+    build_path = work_dir / flatpak_flutter.BUILD_PATH
+    flutter_tools = build_path / 'app-1/flutter/packages/flutter_tools'
+    write_files(build_path / 'app-1', WORKSPACE)
+    write_files(flutter_tools, {
+        'pubspec.lock': _lock(_hosted('yaml')),
+        '.dart_tool/package_config.json': f'{{"rootUri": "file://{build_path.absolute()}/app-1/flutter"}}\n',
+    })
+    os.symlink('app-1', build_path / 'app')
+    (tmp_path / 'elsewhere').mkdir()
+    monkeypatch.chdir(tmp_path if relative else tmp_path / 'elsewhere')
+
+    outputs = flatpak_flutter._generate_pubspec_sources(
+        'app', 'packages/core/plugins/p1', 'packages/ui,packages/core/plugins/p2,tools/gen', 1, TAG,
+        str(tmp_path / 'releases'), work_dir='work' if relative else str(work_dir),
+    )
+    sources_path = os.path.join('work' if relative else str(work_dir), 'pubspec-sources.json')
+
+    assert [source['dest-filename'] for source in outputs[sources_path] if source['type'] == 'inline'] == [
+        'http-1.0.0.sha256', 'yaml-1.0.0.sha256', 'args-1.0.0.sha256',
+    ]
+    assert 'Skipping packages/ui' in capsys.readouterr().out
+    assert outputs[os.path.join(os.path.dirname(sources_path), 'package_config.json')] == (
+        '{"rootUri": "file:///run/build/app/flutter"}\n'
+    )
+
+
+def _git(name: str, url: str, commit: str, path: str = '.') -> str:
+    return (
+        f'  {name}:\n'
+        f'    dependency: transitive\n'
+        f'    description:\n'
+        f'      path: "{path}"\n'
+        f'      ref: main\n'
+        f'      resolved-ref: "{commit}"\n'
+        f'      url: "{url}"\n'
+        f'    source: git\n'
+        f'    version: "1.0.0"\n'
+    )
+
+
+def test_git_packages_of_one_commit(tmp_path):
+    'Packages of a repo at the same commit share one checkout, in both the app and an extra lock'
+    url = 'https://example.com/plugins.git'
+    commit = 'a' * 40
+    write_files(tmp_path, {
+        'app/pubspec.lock': _lock(_git('plugin_a', url, commit, 'a'), _git('plugin_b', url, commit, 'b')),
+        'extra/pubspec.lock': _lock(_git('plugin_c', url, commit, 'c')),
+    })
+
+    paths = [str(tmp_path / 'app/pubspec.lock'), str(tmp_path / 'extra/pubspec.lock')]
+    sources = list(iter_package_sources(paths, set()))
+
+    assert sources == [
+        {'type': 'git', 'url': url, 'commit': commit, 'dest': f'.pub-cache/git/plugins-{commit}'},
+        {'type': 'shell', 'commands': sources[1]['commands']},
+    ]
+    assert generate_sources(paths) == sources
+
+    write_files(tmp_path, {'app/pubspec.lock': _lock(_git('plugin_d', url, commit, '../d'))})
+
+    with pytest.raises(AssertionError, match='plugin_d'):
+        generate_sources(paths)
+
+
+def test_git_packages_of_two_commits(tmp_path):
+    'Running the shell steps, the pub cache of a repo links the first checkout and borrows the objects of the others'
+    url = str(tmp_path / 'plugins')
+    first = make_repo(url, {'a/pubspec.yaml': 'name: plugin_a\n'})
+    second = make_repo(url, {'a/pubspec.yaml': 'name: plugin_a\nversion: 2.0.0\n'})
+    write_files(tmp_path, {
+        'app/pubspec.lock': _lock(_git('plugin_a', url, first, 'a')),
+        'extra/pubspec.lock': _lock(_git('plugin_a', url, second, 'a')),
+    })
+
+    sources = generate_sources([str(tmp_path / 'app/pubspec.lock'), str(tmp_path / 'extra/pubspec.lock')])
+    assert [source['type'] for source in sources] == ['git', 'shell', 'git', 'shell']
+
+    # Like flatpak-builder, check out only the commit of each git source, then run the shell steps
+    build_dir = tmp_path / 'build'
+    build_dir.mkdir()
+
+    for source in sources:
+        if source['type'] == 'git':
+            dest = str(build_dir / source['dest'])
+            subprocess.run(['git', 'init', '--quiet', dest], check=True)
+            subprocess.run(['git', '-C', dest, 'fetch', '--quiet', source['url'], source['commit']], check=True)
+            subprocess.run(['git', '-C', dest, 'checkout', '--quiet', 'FETCH_HEAD'], check=True)
+        else:
+            subprocess.run(['sh', '-c', ' && '.join(source['commands'])], cwd=build_dir, check=True)
+
+    [cache_path] = (build_dir / '.pub-cache/git/cache').iterdir()
+    assert os.readlink(cache_path) == f'../plugins-{first}/.git'
+    assert (cache_path / 'objects/info/alternates').read_text() == (
+        f'{build_dir}/.pub-cache/git/plugins-{second}/.git/objects\n'
+    )
+
+    for commit in [first, second]:
+        subprocess.run(['git', '--git-dir', str(cache_path), 'cat-file', '-e', commit], check=True)
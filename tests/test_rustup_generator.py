@@ -0,0 +1,65 @@
+__license__ = 'MIT'
+from pathlib import Path
+
+from conftest import read_json, sha256
+from rustup_generator.rustup_generator import DIST_PATH, RUSTUP_VERSION, STATIC_URL, main
+
+
+def _write_channel(path) -> str:
+    channel = ''
+
+    for component in ['cargo', 'rust-std', 'rustc']:
+        for target in ['x86_64-unknown-linux-gnu', 'aarch64-unknown-linux-gnu']:
+            channel += f'''
+[pkg.{component}.target.{target}]
+available = true
+url = "{STATIC_URL}/dist/2025-01-09/{component}-1.84.0-{target}.tar.gz"
+hash = "{sha256(f'{component}-{target}.tar.gz')}"
+xz_url = "{STATIC_URL}/dist/2025-01-09/{component}-1.84.0-{target}.tar.xz"
+xz_hash = "{sha256(f'{component}-{target}.tar.xz')}"
+'''
+
+    channel_path = str(path / 'channel-rust-1.84.0.toml')
+
+    with open(channel_path, 'w') as out:
+        out.write('date = "2025-01-09"\n' + channel)
+
+    return channel_path
+
+
+def test_channel(server, scheduler, tmp_path, monkeypatch):
+    for target in ['x86_64-unknown-linux-gnu', 'aarch64-unknown-linux-gnu']:
+        checksum = sha256(f'rustup-init-{target}')
+        server.add(f'/rustup/archive/{RUSTUP_VERSION}/{target}/rustup-init.sha256', f'{checksum}  rustup-init\n'.encode())
+
+    monkeypatch.setenv('RUSTUP_DIST_SERVER', server.url)
+    channel_path = _write_channel(tmp_path)
+    output_path = str(tmp_path / 'rustup-1.84.0.json')
+    main(['1.84.0', '--channel', channel_path, '-o', output_path])
+
+    sources = read_json(output_path)['sources']
+    channel_sha256 = sha256(Path(channel_path).read_bytes())
+    channel_url = f'{STATIC_URL}/dist/channel-rust-1.84.0.toml'
+    by_url = {source['url']: source for source in sources}
+
+    # Only the rustup-init hashes are downloaded, the channel is the local copy
+    assert sorted(server.requested()) == [
+        f'/rustup/archive/{RUSTUP_VERSION}/aarch64-unknown-linux-gnu/rustup-init.sha256',
+        f'/rustup/archive/{RUSTUP_VERSION}/x86_64-unknown-linux-gnu/rustup-init.sha256',
+    ]
+    assert len(sources) == 2 + 2 + 2 * 3
+
+    for arch, target in [('x86_64', 'x86_64-unknown-linux-gnu'), ('aarch64', 'aarch64-unknown-linux-gnu')]:
+        rustup_init = by_url[f'{STATIC_URL}/rustup/archive/{RUSTUP_VERSION}/{target}/rustup-init']
+        assert rustup_init['only-arches'] == [arch]
+        assert rustup_init['sha256'] == sha256(f'rustup-init-{target}')
+
+        for component in ['cargo', 'rust-std', 'rustc']:
+            package = by_url[f'{STATIC_URL}/dist/2025-01-09/{component}-1.84.0-{target}.tar.xz']
+            assert package['only-arches'] == [arch]
+            assert package['sha256'] == sha256(f'{component}-{target}.tar.xz')
+            assert package['dest'] == f'{DIST_PATH}/2025-01-09'
+
+    assert by_url[channel_url]['sha256'] == channel_sha256
+    # The .sha256 companion is the sha256sum line of the channel manifest
+    assert by_url[f'{channel_url}.sha256']['sha256'] == sha256(f'{channel_sha256}  channel-rust-1.84.0.toml\n')
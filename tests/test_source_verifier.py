@@ -0,0 +1,72 @@
+__license__ = 'MIT'
+import pytest
+
+from conftest import sha256, write_json
+from fetch_scheduler.fetch_scheduler import Scheduler, use_scheduler
+from source_verifier.source_verifier import main, verify_sources
+
+
+def test_verify_sources(server, scheduler, tmp_path):
+    server.add('/ok.tar.gz', b'ok')
+    server.add('/changed.tar.gz', b'changed')
+    sources_path = write_json(tmp_path / 'sources.json', [
+        {'type': 'archive', 'url': f'{server.url}/ok.tar.gz', 'sha256': sha256(b'ok')},
+        {'type': 'file', 'url': f'{server.url}/changed.tar.gz', 'sha256': sha256(b'original')},
+        {'type': 'file', 'url': f'{server.url}/missing.tar.gz', 'sha256': sha256(b'missing')},
+        {'type': 'file', 'url': f'{server.url}/unchecked.tar.gz'},
+        {'type': 'inline', 'contents': '', 'dest-filename': 'inline'},
+    ])
+
+    results = {result.url.rsplit('/', 1)[-1]: result for result in verify_sources([sources_path], {})}
+
+    assert sorted(results) == ['changed.tar.gz', 'missing.tar.gz', 'ok.tar.gz']
+    assert results['ok.tar.gz'].ok and results['ok.tar.gz'].size == 2
+    assert not results['changed.tar.gz'].ok
+    assert results['changed.tar.gz'].actual == sha256(b'changed') and results['changed.tar.gz'].error is None
+    assert not results['missing.tar.gz'].ok
+    assert results['missing.tar.gz'].actual is None and '404' in results['missing.tar.gz'].error
+
+
+def test_mirror(server, tmp_path, capsys):
+    server.add('/mirror/crates/a/a-1.0.0.crate', b'crate')
+    sources_path = write_json(tmp_path / 'sources.json', [
+        {'type': 'archive', 'url': 'https://static.crates.io/crates/a/a-1.0.0.crate', 'sha256': sha256(b'crate')},
+    ])
+
+    assert main(['--mirror', f'https://static.crates.io={server.url}/mirror', sources_path]) == 0
+    assert server.requested() == ['/mirror/crates/a/a-1.0.0.crate']
+    assert 'Verified 1 sources' in capsys.readouterr().out
+
+    server.add('/mirror/crates/a/a-1.0.0.crate', b'changed')
+
+    assert main(['--mirror', f'https://static.crates.io={server.url}/mirror/', sources_path]) == 1
+
+
+@pytest.mark.parametrize('host_jobs', [1, 2])
+def test_mirror_host_limit(server, tmp_path, host_jobs):
+    'The downloads are limited per host of the mirror, not of the upstream URLs'
+    # The upstream URLs, by their path on the mirrors
+    urls = {
+        '/crates.io/crates/a/a-1.0.0.crate': 'https://static.crates.io/crates/a/a-1.0.0.crate',
+        '/crates.io/crates/b/b-1.0.0.crate': 'https://static.crates.io/crates/b/b-1.0.0.crate',
+        '/pub.dev/api/archives/c-1.0.0.tar.gz': 'https://pub.dev/api/archives/c-1.0.0.tar.gz',
+        '/pub.dev/api/archives/d-1.0.0.tar.gz': 'https://pub.dev/api/archives/d-1.0.0.tar.gz',
+    }
+    mirrors = {'https://static.crates.io': f'{server.url}/crates.io', 'https://pub.dev': f'{server.url}/pub.dev'}
+    server.delay = 0.2
+
+    for path in urls:
+        server.add(path, b'x')
+
+    sources_path = write_json(tmp_path / 'sources.json', [
+        {'type': 'archive', 'url': url, 'sha256': sha256(b'x')} for url in urls.values()
+    ])
+
+    with use_scheduler(Scheduler(jobs=4, host_jobs=host_jobs, retries=0)) as scheduler:
+        results = verify_sources([sources_path], mirrors)
+
+    scheduler.shutdown()
+
+    assert sorted(result.url for result in results if result.ok) == sorted(urls.values())
+    assert sorted(server.requested()) == sorted(urls)
+    assert server.peak == host_jobs